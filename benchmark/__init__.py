@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# 
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# Benchmarks, run from the root of the repository. The suite of all stages
+# over a generated corpus, with JSON output:
+#
+#     python -m benchmark.suite [--save results.json] [--baseline results.json]
+#     python -m benchmark.corpus [--templates N] > corpus.soy
+#
+# The other modules are scripts for single stages: python benchmark/NAME.py
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# Synthetic template corpus. Every template nests foreach and if commands
+# depth levels deep and prints expressions of complexity terms at the
+# bottom. Template i calls template i + 1, so rendering t0 runs them all.
+
+import random
+import argparse
+
+OPERATORS = ['+', '-', '*']
+
+def makeExpression(rng, var, complexity):
+    text = '$%s.n' % var
+    for i in xrange(complexity - 1):
+        term = rng.choice(['$%s.n' % var, '$%s.m' % var, str(rng.randint(1, 9))])
+        text = '%s %s %s' % (text, rng.choice(OPERATORS), term)
+    return text
+
+def makeBlock(rng, var, depth, complexity, level=0):
+    indent = '    ' * (level + 1)
+
+    if depth == 0:
+        return ('%s<span class="v">{%s}</span> {$%s.name}\n'
+                % (indent, makeExpression(rng, var, complexity), var))
+
+    if depth % 2:
+        loopVar = 'v%d' % level
+        return ('%s{foreach $%s in $items}\n%s%s{ifempty}\n%s    none\n%s{/foreach}\n'
+                % (indent, loopVar, makeBlock(rng, loopVar, depth - 1, complexity, level + 1),
+                   indent, indent, indent))
+    else:
+        return ('%s{if %s > 0}\n%s%s{else}\n%s    <i>{$%s.name |noAutoescape}</i>\n%s{/if}\n'
+                % (indent, makeExpression(rng, var, complexity),
+                   makeBlock(rng, var, depth - 1, complexity, level + 1), indent, indent, var, indent))
+
+def generateNamespace(templates=20, depth=3, loop=10, complexity=3, seed=0):
+    """Returns the text of a namespace and the data to render its template t0 with"""
+
+    rng = random.Random(seed)
+    parts = ['{namespace benchmark.corpus}\n']
+
+    for i in xrange(templates):
+        parts.append('\n{template t%d}\n' % i)
+        parts.append('    <h2>{$title}</h2>\n')
+        parts.append(makeBlock(rng, 'row', depth, complexity))
+        if i + 1 < templates:
+            parts.append('    {call t%d data="all" /}\n' % (i + 1))
+        parts.append('{/template}\n')
+
+    data = { 'title': 'Benchmark <corpus>',
+             'row': { 'n': 1, 'm': 2, 'name': 'row & co' },
+             'items': [{ 'n': i, 'm': i % 7, 'name': 'item <%d>' % i } for i in xrange(loop)] }
+
+    return ''.join(parts), data
+
+if __name__ == "__main__":
+    argsParser = argparse.ArgumentParser(description='Synthetic template corpus')
+    argsParser.add_argument('--templates', type=int, default=20)
+    argsParser.add_argument('--depth', type=int, default=3)
+    argsParser.add_argument('--loop', type=int, default=10)
+    argsParser.add_argument('--complexity', type=int, default=3)
+    argsParser.add_argument('--seed', type=int, default=0)
+    args = argsParser.parse_args()
+
+    print generateNamespace(args.templates, args.depth, args.loop, args.complexity, args.seed)[0]
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# Throughput of the print directives' escape functions, against the former
+# character-by-character implementations:
+#
+#     python benchmark/escape.py [--length N] [--repeat N]
+
+import sys
+import time
+import argparse
+from StringIO import StringIO
+
+sys.path[0:0] = [""]
+
+from pyclosuretempaltes.python_backend import escapeHtml, encodeUri, encodeUriComponent
+
+def charEscapeHtml(text):
+    out = StringIO()
+    for ch in text:
+        if ch == '<':
+            out.write('&lt;')
+        elif ch == '>':
+            out.write('&gt;')
+        elif ch == '"':
+            out.write('&quot;')
+        elif ch =="'":
+            out.write('&#039;')
+        elif ch == '&':
+            out.write('&amp;')
+        else:
+            out.write(ch)
+    return out.getvalue()
+
+def charEncodeString(text, notEncode):
+    out = StringIO()
+    for ch in text:
+        if (chr(0) <= ch <= chr(9)) or ('a' <= ch <= 'z') or ('A' <= ch <= 'Z') or (ch in notEncode):
+            out.write(str(ch))
+        else:
+            for octet in ch.encode('utf-8'):
+                out.write('%%%02X' % ord(octet))
+    return out.getvalue()
+
+FUNCTIONS = [('escapeHtml', escapeHtml, charEscapeHtml),
+             ('encodeUri', encodeUri, lambda text: charEncodeString(text, '~!@#$&*()=:/,;?+\'')),
+             ('encodeUriComponent', encodeUriComponent, lambda text: charEncodeString(text, '~!*()\''))]
+
+INPUTS = [('ascii', u'The quick brown fox jumps over the lazy dog '),
+          ('mixed', u'Fox & dog: <b>быстрая</b> café '),
+          ('heavy', u'<<>>&&""\'\'/?#=<&>"\'')]
+
+def measure(fun, text, repeat):
+    best = None
+    for i in xrange(5):
+        start = time.time()
+        for j in xrange(repeat):
+            fun(text)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best / repeat
+
+if __name__ == "__main__":
+    argsParser = argparse.ArgumentParser(description='Escape functions benchmark')
+    argsParser.add_argument('--length', type=int, default=200)
+    argsParser.add_argument('--repeat', type=int, default=1000)
+    args = argsParser.parse_args()
+
+    print '%-20s %-6s %12s %12s %10s' % ('function', 'input', 'char us', 'table us', 'speedup')
+    for name, fun, reference in FUNCTIONS:
+        for inputName, sample in INPUTS:
+            text = (sample * (args.length / len(sample) + 1))[:args.length]
+            assert fun(text) == reference(text)
+
+            old = measure(reference, text, args.repeat)
+            new = measure(fun, text, args.repeat)
+            print '%-20s %-6s %12.2f %12.2f %10.1f' % (name, inputName, old * 1e6, new * 1e6, old / new)
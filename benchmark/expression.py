@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# Expression parsing time against the number of operands. The time per
+# operand should stay flat as expressions grow:
+#
+#     python benchmark/expression.py [--sizes 10,100,1000] [--parser descent|lepl]
+
+import sys
+import time
+import argparse
+
+sys.path[0:0] = [""]
+
+from pyclosuretempaltes.parser import parseExpression
+
+def andOrChain(size):
+    return ' or '.join(['$a%d and $b%d' % (i, i) for i in xrange(size / 2)])
+
+def concatenation(size):
+    return ' + '.join(["'s%d'" % i if i % 2 else '$v%d' % i for i in xrange(size)])
+
+def arithmetic(size):
+    ops = ['+', '*', '-', '/', '%']
+    parts = ['$x0']
+    for i in xrange(1, size):
+        parts.append(ops[i % len(ops)])
+        parts.append('$x%d' % i)
+    return ' '.join(parts)
+
+def refChain(size):
+    return '$a' + ''.join(['.b%d[%d]' % (i, i) for i in xrange(size / 2)])
+
+SHAPES = [('and/or', andOrChain),
+          ('concat', concatenation),
+          ('arith', arithmetic),
+          ('refs', refChain)]
+
+def measure(text, parser, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        parseExpression(text, parser)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+if __name__ == "__main__":
+    argsParser = argparse.ArgumentParser(description='Expression parser scaling benchmark')
+    argsParser.add_argument('--sizes', default='10,30,100,300,1000')
+    argsParser.add_argument('--repeat', type=int, default=5)
+    argsParser.add_argument('--parser', default='descent', choices=['descent', 'lepl'])
+    args = argsParser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    print '%-8s %8s %12s %14s' % ('shape', 'operands', 'ms', 'us/operand')
+    for name, generator in SHAPES:
+        for size in sizes:
+            elapsed = measure(generator(size), args.parser, args.repeat)
+            print '%-8s %8d %12.3f %14.2f' % (name, size, elapsed * 1e3, elapsed * 1e6 / size)
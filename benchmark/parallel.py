@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# Scaling of parseDirectory from one to N worker processes:
+#
+#     python benchmark/parallel.py [--files N] [--copies N] [--workers 1,2,4]
+
+import sys
+import time
+import shutil
+import codecs
+import os.path
+import tempfile
+import argparse
+import multiprocessing
+
+sys.path[0:0] = [""]
+
+from pyclosuretempaltes.parser import parseDirectory
+from benchmark.parse import makeCorpus
+
+def writeCorpus(directory, files, copies):
+    text = makeCorpus(copies)
+    for i in xrange(files):
+        with codecs.open(os.path.join(directory, 'file%04d.soy' % i), 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    return len(text.encode('utf-8')) * files / 1e6
+
+if __name__ == "__main__":
+    cpus = multiprocessing.cpu_count()
+    defaultWorkers = sorted(set([1, 2, 4, 8, cpus]) & set(range(1, cpus + 1)))
+
+    argsParser = argparse.ArgumentParser(description='Parallel parsing benchmark')
+    argsParser.add_argument('--files', type=int, default=200)
+    argsParser.add_argument('--copies', type=int, default=2)
+    argsParser.add_argument('--workers', default=','.join(map(str, defaultWorkers)))
+    argsParser.add_argument('--parser', default='descent', choices=['descent', 'lepl'])
+    args = argsParser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        size = writeCorpus(directory, args.files, args.copies)
+        print '%d files, %.3f MB, %d CPUs' % (args.files, size, cpus)
+
+        base = None
+        print '%8s %10s %10s %10s' % ('workers', 's', 'MB/s', 'speedup')
+        for workers in [int(n) for n in args.workers.split(',')]:
+            start = time.time()
+            parseDirectory(directory, workers=workers, parser=args.parser)
+            elapsed = time.time() - start
+
+            base = base or elapsed
+            print '%8d %10.3f %10.3f %10.2f' % (workers, elapsed, size / elapsed, base / elapsed)
+    finally:
+        shutil.rmtree(directory)
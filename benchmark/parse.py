@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# Parser throughput in MB/s:
+#
+#     python benchmark/parse.py [--copies N] [--repeat N] [--parser descent|lepl]
+
+import re
+import sys
+import time
+import codecs
+import os.path
+import argparse
+
+sys.path[0:0] = [""]
+
+from pyclosuretempaltes.parser import parseNamespace
+
+TEST_SOY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'js', 'template.soy')
+
+def makeCorpus(copies):
+    with codecs.open(TEST_SOY, encoding='utf-8') as f:
+        text = f.read()
+
+    start = text.index('{template')
+    header, body = text[:start], text[start:]
+
+    parts = [header]
+    for i in xrange(copies):
+        parts.append(re.sub('\\{(template|call) ([A-Za-z0-9_]+)(?![A-Za-z0-9_=])', '{\\1 \\2_%d' % i, body))
+
+    return ''.join(parts)
+
+def measure(text, parser, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        parseNamespace(text, parser)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+if __name__ == "__main__":
+    argsParser = argparse.ArgumentParser(description='Parser throughput benchmark')
+    argsParser.add_argument('--copies', type=int, default=10)
+    argsParser.add_argument('--repeat', type=int, default=3)
+    argsParser.add_argument('--parser', action='append', choices=['descent', 'lepl'])
+    args = argsParser.parse_args()
+
+    text = makeCorpus(args.copies)
+    size = len(text.encode('utf-8')) / 1e6
+
+    print '%.3f MB, %d copies of template.soy' % (size, args.copies)
+    for parser in args.parser or ['descent', 'lepl']:
+        elapsed = measure(text, parser, args.repeat)
+        print '%-8s %8.3f s %10.3f MB/s' % (parser, elapsed, size / elapsed)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# Render time of the closure interpreter against the compiled templates,
+# over the namespaces and calls of test/test_py_backend.py:
+#
+#     python benchmark/render.py [--repeat N]
+
+import sys
+import ast
+import time
+import argparse
+
+sys.path[0:0] = [""]
+
+from pyclosuretempaltes.parser import parseNamespace
+from pyclosuretempaltes.python_backend import makeTTable
+from pyclosuretempaltes.python_compiler import makeCompiledTTable
+
+TESTS = 'test/test_py_backend.py'
+
+def isMethodCall(node, name):
+    return (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+            and node.func.attr == name)
+
+def loadCases(path=TESTS):
+    """Returns (test name, namespace text, [(template, data)]) for every
+    namespace of the tests, with the calls that follow it in the source."""
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+
+    cases = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.FunctionDef) and node.name.startswith('test'):
+            items = sorted([item for item in ast.walk(node) if isinstance(item, ast.Call)],
+                           key=lambda item: (item.lineno, item.col_offset))
+            groups = []
+            for item in items:
+                if getattr(item.func, 'id', None) == 'parseNamespace':
+                    try:
+                        groups.append((ast.literal_eval(item.args[0]), []))
+                    except (ValueError, SyntaxError):
+                        # a namespace built at run time
+                        pass
+                elif isMethodCall(item, 'callTemplate') and groups:
+                    try:
+                        groups[-1][1].append(tuple(ast.literal_eval(arg) for arg in item.args))
+                    except (ValueError, SyntaxError):
+                        # data built at run time
+                        pass
+
+            for i, (text, calls) in enumerate(groups):
+                # the templates of other tables, as a prototype, are not measured
+                names = set(tmpl.name for tmpl in parseNamespace(text).templates)
+                calls = [call for call in calls if call[0] in names]
+                if calls:
+                    cases.append((node.name if i == 0 else '%s.%d' % (node.name, i + 1), text, calls))
+
+    cases.sort()
+    return cases
+
+def measure(ttable, calls, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        for name, data in calls:
+            ttable.callTemplate(name, data)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best / len(calls)
+
+if __name__ == "__main__":
+    argsParser = argparse.ArgumentParser(description='Closure interpreter against compiled templates')
+    argsParser.add_argument('--repeat', type=int, default=2000)
+    args = argsParser.parse_args()
+
+    print '%-24s %14s %14s %10s' % ('test', 'closure us', 'compiled us', 'speedup')
+    for name, text, calls in loadCases():
+        nameSpace = parseNamespace(text)
+        closure = measure(makeTTable(nameSpace), calls, args.repeat)
+        compiled = measure(makeCompiledTTable(nameSpace), calls, args.repeat)
+
+        print '%-24s %14.2f %14.2f %10.2f' % (name, closure * 1e6, compiled * 1e6, closure / compiled)
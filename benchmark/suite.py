@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# Times every stage over a generated corpus and prints the results as JSON:
+#
+#     python -m benchmark.suite [--templates N] [--depth N] [--loop N] [--complexity N]
+#                               [--save FILE] [--baseline FILE] [--threshold 0.1]
+#
+# With --baseline the stages slower than the baseline by more than threshold
+# are reported as regressions and the exit status is 1.
+
+import sys
+import json
+import platform
+import argparse
+from timeit import default_timer
+
+sys.path[0:0] = [""]
+
+from pyclosuretempaltes.parser import parseNamespace
+from pyclosuretempaltes.python_backend import makeTTable
+from pyclosuretempaltes.python_compiler import makeCompiledTTable
+from pyclosuretempaltes.javascript_backend import compileNamespaceToJS
+
+from benchmark.corpus import generateNamespace
+
+def measure(fun, repeat, number):
+    """Best time of one call over repeat runs of number calls"""
+
+    best = None
+    for i in xrange(repeat):
+        start = default_timer()
+        for j in xrange(number):
+            fun()
+        elapsed = (default_timer() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def runSuite(templates=20, depth=3, loop=10, complexity=3, repeat=5, number=10):
+    text, data = generateNamespace(templates, depth, loop, complexity)
+    nameSpace = parseNamespace(text)
+    ttable = makeTTable(nameSpace)
+    compiled = makeCompiledTTable(nameSpace)
+
+    output = ttable.callTemplate('t0', data)
+    if compiled.callTemplate('t0', data) != output:
+        raise Exception('The compiled templates render differently')
+
+    stages = [('parseNamespace', lambda: parseNamespace(text)),
+              ('makeTTable', lambda: makeTTable(nameSpace)),
+              ('callTemplate', lambda: ttable.callTemplate('t0', data)),
+              ('makeCompiledTTable', lambda: makeCompiledTTable(nameSpace)),
+              ('callCompiledTemplate', lambda: compiled.callTemplate('t0', data)),
+              ('compileNamespaceToJS', lambda: compileNamespaceToJS(nameSpace))]
+
+    results = dict()
+    for name, fun in stages:
+        seconds = measure(fun, repeat, number)
+        results[name] = { 'seconds': seconds, 'perSecond': 1.0 / seconds if seconds else None }
+
+    return { 'corpus': { 'templates': templates, 'depth': depth, 'loop': loop, 'complexity': complexity,
+                         'sourceCharacters': len(text), 'outputCharacters': len(output) },
+             'python': platform.python_version(),
+             'results': results }
+
+def compareResults(results, baseline, threshold):
+    """Ratio of the current to the baseline time of every stage in both"""
+
+    comparison = dict()
+    for name, current in results['results'].iteritems():
+        before = baseline['results'].get(name)
+        if before and before['seconds']:
+            ratio = current['seconds'] / before['seconds']
+            comparison[name] = { 'baseline': before['seconds'],
+                                 'current': current['seconds'],
+                                 'ratio': ratio,
+                                 'regression': ratio > 1 + threshold }
+
+    if baseline.get('corpus') != results['corpus']:
+        sys.stderr.write('warning: the baseline was measured on a different corpus\n')
+
+    return comparison
+
+if __name__ == "__main__":
+    argsParser = argparse.ArgumentParser(description='Parse, build, render and compile benchmarks')
+    argsParser.add_argument('--templates', type=int, default=20)
+    argsParser.add_argument('--depth', type=int, default=3)
+    argsParser.add_argument('--loop', type=int, default=10)
+    argsParser.add_argument('--complexity', type=int, default=3)
+    argsParser.add_argument('--repeat', type=int, default=5)
+    argsParser.add_argument('--number', type=int, default=10)
+    argsParser.add_argument('--save', help='write the results to this file')
+    argsParser.add_argument('--baseline', help='compare with the results saved in this file')
+    argsParser.add_argument('--threshold', type=float, default=0.1,
+                            help='slowdown reported as a regression, 0.1 is 10%%')
+    args = argsParser.parse_args()
+
+    results = runSuite(args.templates, args.depth, args.loop, args.complexity, args.repeat, args.number)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['comparison'] = compareResults(results, json.load(f), args.threshold)
+        regressions = [name for name, item in results['comparison'].iteritems() if item['regression']]
+
+    print json.dumps(results, indent=2, sort_keys=True)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# Switch dispatch time against the number of cases, with the dict lookup and
+# with the linear scan of the cases. The values cycle through every case, so
+# the scan tests half the cases on average:
+#
+#     python benchmark/switch.py [--sizes 5,50,500] [--loop 1000]
+
+import sys
+import time
+import argparse
+
+sys.path[0:0] = [""]
+
+from pyclosuretempaltes.parser import parseNamespace
+from pyclosuretempaltes import python_backend, python_compiler
+
+def makeNamespace(size):
+    cases = ''.join(["{case 'v%d'}%d" % (i, i) for i in xrange(size)])
+    return parseNamespace('{namespace benchmark.switch}\n'
+                          '{template page}{foreach $value in $values}'
+                          '{switch $value}%s{default}-{/switch}'
+                          '{/foreach}{/template}\n' % cases)
+
+def measure(ttable, env, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        ttable.callTemplate('page', env)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def makeLinearTTables(nameSpace):
+    # the ttables as they were built before the dict dispatch
+    makeSwitchTable = python_backend.makeSwitchTable
+    dispatchCases = python_compiler.SWITCH_DISPATCH_CASES
+    python_backend.makeSwitchTable = lambda cases: None
+    python_compiler.SWITCH_DISPATCH_CASES = sys.maxint
+    try:
+        return (python_backend.makeTTable(nameSpace), python_compiler.makeCompiledTTable(nameSpace))
+    finally:
+        python_backend.makeSwitchTable = makeSwitchTable
+        python_compiler.SWITCH_DISPATCH_CASES = dispatchCases
+
+if __name__ == "__main__":
+    argsParser = argparse.ArgumentParser(description='Switch dispatch benchmark')
+    argsParser.add_argument('--sizes', default='5,50,500')
+    argsParser.add_argument('--loop', type=int, default=1000)
+    argsParser.add_argument('--repeat', type=int, default=5)
+    args = argsParser.parse_args()
+
+    print '%-9s %6s %12s %12s %9s' % ('backend', 'cases', 'dict us', 'linear us', 'speedup')
+    for size in [int(size) for size in args.sizes.split(',')]:
+        nameSpace = makeNamespace(size)
+        env = { 'values': ['v%d' % (i % size) for i in xrange(args.loop)] }
+
+        dispatch = (python_backend.makeTTable(nameSpace), python_compiler.makeCompiledTTable(nameSpace))
+        for name, fast, slow in zip(['closure', 'compiled'], dispatch, makeLinearTTables(nameSpace)):
+            if fast.callTemplate('page', env) != slow.callTemplate('page', env):
+                raise Exception('The dispatch renders differently')
+
+            fastTime = measure(fast, env, args.repeat) * 1e6 / args.loop
+            slowTime = measure(slow, env, args.repeat) * 1e6 / args.loop
+            print '%-9s %6d %12.2f %12.2f %8.1fx' % (name, size, fastTime, slowTime, slowTime / fastTime)
@@ -15,3 +15,5 @@
 # permissions and limitations under the License.
 
 from javascript_backend import compileNamespaceToJS, compileToJS
+from python_compiler import compileNamespaceToPython, compileToPython, compileDirectory, makeCompiledTTable
+from reloader import Reloader
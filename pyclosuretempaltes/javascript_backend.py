@@ -14,13 +14,17 @@
 # implied.  See the License for the specific language governing
 # permissions and limitations under the License.
 
+import argparse
 import json
+import sys
 from StringIO import StringIO
 from contextlib import closing
 
 from parser import *
 from lepl import List
 
+from optimizer import optimizeNamespace, blockText, copyNode, CallGraph
+
 
 symbolCounter = 1
 
@@ -253,7 +257,83 @@ def writeIf(if_, autoescape, namespace, localVars, indentLevel, out):
 
 # Switch
 
+# switches with this many cases look the case up in an object
+SWITCH_DISPATCH_CASES = 8
+
+def switchKey(value):
+    # typeof value + ":" + value, so that the lookup matches like === does;
+    # None for values whose string form differs in JavaScript (floats)
+    if isinstance(value, bool):
+        return 'boolean:%s' % ('true' if value else 'false')
+    elif isinstance(value, (int, long)):
+        return 'number:%d' % value
+    elif isinstance(value, basestring):
+        return 'string:%s' % value
+    else:
+        return None
+
+def makeSwitchIndex(cases):
+    index = dict()
+    for number, case in enumerate(cases):
+        for item in case[0]:
+            key = switchKey(item)
+            if key is None:
+                return None
+            index.setdefault(key, number + 1)
+
+    return index
+
+def writeSwitchDispatch(switch_, autoescape, namespace, localVars, indentLevel, out):
+    cases = [case for case in switch_.cases if isinstance(case, tuple)]
+    if len(cases) < SWITCH_DISPATCH_CASES:
+        return False
+
+    index = makeSwitchIndex(cases)
+    if index is None:
+        return False
+
+    global symbolCounter
+
+    symbolCounter += 1
+    valueName = '$value_%s$' % symbolCounter
+    switches = '%s.$switches$' % namespace
+
+    writeIndent(indentLevel, out)
+    out.write('var %s = ' % valueName)
+    writeExpression(switch_.expr, namespace, localVars, out)
+    out.write(';\n')
+
+    # the table is built on the first use, then the switch is on dense integers
+    writeIndent(indentLevel, out)
+    out.write('switch ((%s[%d] || (%s[%d] = %s))[typeof %s + ":" + %s]) {\n'
+              % (switches, symbolCounter, switches, symbolCounter,
+                 json.dumps(index, sort_keys=True), valueName, valueName))
+
+    for number, case in enumerate(cases):
+        writeIndent(indentLevel + 1, out)
+        out.write('case %d:\n' % (number + 1))
+
+        writeCommand(case[1], autoescape, namespace, localVars, indentLevel + 2, out)
+        writeIndent(indentLevel + 2, out)
+        out.write('break;\n')
+
+    for case in switch_.cases:
+        if not isinstance(case, tuple):
+            writeIndent(indentLevel + 1, out)
+            out.write('default:\n')
+
+            writeCommand(case, autoescape, namespace, localVars, indentLevel + 2, out)
+            writeIndent(indentLevel + 2, out)
+            out.write('break;\n')
+
+    writeIndent(indentLevel, out)
+    out.write('}\n')
+    return True
+
 def writeSwitch(switch_, autoescape, namespace, localVars, indentLevel, out):
+    if writeSwitchDispatch(switch_, autoescape, namespace, localVars, indentLevel, out):
+        return
+
     writeIndent(indentLevel, out)
     out.write('switch ')
     with PrintParenthesis(out):
@@ -428,6 +508,58 @@ def writeCall(call_, autoescape, namespace, localVars, indentLevel, out):
             out.write(', $result$')
         out.write(';\n')
 
+# Cache
+
+def writeCache(cache_, autoescape, namespace, localVars, indentLevel, out):
+    global symbolCounter
+
+    symbolCounter += 1
+    keyName = '$fragment_%s$' % symbolCounter
+    bodyName = '$fragmentBody_%s$' % symbolCounter
+    fragments = '%s.$fragments$' % namespace
+
+    # the fragments live as long as the page, so the ttl is not needed
+    writeIndent(indentLevel, out)
+    out.write('var %s = ' % keyName)
+    writeExpression(cache_.key, namespace, localVars, out)
+    out.write(';\n')
+
+    writeIndent(indentLevel, out)
+    out.write('var %s = function () {\n' % bodyName)
+
+    writeIndent(indentLevel + 1, out)
+    out.write('var $result$ = [];\n')
+
+    writeCommand(cache_.code, autoescape, namespace, localVars, indentLevel + 1, out)
+
+    writeIndent(indentLevel + 1, out)
+    out.write('return $result$.join("");\n')
+
+    writeIndent(indentLevel, out)
+    out.write('};\n')
+
+    # objects and arrays would all be "[object Object]" or their items
+    # joined: as in Python, such keys are not cached
+    writeIndent(indentLevel, out)
+    out.write('if (%s == null || typeof %s != "object" && typeof %s != "function") {\n'
+              % (keyName, keyName, keyName))
+
+    writeIndent(indentLevel + 1, out)
+    out.write('%s = "%s:" + %s;\n' % (keyName, symbolCounter, keyName))
+
+    writeIndent(indentLevel + 1, out)
+    out.write('if (!%s.hasOwnProperty(%s)) %s[%s] = %s();\n'
+              % (fragments, keyName, fragments, keyName, bodyName))
+
+    writeIndent(indentLevel + 1, out)
+    out.write('$result$.push(%s[%s]);\n' % (fragments, keyName))
+
+    writeIndent(indentLevel, out)
+    out.write('}\n')
+
+    writeIndent(indentLevel, out)
+    out.write('else $result$.push(%s());\n' % bodyName)
+
 
 # All Commands
         
@@ -448,6 +580,8 @@ def writeCommand(cmd, autoescape, namespace, localVars, indentLevel, out):
         writeFor(cmd, autoescape, namespace, localVars, indentLevel, out)
     elif isinstance(cmd, Call):
         writeCall(cmd, autoescape, namespace, localVars, indentLevel, out)
+    elif isinstance(cmd, Cache):
+        writeCache(cmd, autoescape, namespace, localVars, indentLevel, out)
     elif isText(cmd):
         writeIndent(indentLevel, out)
         out.write('$result$.push')
@@ -459,7 +593,22 @@ def writeCommand(cmd, autoescape, namespace, localVars, indentLevel, out):
 # namespace/template
 ####################################################################################################
     
+def writeStaticTemplate(tmpl, text, namespace, out):
+    out.write('\n%s.%s = function($env$, $target$) {\n' % (namespace, tmpl.name))
+    writeIndent(1, out)
+    out.write('if (!$target$) return %s;\n' % js(text))
+    writeIndent(1, out)
+    out.write('$target$.push(%s);\n' % js(text))
+    writeIndent(1, out)
+    out.write('return null;\n')
+    out.write('};\n')
+
 def writeTemplate(tmpl, namespace,  out):
+    text = blockText(tmpl.code)
+    if text is not None:
+        writeStaticTemplate(tmpl, text, namespace, out)
+        return
+
     out.write('\n%s.%s = function($env$, $target$) {\n' % (namespace, tmpl.name))
     writeIndent(1, out)
     out.write('if (!$env$) { $env$ = {}; }\n')
@@ -514,6 +663,12 @@ def writeNamespace(namespace, out):
     out.write('    else return Math.round(number);')
     out.write('\n};\n')
 
+    # fragments of the {cache} commands
+    out.write('\n%s.%s = {};\n' % (name, '$fragments$'))
+
+    # lookup tables of the large {switch} commands
+    out.write('\n%s.%s = {};\n' % (name, '$switches$'))
+
     # objectFromPrototype
     out.write('\n%s.%s = function(obj) {\n' % (name, '$objectFromPrototype$'))
     out.write('    function C () {}\n')
@@ -524,32 +679,78 @@ def writeNamespace(namespace, out):
     for tmpl in namespace.templates:
         writeTemplate(tmpl, name, out)
 
-def compileNamespaceToJS(namespace):
+def shakeNamespace(namespace, entryPoints, report=None):
+    """namespace with only the templates reachable from entryPoints. A
+    reachable {call} with a computed name can reach any template: then all
+    of them are kept, and the callers are reported in report['dynamicCalls']."""
+
+    graph = CallGraph(namespace.templates)
+    for name in entryPoints:
+        if name not in graph.calls:
+            raise Exception('Template %s is undefined' % name)
+
+    reachable = graph.reachable(entryPoints)
+    dynamicCalls = sorted(graph.dynamic & reachable)
+    if dynamicCalls:
+        reachable = set(graph.calls)
+
+    kept = [tmpl for tmpl in namespace.templates if tmpl.name in reachable]
+    removed = [tmpl for tmpl in namespace.templates if tmpl.name not in reachable]
+
+    if report is not None:
+        sizes = dict()
+        for tmpl in removed:
+            with closing(StringIO()) as out:
+                writeTemplate(tmpl, namespace.name, out)
+                sizes[tmpl.name] = len(out.getvalue())
+
+        report.update({
+                'entryPoints': list(entryPoints),
+                'dynamicCalls': dynamicCalls,
+                'kept': [tmpl.name for tmpl in kept],
+                'removed': sizes,
+                'removedBytes': sum(sizes.values()) })
+
+    return copyNode(namespace, [namespace.name] + kept)
+
+def compileNamespaceToJS(namespace, inlineCalls=True, entryPoints=None, report=None):
+    """The JavaScript code of namespace. With entryPoints, only the templates
+    they reach are written, and report, a dict, tells what was removed and
+    the size in bytes of the code."""
+
+    namespace = optimizeNamespace(namespace, inlineCalls)
+    if entryPoints is not None:
+        namespace = shakeNamespace(namespace, entryPoints, report)
+
     with closing(StringIO()) as out:
         writeNamespace(namespace, out)
+        if report is not None:
+            report['bytes'] = len(out.getvalue())
         return out.getvalue()
 
-def compileToJS(path):
-    return compileNamespaceToJS(parseFile(path))
+def compileToJS(path, inlineCalls=True, entryPoints=None, report=None):
+    return compileNamespaceToJS(parseFile(path), inlineCalls, entryPoints, report)
 
 ####################################################################################################
 # main
 ####################################################################################################
 
 if __name__ == "__main__":
-    namespace = parseNamespace("""
-    {namespace merchandising.view}
-
-    {template helloWorld}
-       Hello world!
-    {/template}
-
-    {template helloName}
-       Hello {$name}
-    {/template}
-
-    """)
-
-    with closing(StringIO()) as out:
-        writeNamespace(namespace, [], out)
-        print out.getvalue()
+    argsParser = argparse.ArgumentParser(description='Compile a .soy file to JavaScript')
+    argsParser.add_argument('path')
+    argsParser.add_argument('--entry-point', dest='entryPoints', action='append', default=None,
+                            help='emit only the templates reachable from this one, can be repeated')
+    argsParser.add_argument('--no-inline', dest='inlineCalls', action='store_false')
+    args = argsParser.parse_args()
+
+    report = dict()
+    print compileToJS(args.path, args.inlineCalls, args.entryPoints, report)
+
+    if args.entryPoints:
+        # the size report goes to stderr, next to the code on stdout
+        if report['dynamicCalls']:
+            print >> sys.stderr, 'not pruned, computed {call} names in: %s' % ', '.join(report['dynamicCalls'])
+        print >> sys.stderr, 'removed %d templates, %d bytes; %d bytes written' % (
+            len(report['removed']), report['removedBytes'], report['bytes'])
+        for name, size in sorted(report['removed'].items(), key=lambda item: -item[1]):
+            print >> sys.stderr, '  %8d  %s' % (size, name)
@@ -0,0 +1,674 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# Compile time optimization of the AST, shared by the backends. Constant
+# expressions are folded, the branches of {if} and {switch} commands with
+# constant conditions are pruned, and every run of text, {sp}-like
+# characters, {literal} blocks and prints of constants becomes one string.
+# Within a namespace, the static {call}s of small templates are replaced by
+# the code of the callee with the params substituted. The call graph of a
+# namespace tells the templates that its entry points can reach.
+#
+# A subtree is folded only when Python and JavaScript agree on its value:
+# '1.5 + "a"' or '-7 % 2' are left to the backends. The parsed AST is not
+# modified, the changed nodes are copies that keep the source positions.
+
+import math
+import operator
+
+from parser import *
+from lepl import List
+
+####################################################################################################
+# helpers
+####################################################################################################
+
+# integers beyond this lose precision in JavaScript
+MAX_SAFE_INTEGER = 2 ** 53
+
+def copyNode(node, items):
+    """node itself if items are its items, else a copy of node with items"""
+
+    if len(items) == len(node) and all(a is b for a, b in zip(items, node)):
+        return node
+
+    result = node.__class__(items)
+    result.__dict__.update(node.__dict__)
+    return result
+
+def isLiteral(expr):
+    return not isinstance(expr, (Variable, DotRef, ARef, Operator, Funcall))
+
+def literalKind(value):
+    if value is None:
+        return 'null'
+    elif isinstance(value, bool):
+        return 'boolean'
+    elif isinstance(value, (int, long, float)):
+        return 'number'
+    elif isText(value):
+        return 'string'
+    else:
+        return None
+
+def isNumber(value):
+    return literalKind(value) == 'number'
+
+def isInteger(value):
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+def isSafe(value):
+    if isinstance(value, float):
+        return not (math.isinf(value) or math.isnan(value))
+    elif isInteger(value):
+        return abs(value) <= MAX_SAFE_INTEGER
+    else:
+        return literalKind(value) is not None
+
+####################################################################################################
+# expressions
+####################################################################################################
+
+def foldAdd(a, b):
+    if isNumber(a) and isNumber(b):
+        return a + b
+    elif (isText(a) or isInteger(a)) and (isText(b) or isInteger(b)):
+        # like genericAdd, but not for floats or booleans, which print differently in JavaScript
+        return unicode(a) + unicode(b)
+    else:
+        raise TypeError('Not folded')
+
+def foldArithmetic(op):
+    def fold(a, b):
+        if isNumber(a) and isNumber(b):
+            return op(a, b)
+        raise TypeError('Not folded')
+
+    return fold
+
+def foldMod(a, b):
+    # the sign of the result differs for negative operands
+    if isNumber(a) and isNumber(b) and a >= 0 and b > 0:
+        return a % b
+    raise TypeError('Not folded')
+
+def foldComparison(op, sameKind=False):
+    def fold(a, b):
+        kinds = (literalKind(a), literalKind(b))
+        if kinds[0] == kinds[1] and (sameKind or kinds[0] in ('number', 'string')):
+            return op(a, b)
+        raise TypeError('Not folded')
+
+    return fold
+
+BINARY_FOLDS = { '+': foldAdd,
+                 '-': foldArithmetic(operator.sub),
+                 '*': foldArithmetic(operator.mul),
+                 '/': foldArithmetic(operator.truediv),
+                 '%': foldMod,
+                 '<': foldComparison(operator.lt),
+                 '>': foldComparison(operator.gt),
+                 '<=': foldComparison(operator.le),
+                 '>=': foldComparison(operator.ge),
+                 '==': foldComparison(operator.eq, True),
+                 '!=': foldComparison(operator.ne, True) }
+
+def foldRound(*args):
+    # Math.round rounds halves up, Python away from zero; ndigits rounds differently too
+    if len(args) == 1 and isNumber(args[0]) and abs(args[0] - math.floor(args[0])) != 0.5:
+        return int(round(args[0]))
+    raise TypeError('Not folded')
+
+def foldNumbers(fun, minArgs, maxArgs):
+    def fold(*args):
+        if minArgs <= len(args) <= maxArgs and all(isNumber(arg) for arg in args):
+            return fun(*args)
+        raise TypeError('Not folded')
+
+    return fold
+
+def foldLength(*args):
+    if len(args) == 1 and isText(args[0]):
+        # the length of a unicode string, as JavaScript counts it in the BMP
+        return len(unicode(args[0]))
+    raise TypeError('Not folded')
+
+FUNCTION_FOLDS = { 'length': foldLength,
+                   'round': foldRound,
+                   'floor': foldNumbers(math.floor, 1, 1),
+                   'ceiling': foldNumbers(math.ceil, 1, 1),
+                   'min': foldNumbers(min, 2, 100),
+                   'max': foldNumbers(max, 2, 100) }
+
+def foldValue(fold, args, expr):
+    try:
+        value = fold(*args)
+    except (TypeError, ValueError, ArithmeticError, UnicodeError):
+        return expr
+
+    return value if isSafe(value) else expr
+
+def foldOperator(expr):
+    args = [foldExpression(arg) for arg in expr.args]
+    name = expr.op
+    expr = copyNode(expr, [name] + args)
+
+    if not isLiteral(args[0]):
+        return expr
+
+    if len(args) == 1:
+        if name == 'not':
+            return not args[0]
+        elif name == 'neg':
+            return foldValue(foldNumbers(operator.neg, 1, 1), args, expr)
+    elif len(args) == 2:
+        if name == 'and':
+            return args[1] if args[0] else args[0]
+        elif name == 'or':
+            return args[0] if args[0] else args[1]
+        elif name in BINARY_FOLDS and isLiteral(args[1]):
+            return foldValue(BINARY_FOLDS[name], args, expr)
+    elif len(args) == 3 and name == 'if':
+        return args[1] if args[0] else args[2]
+
+    return expr
+
+def foldFuncall(expr):
+    args = [foldExpression(arg) for arg in expr.args]
+    expr = copyNode(expr, [expr.name] + args)
+
+    fold = FUNCTION_FOLDS.get(expr.name)
+    if fold and all(isLiteral(arg) for arg in args):
+        return foldValue(fold, args, expr)
+
+    return expr
+
+def foldExpression(expr):
+    """expr with its constant subtrees replaced by their values"""
+
+    if isinstance(expr, Operator):
+        return foldOperator(expr)
+    elif isinstance(expr, Funcall):
+        return foldFuncall(expr)
+    elif isinstance(expr, (DotRef, ARef)):
+        return copyNode(expr, [foldExpression(item) for item in expr])
+    else:
+        return expr
+
+####################################################################################################
+# static text
+####################################################################################################
+
+def escapeHtml(text):
+    # as python_backend.escapeHtml and $escapeHTML$ escape a string
+    return (text.replace('&', '&amp;')
+            .replace('<', '&lt;')
+            .replace('>', '&gt;')
+            .replace('"', '&quot;')
+            .replace("'", '&#039;'))
+
+def printedText(print_, autoescape):
+    value = print_.expr
+    directives = print_.directives
+
+    if directives.get('id') or directives.get('escapeUri'):
+        return None
+    elif value is None:
+        return ''
+    elif isInteger(value) and isSafe(value):
+        return str(value)
+    elif not isText(value):
+        # floats and booleans print differently in JavaScript
+        return None
+    elif directives.get('escapeHtml') or (autoescape and directives.get('noAutoescape') != True):
+        return escapeHtml(value)
+    else:
+        return value
+
+def staticText(cmd, autoescape):
+    """The text cmd renders whatever the data, or None"""
+
+    if isText(cmd):
+        return cmd
+    elif isinstance(cmd, Substition):
+        return cmd.char
+    elif isinstance(cmd, LiteralTag):
+        return cmd.text
+    elif isinstance(cmd, Print):
+        return printedText(cmd, autoescape)
+    else:
+        return None
+
+def blockText(block):
+    """The text of an optimized block without dynamic content, or None"""
+
+    if not block:
+        return ''
+    elif len(block) == 1 and isText(block[0]):
+        return block[0]
+    else:
+        return None
+
+def joinTexts(texts):
+    try:
+        text = ''.join(texts)
+    except UnicodeError:
+        # byte strings that are not ASCII, which the backends write as they are
+        return [text for text in texts if text]
+
+    return [text] if text else []
+
+def coalesceBlock(cmds, autoescape):
+    # every maximal run of static commands becomes one string
+    result = []
+    run = []
+    for cmd in cmds:
+        text = staticText(cmd, autoescape)
+        if text is None:
+            result.extend(joinTexts(run))
+            run = []
+            result.append(cmd)
+        else:
+            run.append(text)
+
+    result.extend(joinTexts(run))
+    return result
+
+####################################################################################################
+# inlining
+####################################################################################################
+
+# templates up to this many nodes are inlined at their static {call}s,
+# private ones up to PRIVATE_INLINE_SIZE. inline="true" inlines a template
+# of any size, inline="false" never.
+INLINE_SIZE = 40
+PRIVATE_INLINE_SIZE = 160
+
+LOOP_FUNCTIONS = frozenset(['index', 'isFirst', 'isLast'])
+
+class Inliner(object):
+    """The templates of a namespace, optimized once each on demand"""
+
+    def __init__(self, templates):
+        self.templates = dict((tmpl.name, tmpl) for tmpl in templates)
+        self.optimized = dict()
+        self.active = set()
+
+    def optimize(self, tmpl):
+        """tmpl optimized, or None if it is being optimized: it calls itself"""
+
+        key = id(tmpl)
+        if key in self.optimized:
+            return self.optimized[key]
+        elif key in self.active:
+            return None
+
+        self.active.add(key)
+        try:
+            autoescape = not(tmpl.props.get('autoescape') == False)
+            scope = Scope(autoescape, self, inlined=(tmpl.name,))
+            result = copyNode(tmpl, [tmpl.name, tmpl.props, optimizeBlock(tmpl.code, scope)])
+        finally:
+            self.active.remove(key)
+
+        self.optimized[key] = result
+        return result
+
+class CodeInfo(object):
+    def __init__(self):
+        self.free = set()
+        self.bound = set()
+        self.usesEnv = False
+
+def collectInfo(node, bound, info):
+    # the data variables, the foreach and for variables and whether the
+    # code passes or tests its whole data
+    if isinstance(node, Variable):
+        if node.name not in bound:
+            info.free.add(node.name)
+    elif isinstance(node, Foreach):
+        info.bound.add(node.var.name)
+        collectInfo(node.expr, bound, info)
+        collectInfo(node.code, bound | set([node.var.name]), info)
+        collectInfo(node.ifEmptyCode, bound, info)
+    elif isinstance(node, For):
+        info.bound.add(node.var.name)
+        collectInfo(node.range, bound, info)
+        collectInfo(node.code, bound | set([node.var.name]), info)
+    elif isinstance(node, Funcall) and node.name == 'hasData':
+        info.usesEnv = True
+    elif isinstance(node, Call) and node.data == True:
+        info.usesEnv = True
+        collectInfo(list(node), bound, info)
+    elif isinstance(node, (list, tuple)):
+        for item in node:
+            collectInfo(item, bound, info)
+
+def codeInfo(node):
+    info = CodeInfo()
+    collectInfo(node, frozenset(), info)
+    return info
+
+def treeSize(node):
+    if isinstance(node, (list, tuple)):
+        return 1 + sum(treeSize(item) for item in node)
+    else:
+        return 1
+
+def isSimple(expr):
+    """True for the expressions that are cheap and safe to evaluate at every use"""
+
+    if isinstance(expr, Variable):
+        return True
+    elif isinstance(expr, DotRef):
+        return isText(expr.name) and isSimple(expr.expr)
+    elif isinstance(expr, ARef):
+        return isLiteral(expr.position) and isSimple(expr.expr)
+    else:
+        return isLiteral(expr)
+
+def substitute(node, params, data, bound):
+    """The callee code node as the caller sees it: the params replaced by
+    their values and the data variables looked up in data"""
+
+    if isinstance(node, Variable):
+        if node.name in bound:
+            return node
+        elif node.name in params:
+            return params[node.name]
+        elif data == True:
+            return node
+        elif data is None:
+            return None
+        else:
+            return DotRef([node.name, data])
+    elif isinstance(node, Foreach):
+        inner = bound | set([node.var.name])
+        return copyNode(node, [node.var, substitute(node.expr, params, data, bound),
+                               substitute(node.code, params, data, inner),
+                               substitute(node.ifEmptyCode, params, data, bound)])
+    elif isinstance(node, For):
+        inner = bound | set([node.var.name])
+        return copyNode(node, [node.var] + [substitute(item, params, data, bound) for item in node.range]
+                        + [substitute(node.code, params, data, inner)])
+    elif isinstance(node, Funcall) and node.name in LOOP_FUNCTIONS:
+        return node
+    elif isinstance(node, tuple):
+        return tuple(substitute(item, params, data, bound) for item in node)
+    elif isinstance(node, List):
+        return copyNode(node, [substitute(item, params, data, bound) for item in node])
+    elif isinstance(node, list):
+        return [substitute(item, params, data, bound) for item in node]
+    else:
+        return node
+
+def callParams(call_):
+    """name -> value of the params of call_, or None if one is not a value
+    that can be substituted at every use"""
+
+    params = dict()
+    for name, value in call_.params:
+        if isinstance(value, CodeBlock):
+            # the rendered text of the block
+            value = blockText(value)
+            if value is None:
+                return None
+        elif call_.data is not None and (value is None or not isLiteral(value)):
+            # Python looks a param that is null up in data, JavaScript does not
+            return None
+        elif not isSimple(value):
+            return None
+        params[name] = value
+
+    return params
+
+def inlineCall(call_, scope):
+    """The code of the callee of call_ to splice in its place, or None"""
+
+    inliner = scope.inliner
+    if not (inliner and isText(call_.name)) or call_.name in scope.inlined:
+        return None
+
+    tmpl = inliner.templates.get(call_.name)
+    if tmpl is None or tmpl.props.get('inline') == False or tmpl.props.get('cache'):
+        return None
+
+    callee = inliner.optimize(tmpl)
+    if callee is None or (callee.props.get('autoescape') != False) != scope.autoescape:
+        return None
+
+    limit = PRIVATE_INLINE_SIZE if tmpl.props.get('private') else INLINE_SIZE
+    if tmpl.props.get('inline') != True and treeSize(callee.code) > limit:
+        return None
+
+    params = callParams(call_)
+    if params is None or not (call_.data in (True, None) or isSimple(call_.data)):
+        return None
+
+    info = codeInfo(callee.code)
+    if info.usesEnv and not (call_.data == True and not params):
+        return None
+
+    # the data variables of the callee must not resolve to the locals of the caller
+    if call_.data == True and (info.free - set(params)) & scope.localNames:
+        return None
+
+    # nor the variables of the values to the locals of the callee
+    if codeInfo([params.values(), call_.data]).free & info.bound:
+        return None
+
+    # nor the loop variables of the callee shadow those of the caller: a
+    # JavaScript var is function scoped, the inner loop would reset the outer
+    if info.bound & scope.localNames:
+        return None
+
+    code = substitute(callee.code, params, call_.data, frozenset())
+    return optimizeBlock(code, scope.inline(call_.name))
+
+####################################################################################################
+# call graph
+####################################################################################################
+
+def collectCalls(node, calls):
+    """Adds the names of the static {call}s in node to calls, True if node
+    also has a {call} with a computed name"""
+
+    dynamic = False
+    if isinstance(node, Call):
+        if isText(node.name):
+            calls.add(node.name)
+        else:
+            dynamic = True
+
+    if isinstance(node, (list, tuple)):
+        for item in node:
+            dynamic = collectCalls(item, calls) or dynamic
+
+    return dynamic
+
+class CallGraph(object):
+    """The static {call}s between the templates of a namespace"""
+
+    def __init__(self, templates):
+        self.calls = dict()
+        self.dynamic = set()
+        for tmpl in templates:
+            calls = set()
+            if collectCalls(tmpl.code, calls):
+                self.dynamic.add(tmpl.name)
+            self.calls[tmpl.name] = calls
+
+    def reachable(self, entryPoints):
+        """Names of the templates called from entryPoints, directly or not,
+        and the entry points themselves"""
+
+        result = set()
+        stack = list(entryPoints)
+        while stack:
+            name = stack.pop()
+            if name not in result and name in self.calls:
+                result.add(name)
+                stack.extend(self.calls[name])
+
+        return result
+
+####################################################################################################
+# commands
+####################################################################################################
+
+class Scope(object):
+    """What the optimization of a block depends on"""
+
+    def __init__(self, autoescape, inliner=None, localNames=frozenset(), inlined=()):
+        self.autoescape = autoescape
+        self.inliner = inliner
+        # the foreach and for variables of the enclosing blocks
+        self.localNames = localNames
+        # the templates whose code the block is part of
+        self.inlined = inlined
+
+    def bind(self, name):
+        return Scope(self.autoescape, self.inliner, self.localNames | set([name]), self.inlined)
+
+    def inline(self, name):
+        return Scope(self.autoescape, self.inliner, self.localNames, self.inlined + (name,))
+
+def optimizeItem(item, scope):
+    if isinstance(item, CodeBlock):
+        return optimizeBlock(item, scope)
+    elif isinstance(item, tuple):
+        return tuple(optimizeItem(x, scope) for x in item)
+    elif isinstance(item, dict):
+        return item
+    else:
+        return foldExpression(item)
+
+def optimizeIf(if_, scope):
+    options = []
+    for cond, block in if_:
+        cond = foldExpression(cond)
+        if not isLiteral(cond):
+            options.append((cond, optimizeBlock(block, scope)))
+        elif cond:
+            # the following options are never tested
+            if not options:
+                return optimizeBlock(block, scope)
+            options.append((True, optimizeBlock(block, scope)))
+            break
+
+    return copyNode(if_, options) if options else None
+
+def caseMatches(value, values):
+    """True, False or None if Python and JavaScript may disagree"""
+
+    kind = literalKind(value)
+    for item in values:
+        if item == value:
+            # 1 == True, but 1 !== true
+            return True if literalKind(item) == kind else None
+
+    return False
+
+def optimizeSwitch(switch_, scope):
+    expr = foldExpression(switch_.expr)
+    cases = [optimizeItem(case, scope) for case in switch_.cases]
+
+    if isLiteral(expr) and literalKind(expr):
+        for case in cases:
+            if not isinstance(case, tuple):
+                return case
+
+            match = caseMatches(expr, case[0])
+            if match:
+                return case[1]
+            elif match is None:
+                break
+        else:
+            return None
+
+    return copyNode(switch_, [expr] + cases)
+
+def optimizeForeach(foreach_, scope):
+    ifEmptyCode = foreach_.ifEmptyCode
+    return copyNode(foreach_, [foreach_.var, foldExpression(foreach_.expr),
+                               optimizeBlock(foreach_.code, scope.bind(foreach_.var.name)),
+                               optimizeBlock(ifEmptyCode, scope) if ifEmptyCode else ifEmptyCode])
+
+def optimizeFor(for_, scope):
+    return copyNode(for_, [for_.var] + [foldExpression(item) for item in for_.range]
+                    + [optimizeBlock(for_.code, scope.bind(for_.var.name))])
+
+def optimizeCache(cache_, scope):
+    cache_ = copyNode(cache_, [optimizeItem(item, scope) for item in cache_])
+
+    # nothing to save by caching a constant
+    if blockText(cache_.code) is not None:
+        return cache_.code
+
+    return cache_
+
+def optimizeCall(call_, scope):
+    call_ = copyNode(call_, [optimizeItem(item, scope) for item in call_])
+    code = inlineCall(call_, scope)
+    return call_ if code is None else code
+
+def optimizeCommand(cmd, scope):
+    if isinstance(cmd, CodeBlock):
+        return optimizeBlock(cmd, scope)
+    elif isinstance(cmd, If):
+        return optimizeIf(cmd, scope)
+    elif isinstance(cmd, Switch):
+        return optimizeSwitch(cmd, scope)
+    elif isinstance(cmd, Foreach):
+        return optimizeForeach(cmd, scope)
+    elif isinstance(cmd, For):
+        return optimizeFor(cmd, scope)
+    elif isinstance(cmd, Cache):
+        return optimizeCache(cmd, scope)
+    elif isinstance(cmd, Call):
+        return optimizeCall(cmd, scope)
+    elif isinstance(cmd, Print):
+        return copyNode(cmd, [optimizeItem(item, scope) for item in cmd])
+    else:
+        return cmd
+
+def optimizeBlock(block, scope):
+    """block with constant expressions folded, the dead branches pruned, the
+    static text coalesced and the small callees inlined"""
+
+    cmds = []
+    for cmd in block:
+        cmd = optimizeCommand(cmd, scope)
+        if isinstance(cmd, CodeBlock):
+            # the body of a pruned {if} or {switch}, or of an inlined call
+            cmds.extend(cmd)
+        elif cmd is not None:
+            cmds.append(cmd)
+
+    return copyNode(block, coalesceBlock(cmds, scope.autoescape))
+
+def optimizeTemplate(tmpl):
+    """tmpl optimized on its own, without inlining"""
+
+    autoescape = not(tmpl.props.get('autoescape') == False)
+    return copyNode(tmpl, [tmpl.name, tmpl.props, optimizeBlock(tmpl.code, Scope(autoescape))])
+
+def optimizeNamespace(namespace, inlineCalls=True):
+    if not inlineCalls:
+        return copyNode(namespace, [namespace.name] + [optimizeTemplate(tmpl) for tmpl in namespace.templates])
+
+    inliner = Inliner(namespace.templates)
+    return copyNode(namespace, [namespace.name] + [inliner.optimize(tmpl) for tmpl in namespace.templates])
@@ -14,6 +14,10 @@
 # implied.  See the License for the specific language governing
 # permissions and limitations under the License.
 
-from expression import parseExpression, Variable, DotRef, ARef, Operator, Funcall
-from commands import Namespace, Template, Substition, CodeBlock, Print, LiteralTag, If, Switch, Foreach, For, Call, parseSingleTemplate, parseNamespace, parseFile, isText
+from expression import leplParseExpression, Variable, DotRef, ARef, Operator, Funcall
+from commands import parseExpression, Namespace, Template, Substition, CodeBlock, Print, LiteralTag, If, Switch, Foreach, For, Call, Flush, Cache, parseSingleTemplate, parseNamespace, parseFile, isText
+from commands import leplParseSingleTemplate, leplParseNamespace, setDefaultParser, setDefaultCache
+from descent import ParseError
+from cache import ASTCache
+from batch import parseFiles, parseDirectory, ParseErrors
 
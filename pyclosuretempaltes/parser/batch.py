@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# Parsing many files at once. Sources are read (and looked up in the AST
+# cache) in the calling process; only the texts that really need parsing
+# are sent to a pool of worker processes.
+
+import os
+import os.path
+import codecs
+import multiprocessing
+
+import commands
+
+class ParseErrors(Exception):
+    def __init__(self, errors, namespaces):
+        self.errors = errors
+        self.namespaces = namespaces
+        Exception.__init__(self, '%d file(s) failed to parse:\n%s'
+                           % (len(errors), '\n'.join(['  %s: %s' % error for error in errors])))
+
+def parseTextTask(task):
+    path, text, parser = task
+    try:
+        return (commands.parseNamespace(text, parser), None)
+    except Exception as e:
+        return (None, '%s: %s' % (e.__class__.__name__, e))
+
+def parseFiles(paths, workers=None, parser=None, cache=None):
+    parser = parser or commands.defaultParser
+    cache = cache or commands.defaultCache
+
+    namespaces = [None] * len(paths)
+    errors = []
+    tasks = []
+
+    for i, path in enumerate(paths):
+        try:
+            with codecs.open(path, encoding='utf-8') as f:
+                text = f.read()
+        except (IOError, UnicodeDecodeError) as e:
+            errors.append((i, path, '%s: %s' % (e.__class__.__name__, e)))
+            continue
+
+        if cache:
+            namespaces[i] = cache.get(text, parser)
+
+        if namespaces[i] is None:
+            tasks.append((i, (path, text, parser)))
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(tasks))
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(parseTextTask, [task for i, task in tasks])
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        results = [parseTextTask(task) for i, task in tasks]
+
+    for (i, task), (namespace, error) in zip(tasks, results):
+        if error:
+            errors.append((i, task[0], error))
+        else:
+            namespaces[i] = namespace
+            if cache:
+                cache.put(task[1], parser, namespace)
+
+    for path, namespace in zip(paths, namespaces):
+        if namespace is not None:
+            namespace.path = path
+
+    if errors:
+        errors.sort()
+        raise ParseErrors([(path, error) for i, path, error in errors], namespaces)
+
+    return namespaces
+
+def findFiles(root, extension='.soy'):
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith(extension):
+                paths.append(os.path.join(dirpath, filename))
+
+    paths.sort()
+    return paths
+
+def parseDirectory(root, workers=None, parser=None, cache=None):
+    return parseFiles(findFiles(root), workers=workers, parser=parser, cache=cache)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# Persistent cache of parsed namespaces. Every entry is a pickled tree
+# stored under the hash of the source text, the parser name and
+# PARSER_VERSION, so editing a file or changing the grammar simply misses.
+# Entries are written atomically (temporary file + rename) and the least
+# recently used ones are evicted when the directory grows over maxSize.
+
+import os
+import os.path
+import hashlib
+import tempfile
+import cPickle
+
+PARSER_VERSION = 6
+
+SUFFIX = '.ast'
+
+class ASTCache(object):
+    def __init__(self, directory, maxSize=64 * 1024 * 1024):
+        self.directory = directory
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, text, parser):
+        digest = hashlib.sha1()
+        digest.update('%s:%s:' % (PARSER_VERSION, parser))
+        digest.update(text.encode('utf-8'))
+        return digest.hexdigest()
+
+    def entryPath(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def entries(self):
+        result = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                result.append((st.st_mtime, st.st_size, path))
+        return result
+
+    def get(self, text, parser):
+        path = self.entryPath(self.key(text, parser))
+
+        try:
+            with open(path, 'rb') as f:
+                tree = cPickle.load(f)
+        except IOError:
+            self.misses += 1
+            return None
+        except Exception:
+            # truncated or written by an incompatible version
+            self.remove(path)
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return tree
+
+    def put(self, text, parser, tree):
+        path = self.entryPath(self.key(text, parser))
+        data = cPickle.dumps(tree, cPickle.HIGHEST_PROTOCOL)
+
+        if len(data) > self.maxSize:
+            return
+
+        fd, tmpPath = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmpPath, path)
+        except:
+            self.remove(tmpPath)
+            raise
+
+        if self.size is None:
+            self.size = sum(size for mtime, size, entry in self.entries())
+        else:
+            self.size += len(data)
+
+        if self.size > self.maxSize:
+            self.evict()
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        entries = self.entries()
+        entries.sort()
+
+        self.size = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if self.size <= self.maxSize:
+                break
+            self.remove(path)
+            self.size -= size
+            self.evictions += 1
+
+    def clear(self):
+        for mtime, size, path in self.entries():
+            self.remove(path)
+        self.size = 0
+
+    def stats(self):
+        return { 'hits': self.hits,
+                 'misses': self.misses,
+                 'evictions': self.evictions }
@@ -16,7 +16,7 @@
 
 import re
 from lepl import *
-from expression import namedFields, simpleName, expressionLiteral, expression, variable, boolean, iW, oW
+from expression import namedFields, simpleName, expressionLiteral, expression, variable, boolean, iW, oW, leplParseExpression
 import codecs
 
 def isText(text):
@@ -57,6 +57,15 @@ substition = Or(Substitute('{sp}', Substition([' '])),
                 Substitute('{lb}', Substition(['{'])),
                 Substitute('{rb}', Substition(['}'])))
 
+# flush
+
+class Flush(List):
+    # has no arguments, but must survive filter(None, ...)
+    def __nonzero__(self):
+        return True
+
+flush = Drop('{flush}') > Flush
+
 # literal
 
 @namedFields(text=0)
@@ -78,9 +87,7 @@ def printHandler(args):
         else:
             directives[item] = True
 
-    args[1:] = [directives]
-
-    return Print(args)
+    return Print([args[0], directives])
 
 printDirective = Drop("|") & oW & Or(simpleName, simpleName & Drop(':') & expressionLiteral > tuple)
 printTag = Drop(Or("{print ", "{")) &oW & expression & (printDirective | iW)[0:] & Drop("}") > printHandler
@@ -166,11 +173,11 @@ class Call(List): pass
 
 def callHandler(args):
     if len(args) == 1:
-        args.append(None)
+        return Call([args[0], None])
     elif isinstance(args[1], tuple):
-        args.insert(1, None)
-        
-    return Call(args)
+        return Call([args[0], None] + args[1:])
+    else:
+        return Call(args)
 
 _param = (Drop('{param') & iW & simpleName &
           Or(oW  & Drop(':') & oW  & expression & oW & Drop('/}'),
@@ -186,6 +193,26 @@ _call = (Drop('{call')
          & Or(Drop('/}'),
               Drop('}') & (_param | iW)[0:] & Drop('{/call}'))) > callHandler
 
+# cache
+
+@namedFields(key=0, ttl=1, code=2)
+class Cache(List): pass
+
+def cacheHandler(args):
+    if len(args) == 2:
+        return Cache([args[0], None, args[1]])
+    else:
+        return Cache(args)
+
+_cache = (Drop('{cache')
+          & iW
+          & Drop('key="') & expression & Drop('"')
+          & Optional(iW & Drop('ttl="') & expression & Drop('"'))
+          & oW
+          & Drop('}')
+          & codeBlock
+          & Drop('{/cache}')) > cacheHandler
+
 # codeBlock
 
 class CodeBlock(List): pass
@@ -215,6 +242,8 @@ codeBlock += Or(comment,
                 _foreach,
                 _switch,
                 _for,
+                _cache,
+                flush,
                 substition,
                 #with,                
                 printTag,
@@ -231,19 +260,19 @@ def templateHandler(args):
     for (key, value) in args[1:-1]:
         props[key] = value
 
-    args[1:-1] = [props]
-
-    return Template(args)
+    return Template([args[0], props, args[-1]])
 
 templateStart = (Drop('{template') & iW & simpleName
                  & Optional(iW & Drop('') & 'autoescape' & Drop('=') & Drop('"') & boolean & Drop('"') > tuple)
                  & Optional(iW & Drop('') & 'private' & Drop('="') & boolean & Drop('"') > tuple)
+                 & Optional(iW & Drop('') & 'cache' & Drop('="') & boolean & Drop('"') > tuple)
+                 & Optional(iW & Drop('') & 'inline' & Drop('="') & boolean & Drop('"') > tuple)
                  & oW
                  & Drop('}'))
 templateEnd = Drop('{/template}')
 template = templateStart & codeBlock & templateEnd > templateHandler
 
-def parseSingleTemplate(text):
+def leplParseSingleTemplate(text):
     return template.parse(text)[0]
 
 # namespace
@@ -258,9 +287,59 @@ namespace = (Drop((comment | iW)[0:])
 matcher = namespace
 matcher.config.clear()
 
-def parseNamespace(text):
+def leplParseNamespace(text):
     return matcher.parse(text)[0]
 
-def parseFile(path):
+# parser selection
+
+import descent
+
+defaultParser = 'descent'
+defaultCache = None
+
+def setDefaultParser(name):
+    global defaultParser
+    findParser(name)
+    defaultParser = name
+
+def setDefaultCache(cache):
+    global defaultCache
+    defaultCache = cache
+
+def findParser(name=None):
+    name = name or defaultParser
+
+    if name == 'descent':
+        return (descent.parseExpression, descent.parseSingleTemplate, descent.parseNamespace)
+    elif name == 'lepl':
+        return (leplParseExpression, leplParseSingleTemplate, leplParseNamespace)
+    else:
+        raise Exception('Unknown parser: %s' % name)
+
+def parseExpression(text, parser=None):
+    return findParser(parser)[0](text)
+
+def parseSingleTemplate(text, parser=None):
+    return findParser(parser)[1](text)
+
+def parseNamespace(text, parser=None):
+    return findParser(parser)[2](text)
+
+def parseFile(path, parser=None, cache=None):
     with codecs.open(path, encoding='utf-8') as f:
-        return parseNamespace(f.read())
+        text = f.read()
+
+    cache = cache or defaultCache
+    if not cache:
+        namespace = parseNamespace(text, parser)
+    else:
+        parser = parser or defaultParser
+
+        namespace = cache.get(text, parser)
+        if namespace is None:
+            namespace = parseNamespace(text, parser)
+            cache.put(text, parser, namespace)
+
+    # the source of the positions of the commands
+    namespace.path = path
+    return namespace
@@ -0,0 +1,784 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# Hand-written tokenizer and recursive-descent parser. It builds exactly
+# the same trees as the lepl grammar in commands.py/expression.py, which
+# is kept as the reference implementation.
+
+import re
+from bisect import bisect_right
+
+from expression import Variable, DotRef, ARef, Operator, Funcall, BINARY_PRECEDENCE
+from commands import (Namespace, Template, CodeBlock, SimpleComment, MultilineComment, Substition,
+                      LiteralTag, Print, If, Switch, Foreach, For, Call, Flush, Cache,
+                      codeBlockHandler, simpleTextHandler, isText)
+
+####################################################################################################
+# errors
+####################################################################################################
+
+class ParseError(Exception):
+    def __init__(self, message, text, pos):
+        self.line = text.count('\n', 0, pos) + 1
+        self.column = pos - text.rfind('\n', 0, pos)
+        Exception.__init__(self, '%s at line %d, column %d' % (message, self.line, self.column))
+
+class NoMatch(Exception): pass
+
+####################################################################################################
+# tokens
+####################################################################################################
+
+spacesRe = re.compile('[ \t\n\r]*')
+textChunkRe = re.compile('[^{} \t\n\r]+')
+whitespaceRe = re.compile('[ \t\n\r]+')
+
+nameRe = re.compile('[A-Za-z][A-Za-z0-9_]*')
+variableRe = re.compile('\\$([A-Za-z][A-Za-z0-9_]*)')
+floatRe = re.compile('[0-9]+\\.[0-9]*(?:[Ee][+-]?[0-9]*)?')
+integerRe = re.compile('0x([0-9A-Fa-f]+)|([0-9]+)')
+stringRe = re.compile("'((?:\\\\[\\\\'\"nrtbf]|[^'])*)'")
+escapeRe = re.compile('\\\\([\\\\\'"nrtbf])')
+keywordRe = re.compile('(null|true|false)(?![A-Za-z0-9_])')
+prefixRe = re.compile('-|not')
+operatorRe = re.compile('-|not|\\*|/|%|\\+|<=|>=|<|>|==|!=|and|or|\\?|:')
+dotNameRe = re.compile('\\.([A-Za-z][A-Za-z0-9_]*)|\\[([A-Za-z][A-Za-z0-9_]*)\\]')
+dotIndexRe = re.compile('\\.(?:0x([0-9A-Fa-f]+)|([0-9]+))')
+
+commandRe = re.compile('\\{(call|if|foreach|switch|for|cache)[ \t\n\r]')
+substitionRe = re.compile('\\{(sp|nil|\\\\r|\\\\n|\\\\t|lb|rb)\\}')
+templateRe = re.compile('\\{template[ \t\n\r]+([A-Za-z][A-Za-z0-9_]*)'
+                        '(?:[ \t\n\r]+autoescape="(true|false)")?'
+                        '(?:[ \t\n\r]+private="(true|false)")?'
+                        '(?:[ \t\n\r]+cache="(true|false)")?'
+                        '(?:[ \t\n\r]+inline="(true|false)")?'
+                        '[ \t\n\r]*\\}')
+namespaceRe = re.compile('\\{namespace[ \t\n\r]+([A-Za-z][A-Za-z0-9_]*(?:\\.[A-Za-z][A-Za-z0-9_]*)*)[ \t\n\r]*\\}')
+
+ESCAPES = { '\\': '\\', "'": "'", '"': '"', 'n': '\n', 'r': '\r', 't': '\t', 'b': '\b', 'f': '\f' }
+
+SUBSTITIONS = { 'sp': ' ', 'nil': '', '\\r': '\r', '\\n': '\n', '\\t': '\t', 'lb': '{', 'rb': '}' }
+
+KEYWORDS = { 'null': None, 'true': True, 'false': False }
+
+PREFIX_OPERATORS = { '-': 'neg', 'not': 'not' }
+
+def unescape(match):
+    return ESCAPES[match.group(1)]
+
+####################################################################################################
+# parser
+####################################################################################################
+
+class Parser(object):
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+        self.lineStarts = [0] + [m.end() for m in re.finditer('\n', text)]
+
+    def locate(self, node, pos):
+        # line and column of the command, for the profiler
+        line = bisect_right(self.lineStarts, pos)
+        node.line = line
+        node.column = pos - self.lineStarts[line - 1] + 1
+        return node
+
+    def error(self, message):
+        raise ParseError(message, self.text, self.pos)
+
+    def startswith(self, prefix):
+        return self.text.startswith(prefix, self.pos)
+
+    def expect(self, prefix):
+        if not self.text.startswith(prefix, self.pos):
+            self.error('Expected "%s"' % prefix)
+        self.pos += len(prefix)
+
+    def skipSpaces(self):
+        self.pos = spacesRe.match(self.text, self.pos).end()
+
+    def skipRequiredSpaces(self):
+        m = whitespaceRe.match(self.text, self.pos)
+        if not m:
+            self.error('Expected whitespace')
+        self.pos = m.end()
+
+    def name(self):
+        m = nameRe.match(self.text, self.pos)
+        if not m:
+            self.error('Expected name')
+        self.pos = m.end()
+        return m.group()
+
+    # comments
+
+    def commentEnd(self, pos):
+        text = self.text
+        if text.startswith('//', pos):
+            end = text.find('\n', pos + 2)
+            return len(text) if end < 0 else end
+        elif text.startswith('/*', pos):
+            end = text.find('*/', pos + 2)
+            return None if end < 0 else end + 2
+        else:
+            return None
+
+    def parseComment(self):
+        pos = self.pos
+        end = self.commentEnd(pos)
+        if end is None:
+            return None
+
+        self.pos = end
+        if self.text.startswith('//', pos):
+            body = self.text[pos + 2:end]
+            return SimpleComment([body] if body else [])
+        else:
+            body = self.text[pos + 2:end - 2]
+            return MultilineComment([body] if body else [])
+
+    def skipSpacesAndComments(self):
+        while True:
+            self.skipSpaces()
+            end = self.commentEnd(self.pos)
+            if end is None:
+                return
+            self.pos = end
+
+    # expression
+
+    def literal(self):
+        text = self.text
+        pos = self.pos
+
+        m = floatRe.match(text, pos)
+        if m:
+            self.pos = m.end()
+            return float(m.group())
+
+        m = integerRe.match(text, pos)
+        if m:
+            self.pos = m.end()
+            if m.group(1):
+                return int(m.group(1), 16)
+            else:
+                return int(m.group(2))
+
+        m = keywordRe.match(text, pos)
+        if m:
+            self.pos = m.end()
+            return KEYWORDS[m.group()]
+
+        m = stringRe.match(text, pos)
+        if m:
+            self.pos = m.end()
+            return escapeRe.sub(unescape, m.group(1))
+
+        raise NoMatch()
+
+    def primary(self):
+        text = self.text
+        pos = self.pos
+
+        if pos >= len(text):
+            raise NoMatch()
+
+        ch = text[pos]
+
+        if ch == '$':
+            m = variableRe.match(text, pos)
+            if not m:
+                raise NoMatch()
+            self.pos = m.end()
+            return Variable([m.group(1)])
+
+        if ch == '(':
+            self.pos = pos + 1
+            expr = self.expression()
+            if not self.startswith(')'):
+                raise NoMatch()
+            self.pos += 1
+            return expr
+
+        try:
+            return self.literal()
+        except NoMatch:
+            pass
+
+        m = nameRe.match(text, pos)
+        if not m:
+            raise NoMatch()
+
+        # funcall
+        self.pos = m.end()
+        self.skipSpaces()
+        if not self.startswith('('):
+            raise NoMatch()
+        self.pos += 1
+
+        funcall = Funcall([m.group()])
+        self.skipSpaces()
+        if not self.startswith(')'):
+            funcall.append(self.expression())
+            while self.startswith(','):
+                self.pos += 1
+                funcall.append(self.expression())
+        if not self.startswith(')'):
+            raise NoMatch()
+        self.pos += 1
+
+        return funcall
+
+    def expressionPart(self):
+        text = self.text
+        expr = self.primary()
+
+        while True:
+            pos = self.pos
+
+            m = dotNameRe.match(text, pos)
+            if m:
+                expr = DotRef([m.group(1) or m.group(2), expr])
+                self.pos = m.end()
+                continue
+
+            if text.startswith('[', pos):
+                self.pos = pos + 1
+                try:
+                    position = self.expression()
+                except NoMatch:
+                    self.pos = pos
+                    return expr
+                if self.startswith(']'):
+                    expr = ARef([position, expr])
+                    self.pos += 1
+                    continue
+                self.pos = pos
+                return expr
+
+            m = dotIndexRe.match(text, pos)
+            if m:
+                if m.group(1):
+                    expr = ARef([int(m.group(1), 16), expr])
+                else:
+                    expr = ARef([int(m.group(2)), expr])
+                self.pos = m.end()
+                continue
+
+            return expr
+
+    def prefixed(self):
+        # the optional '-' or 'not' applies to the first operand only
+        start = self.pos
+        m = prefixRe.match(self.text, start)
+        if m:
+            self.pos = m.end()
+            self.skipSpaces()
+            try:
+                return Operator([PREFIX_OPERATORS[m.group()], self.expressionPart()])
+            except NoMatch:
+                self.pos = start
+
+        return self.expressionPart()
+
+    def climb(self, lhs, minPrecedence):
+        text = self.text
+
+        while True:
+            pos = self.pos
+            m = operatorRe.match(text, spacesRe.match(text, pos).end())
+            if not m:
+                break
+
+            op = m.group()
+            if op == '?':
+                if minPrecedence > 0:
+                    break
+            else:
+                precedence = BINARY_PRECEDENCE.get(op)
+                if (precedence is None) or (precedence < minPrecedence):
+                    break
+
+            self.pos = m.end()
+            self.skipSpaces()
+            try:
+                rhs = self.expressionPart()
+            except NoMatch:
+                self.pos = pos
+                break
+
+            if op == '?':
+                then_ = self.climb(rhs, 0)
+
+                self.skipSpaces()
+                if not self.startswith(':'):
+                    self.error('Expected ":"')
+                self.pos += 1
+                self.skipSpaces()
+                try:
+                    else_ = self.climb(self.expressionPart(), 0)
+                except NoMatch:
+                    self.error('Expected expression')
+
+                lhs = Operator(['if', lhs, then_, else_])
+            else:
+                lhs = Operator([op, lhs, self.climb(rhs, precedence + 1)])
+
+        return lhs
+
+    def expression(self):
+        self.skipSpaces()
+        expr = self.climb(self.prefixed(), 0)
+        self.skipSpaces()
+        return expr
+
+    def requiredExpression(self):
+        pos = self.pos
+        try:
+            return self.expression()
+        except NoMatch:
+            self.pos = pos
+            self.error('Expected expression')
+
+    def requiredLiteral(self):
+        try:
+            return self.literal()
+        except NoMatch:
+            self.error('Expected literal')
+
+    # text
+
+    def parseText(self):
+        text = self.text
+        pos = self.pos
+        parts = []
+
+        while True:
+            m = textChunkRe.match(text, pos)
+            if m:
+                parts.append(m.group())
+                pos = m.end()
+
+            m = whitespaceRe.match(text, pos)
+            if not m:
+                break
+
+            end = self.commentEnd(m.end())
+            if end is None:
+                parts.append(m.group())
+                pos = m.end()
+            else:
+                pos = end
+
+        self.pos = pos
+        return simpleTextHandler([''.join(parts)])
+
+    # code block
+
+    def parseCodeBlock(self):
+        text = self.text
+        length = len(text)
+        items = []
+
+        while self.pos < length:
+            ch = text[self.pos]
+            if ch == '{':
+                command = self.parseCommand()
+                if command is None:
+                    break
+                items.append(command)
+            elif ch == '}':
+                break
+            else:
+                comment = self.parseComment()
+                if comment is not None:
+                    items.append(comment)
+                else:
+                    item = self.parseText()
+                    if item:
+                        items.append(item)
+
+        return codeBlockHandler(items)
+
+    def parseCommand(self):
+        pos = self.pos
+        command = self.parseCommandAt()
+        if command is not None and not isText(command):
+            self.locate(command, pos)
+        return command
+
+    def parseCommandAt(self):
+        text = self.text
+        pos = self.pos
+
+        if text.startswith('{/', pos):
+            return None
+
+        if text.startswith('{literal}', pos):
+            return self.parseLiteral()
+
+        if text.startswith('{flush}', pos):
+            self.pos = pos + len('{flush}')
+            return Flush([])
+
+        m = commandRe.match(text, pos)
+        if m:
+            self.pos = m.end()
+            self.skipSpaces()
+            return COMMANDS[m.group(1)](self)
+
+        m = substitionRe.match(text, pos)
+        if m:
+            self.pos = m.end()
+            return Substition([SUBSTITIONS[m.group(1)]])
+
+        if text.startswith('{print ', pos):
+            print_ = self.parsePrint(pos + 7)
+            if print_ is not None:
+                return print_
+
+        return self.parsePrint(pos + 1)
+
+    # literal
+
+    def parseLiteral(self):
+        start = self.pos + len('{literal}')
+        end = self.text.find('{/literal}', start)
+        if end < 0:
+            self.error('Unterminated {literal}')
+
+        self.pos = end + len('{/literal}')
+        body = self.text[start:end]
+        return LiteralTag([body] if body else [])
+
+    # print
+
+    def parsePrint(self, pos):
+        text = self.text
+        start = self.pos
+        self.pos = pos
+
+        try:
+            expr = self.expression()
+        except NoMatch:
+            self.pos = start
+            return None
+
+        directives = dict()
+        while True:
+            if self.startswith('|'):
+                self.pos += 1
+                self.skipSpaces()
+                m = nameRe.match(text, self.pos)
+                if not m:
+                    self.pos = start
+                    return None
+                self.pos = m.end()
+                if self.startswith(':'):
+                    self.pos += 1
+                    try:
+                        directives[m.group()] = self.literal()
+                        continue
+                    except NoMatch:
+                        self.pos -= 1
+                directives[m.group()] = True
+            else:
+                m = whitespaceRe.match(text, self.pos)
+                if not m:
+                    break
+                self.pos = m.end()
+
+        if not self.startswith('}'):
+            self.pos = start
+            return None
+        self.pos += 1
+
+        return Print([expr, directives])
+
+    # if
+
+    def parseIf(self):
+        options = []
+
+        expr = self.requiredExpression()
+        self.expect('}')
+        options.append((expr, self.parseCodeBlock()))
+
+        while self.startswith('{elseif'):
+            self.pos += len('{elseif')
+            self.skipRequiredSpaces()
+            expr = self.requiredExpression()
+            self.expect('}')
+            options.append((expr, self.parseCodeBlock()))
+
+        if self.startswith('{else}'):
+            self.pos += len('{else}')
+            options.append((True, self.parseCodeBlock()))
+
+        self.expect('{/if}')
+        return If(options)
+
+    # switch
+
+    def parseSwitch(self):
+        switch_ = Switch([self.requiredExpression()])
+        self.expect('}')
+
+        while True:
+            self.skipSpaces()
+            if not self.startswith('{case'):
+                break
+            self.pos += len('{case')
+            self.skipRequiredSpaces()
+
+            values = [self.requiredLiteral()]
+            while True:
+                pos = self.pos
+                self.skipSpaces()
+                if not self.startswith(','):
+                    self.pos = pos
+                    break
+                self.pos += 1
+                self.skipSpaces()
+                values.append(self.requiredLiteral())
+
+            self.skipSpaces()
+            self.expect('}')
+            switch_.append((values, self.parseCodeBlock()))
+
+        if self.startswith('{default}'):
+            self.pos += len('{default}')
+            switch_.append(self.parseCodeBlock())
+
+        self.expect('{/switch}')
+        return switch_
+
+    # foreach
+
+    def parseVariable(self):
+        m = variableRe.match(self.text, self.pos)
+        if not m:
+            self.error('Expected variable')
+        self.pos = m.end()
+        return Variable([m.group(1)])
+
+    def parseForeach(self):
+        var = self.parseVariable()
+        self.skipRequiredSpaces()
+        self.expect('in')
+        self.skipRequiredSpaces()
+        expr = self.requiredExpression()
+        self.expect('}')
+
+        code = self.parseCodeBlock()
+
+        ifEmptyCode = None
+        if self.startswith('{ifempty}'):
+            self.pos += len('{ifempty}')
+            ifEmptyCode = self.parseCodeBlock()
+
+        self.expect('{/foreach}')
+        return Foreach([var, expr, code, ifEmptyCode])
+
+    # for
+
+    def parseFor(self):
+        for_ = For([self.parseVariable()])
+        self.skipRequiredSpaces()
+        self.expect('in')
+        self.skipRequiredSpaces()
+        self.expect('range(')
+
+        for_.append(self.requiredExpression())
+        while len(for_) < 4 and self.startswith(','):
+            self.pos += 1
+            for_.append(self.requiredExpression())
+
+        self.expect(')')
+        self.skipSpaces()
+        self.expect('}')
+
+        for_.append(self.parseCodeBlock())
+        self.expect('{/for}')
+        return for_
+
+    # call
+
+    def parseParam(self):
+        name = self.name()
+
+        pos = self.pos
+        self.skipSpaces()
+        if self.startswith(':'):
+            self.pos += 1
+            expr = self.requiredExpression()
+            self.expect('/}')
+            return (name, expr)
+
+        self.pos = pos
+        self.expect('}')
+        code = self.parseCodeBlock()
+        self.expect('{/param}')
+        return (name, code)
+
+    def parseCall(self):
+        if self.startswith('name="'):
+            self.pos += len('name="')
+            name = self.requiredExpression()
+            self.expect('"')
+        else:
+            name = self.name()
+
+        data = None
+        pos = self.pos
+        m = whitespaceRe.match(self.text, pos)
+        if m:
+            self.pos = m.end()
+            if self.startswith('data="all"'):
+                self.pos += len('data="all"')
+                data = True
+            elif self.startswith('data="'):
+                self.pos += len('data="')
+                data = self.requiredExpression()
+                self.expect('"')
+            else:
+                self.pos = pos
+
+        call_ = Call([name, data])
+
+        self.skipSpaces()
+        if self.startswith('/}'):
+            self.pos += 2
+            return call_
+
+        self.expect('}')
+        while True:
+            self.skipSpaces()
+            if self.startswith('{param') and whitespaceRe.match(self.text, self.pos + len('{param')):
+                self.pos += len('{param')
+                self.skipSpaces()
+                call_.append(self.parseParam())
+            else:
+                break
+
+        self.expect('{/call}')
+        return call_
+
+    # cache
+
+    def parseCache(self):
+        self.expect('key="')
+        key = self.requiredExpression()
+        self.expect('"')
+
+        ttl = None
+        pos = self.pos
+        m = whitespaceRe.match(self.text, pos)
+        if m:
+            self.pos = m.end()
+            if self.startswith('ttl="'):
+                self.pos += len('ttl="')
+                ttl = self.requiredExpression()
+                self.expect('"')
+            else:
+                self.pos = pos
+
+        self.skipSpaces()
+        self.expect('}')
+
+        code = self.parseCodeBlock()
+        self.expect('{/cache}')
+        return Cache([key, ttl, code])
+
+    # template
+
+    def parseTemplate(self):
+        pos = self.pos
+        m = templateRe.match(self.text, self.pos)
+        if not m:
+            self.error('Expected {template ...}')
+        self.pos = m.end()
+
+        name, autoescape, private, cache, inline = m.groups()
+        props = dict()
+        if autoescape:
+            props['autoescape'] = (autoescape == 'true')
+        if private:
+            props['private'] = (private == 'true')
+        if cache:
+            props['cache'] = (cache == 'true')
+        if inline:
+            props['inline'] = (inline == 'true')
+
+        code = self.parseCodeBlock()
+        self.expect('{/template}')
+
+        return self.locate(Template([name, props, code]), pos)
+
+    # namespace
+
+    def parseNamespace(self):
+        self.skipSpacesAndComments()
+
+        m = namespaceRe.match(self.text, self.pos)
+        if not m:
+            self.error('Expected {namespace ...}')
+        self.pos = m.end()
+
+        namespace = Namespace([m.group(1)])
+        while True:
+            self.skipSpacesAndComments()
+            if self.pos >= len(self.text):
+                break
+            namespace.append(self.parseTemplate())
+
+        return namespace
+
+COMMANDS = { 'call': Parser.parseCall,
+             'if': Parser.parseIf,
+             'foreach': Parser.parseForeach,
+             'switch': Parser.parseSwitch,
+             'for': Parser.parseFor,
+             'cache': Parser.parseCache }
+
+####################################################################################################
+# entry points
+####################################################################################################
+
+def parseExpression(text):
+    parser = Parser(text)
+    try:
+        expr = parser.expression()
+    except NoMatch:
+        parser.error('Expected expression')
+
+    if parser.pos != len(text):
+        parser.error('Unexpected text')
+
+    return expr
+
+def parseSingleTemplate(text):
+    parser = Parser(text)
+    template = parser.parseTemplate()
+
+    parser.skipSpaces()
+    if parser.pos != len(text):
+        parser.error('Unexpected text')
+
+    return template
+
+def parseNamespace(text):
+    return Parser(text).parseNamespace()
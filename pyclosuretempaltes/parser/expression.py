@@ -156,60 +156,72 @@ parenthesis = Drop('(') & oW & expression & oW & Drop(')') > toPrefixExpression
 # expression
 
 def reduceRef(expr):
-    while len(expr) > 1:
-        for pos, item in enumerate(expr):
-            if isinstance(item, Ref) and len(item) == 1:
-                item.append(expr[pos-1])
-                expr[pos-1:pos+1] = [item]
-                break
-        
-    return expr
+    result = expr[0]
+    for ref in expr[1:]:
+        result = ref.__class__([ref[0], result])
+
+    return [result]
 
 expressionPart = (expressionLiteral | variable | funcall | parenthesis) & ((dotRef | aRef)[0:]) >= reduceRef
 
-def reduceInfix(infix):
-    def isOperator(obj, optype):
-        return isinstance(obj, Operator) and obj[0] == optype
-    
-    # - (unary)
-    if isOperator(infix[0], '-') and not infix[0].args:
-        infix[0].append(infix[1])
-        infix[0:2] = [Operator(['neg', infix[1]])]
-        return
-
-    # ?: ternary
-    for pos1, item1 in enumerate(infix):
-        if isOperator(item1, '?'):
-            for pos2, item2 in enumerate(infix[pos1+1:], pos1 + 1):
-                if isOperator(item2, ':'):
-                    infix[:] = [Operator(['if',
-                                          toPrefixExpression(infix[0:pos1]),
-                                          toPrefixExpression(infix[pos1+1:pos2]),
-                                          toPrefixExpression(infix[pos2+1:])])]
-                    return
-
-            raise Exception(": not found")
-
-
-    # binary operators
-    for ops in [['not'], ['*', '/', '%'], ['+', '-'], ['<', '>', '<=', '>='], ['==', '!='], ['and'], ['or']]:
-        for pos, item in enumerate(infix):
-            if isinstance(item, Operator) and (len(item.args) == 0) and (item.op in ops):
-                if item.op == 'not':
-                    item.append(infix[pos+1])
-                    infix[pos:pos+2] = [item]
-                    return
-                else:
-                    item.append(infix[pos-1])
-                    item.append(infix[pos+1])
-                    infix[pos-1:pos+2] = [item]
-                    return
+# precedence climbing
+
+BINARY_PRECEDENCE = { 'or': 1,
+                      'and': 2,
+                      '==': 3, '!=': 3,
+                      '<': 4, '>': 4, '<=': 4, '>=': 4,
+                      '+': 5, '-': 5,
+                      '*': 6, '/': 6, '%': 6 }
+
+def isOperatorSign(obj):
+    return isinstance(obj, Operator) and len(obj) == 1
+
+def climbOperand(infix, pos):
+    item = infix[pos]
+
+    if isOperatorSign(item):
+        if item.op == '-':
+            return (Operator(['neg', infix[pos + 1]]), pos + 2)
+        elif item.op == 'not':
+            return (Operator(['not', infix[pos + 1]]), pos + 2)
+        else:
+            raise Exception('Unexpected operator: %s' % item.op)
+
+    return (item, pos + 1)
+
+def climbInfix(infix, pos, minPrecedence):
+    lhs, pos = climbOperand(infix, pos)
+
+    while pos < len(infix):
+        op = infix[pos].op
+
+        if op == '?':
+            if minPrecedence > 0:
+                break
+
+            then_, pos = climbInfix(infix, pos + 1, 0)
+            if pos >= len(infix) or infix[pos].op != ':':
+                raise Exception(": not found")
+
+            else_, pos = climbInfix(infix, pos + 1, 0)
+            lhs = Operator(['if', lhs, then_, else_])
+        else:
+            precedence = BINARY_PRECEDENCE.get(op)
+            if (precedence is None) or (precedence < minPrecedence):
+                break
+
+            rhs, pos = climbInfix(infix, pos + 1, precedence + 1)
+            lhs = Operator([op, lhs, rhs])
+
+    return (lhs, pos)
 
 def toPrefix(expr):
-    while len(expr) > 1:
-        reduceInfix(expr)
+    result, pos = climbInfix(expr, 0, 0)
+
+    if pos != len(expr):
+        raise Exception('Unexpected operator: %s' % expr[pos].op)
 
-    return expr
+    return [result]
 
 expression += (oW
                & Optional((Literal('-') > Operator) | (Literal('not') > Operator))
@@ -219,5 +231,5 @@ expression += (oW
                & oW) > toPrefixExpression
     
 
-def parseExpression(text):
+def leplParseExpression(text):
     return expression.parse(text)[0]
@@ -14,51 +14,207 @@
 # implied.  See the License for the specific language governing
 # permissions and limitations under the License.
 
+import os
+import re
+import sys
+import json
+import Queue
 import operator
+import threading
+import multiprocessing
+import time
+import hashlib
+from multiprocessing.pool import ThreadPool
 import math
 from random import randint
 from numbers import Number
 from StringIO import StringIO
 from contextlib import closing
+from collections import OrderedDict, deque
+from itertools import islice
 
 from parser import *
+from lepl import List
+
+from optimizer import optimizeNamespace, blockText
 
 ####################################################################################################
 # ttable
 ####################################################################################################
 
+def renderTemplate(ttable, name, env, out):
+    if out:
+        template = ttable.findTemplate(name)
+        if not template:
+            raise Exception('Template %s is undefined' % name)
+        template(env, out, ttable)
+    else:
+        with closing(StringIO()) as out:
+            renderTemplate(ttable, name, env, out)
+            return out.getvalue()
+
+# bumped by every change of any TTable: the flattened lookup indexes built
+# before it include the prototypes as they were
+registryGeneration = 0
+
+class TemplateLink(object):
+    """The handler that static {call}s of a template name resolve to, linked
+    when the handlers are built and updated when the template is registered"""
+
+    def __init__(self, template):
+        self.template = template
+
 class TTable(object):
-    def __init__(self, prototype=None):
+    # memo of the calls of the current render, see RenderScope
+    callMemo = None
+
+    def __init__(self, prototype=None, renderCache=None, cacheTemplates=False, memoizeCalls=False,
+                 fragmentCache=None, instrumentation=None, profiler=None, inlineCalls=False,
+                 renderThreads=None):
         self.dict = dict()
         self.prototype = prototype
+        self.links = dict()
+        self.index = None
+        self.indexGeneration = None
+        self.renderCache = renderCache or RenderCache()
+        # store of the {cache} fragments: any object with the get(key) and
+        # set(key, text, time=0) methods of a memcached client
+        if fragmentCache is None:
+            fragmentCache = RenderCache()
+        self.fragmentCache = fragmentCache
+        # cache the output of every template without cache="false"
+        self.cacheTemplates = cacheTemplates
+        # reuse the output of identical calls of pure templates within a render
+        self.memoizeCalls = memoizeCalls
+        # an Instrumentation that wraps every registered template
+        self.instrumentation = instrumentation
+        # a Profiler that the templates built for this table report to
+        self.profiler = profiler
+        # build the small templates into their callers of the same namespace:
+        # superseding a template then leaves its inlined copies as they were.
+        # Rendered through a child table, the templates are not inlined, so
+        # the overrides of the child apply.
+        self.inlineCalls = inlineCalls
+        # the threads of renderAsync: by default the RENDER_THREADS of the pool
+        # shared by all tables, else a pool of this table, started on first use
+        self.renderThreads = renderThreads
+        self.ownRenderPool = None
+
+    @property
+    def ttable(self):
+        # the table that registers the templates, as for a RenderScope
+        return self
 
     def clear(self):
+        global registryGeneration
+        registryGeneration += 1
+
         self.dict.clear()
+        for link in self.links.itervalues():
+            link.template = None
+        self.renderCache.clear()
+        self.clearFragments()
+
+    def clearFragments(self):
+        # a shared store outlives the process, its entries expire by ttl
+        if isinstance(self.fragmentCache, RenderCache):
+            self.fragmentCache.clear()
 
     def findTemplate(self, name):
-        if name in self.dict:
-            return self.dict.get(name)
-        elif self.prototype:
-            return self.prototype.findTemplate(name)
-        else:
-            return None
+        return self.templateIndex().get(name)
+
+    def templateIndex(self):
+        """The templates of the whole prototype chain in one dict"""
+
+        if self.indexGeneration != registryGeneration:
+            generation = registryGeneration
+            index = dict(self.prototype.templateIndex()) if self.prototype else dict()
+            index.update(self.dict)
+
+            self.index = index
+            self.indexGeneration = generation
+
+        return self.index
+
+    def link(self, name):
+        """The TemplateLink of name. Links only resolve to the templates of
+        this TTable: the others are looked up by name on every call."""
+
+        link = self.links.get(name)
+        if link is None:
+            link = self.links[name] = TemplateLink(self.dict.get(name))
+        return link
 
     def registerTempalte(self, name, template, supersede=False):
+        global registryGeneration
+
         if (not supersede) and (name in self.dict):
             raise Exception('Template %s has already been registered' % name)
-        
+
+        if name in self.dict:
+            # callers may have cached the output of the old version
+            self.renderCache.clear()
+            self.clearFragments()
+
+        if self.instrumentation:
+            template = self.instrumentation.wrap(name, template)
+
         self.dict[name] = template
+        registryGeneration += 1
+
+        link = self.links.get(name)
+        if link:
+            link.template = template
 
     def callTemplate(self, name, env, out=None):
-        if out:
-            template = self.findTemplate(name)
-            if not template:
-                raise Exception('Template %s is undefined' % name)
-            template(env, out, ttable=self)
+        if self.memoizeCalls:
+            return renderTemplate(RenderScope(self), name, env, out)
         else:
-            with closing(StringIO()) as out:
-                self.callTemplate(name, env, out=out)
-                return out.getvalue()
+            return renderTemplate(self, name, env, out)
+
+    def iterTemplate(self, name, env, chunkSize=8192, encoding='utf-8'):
+        """Renders in a background thread and yields the output in chunks of about
+        chunkSize characters, encoded unless encoding is None, so the result can be
+        returned as a WSGI iterable. {flush} ends the current chunk early."""
+
+        if not self.findTemplate(name):
+            raise Exception('Template %s is undefined' % name)
+
+        return iterRender(self, name, env, chunkSize, encoding)
+
+    def renderAsync(self, name, env, callback=None):
+        """Starts rendering in the render thread pool and returns its
+        multiprocessing.pool.AsyncResult; get() returns the output. A render
+        that waits for a future holds its thread: at most renderThreads, or
+        RENDER_THREADS for the shared pool, run at once and the others queue."""
+
+        if not self.findTemplate(name):
+            raise Exception('Template %s is undefined' % name)
+
+        return self.renderPool().apply_async(self.callTemplate, (name, env), callback=callback)
+
+    def renderPool(self):
+        if not self.renderThreads:
+            return renderPool()
+
+        with renderPoolLock:
+            if self.ownRenderPool is None:
+                self.ownRenderPool = ThreadPool(self.renderThreads)
+            return self.ownRenderPool
+
+    def renderMany(self, name, envs, workers=None, chunksize=64):
+        """Renders name for every env of the iterable envs in a pool of worker
+        processes and returns a BatchRender: an iterator of the outputs in the
+        order of envs. The workers are forked and inherit the templates.
+
+        The workers stop when the iterator is exhausted or raises. An iteration
+        left before must call close(), or use the BatchRender as a context
+        manager: the pool is not garbage collected while its workers run."""
+
+        if not self.findTemplate(name):
+            raise Exception('Template %s is undefined' % name)
+
+        return BatchRender(self, name, envs, workers or multiprocessing.cpu_count(), chunksize)
 
     def templateNameList(self):
         names = self.dict.keys()
@@ -69,6 +225,590 @@ class TTable(object):
         names.sort()
         return names
 
+class RenderScope(object):
+    """Passed to the templates as ttable during one render of a TTable with
+    memoizeCalls, so the memo lives exactly as long as the render."""
+
+    def __init__(self, ttable):
+        self.ttable = ttable
+        self.renderCache = ttable.renderCache
+        self.fragmentCache = ttable.fragmentCache
+        self.callMemo = dict()
+
+    def findTemplate(self, name):
+        return self.ttable.findTemplate(name)
+
+    def callTemplate(self, name, env, out=None):
+        return renderTemplate(self, name, env, out)
+
+####################################################################################################
+# streaming
+####################################################################################################
+
+STREAM_QUEUE_SIZE = 16
+
+# the ChunkWriter of the streaming render running in this thread
+streamState = threading.local()
+
+class RenderCancelled(Exception): pass
+
+class ChunkWriter(object):
+    def __init__(self, emit, chunkSize):
+        self.emit = emit
+        self.chunkSize = chunkSize
+        self.parts = []
+        self.size = 0
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.chunkSize:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            chunk = ''.join(self.parts)
+            self.parts = []
+            self.size = 0
+            self.emit(chunk)
+
+class TeeWriter(object):
+    """Passes the output on to out and records it, so it can be cached while streaming"""
+
+    def __init__(self, out):
+        self.out = out
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append(text)
+        self.out.write(text)
+
+    def flush(self):
+        self.out.flush()
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+def iterRender(ttable, name, env, chunkSize, encoding):
+    chunks = Queue.Queue(STREAM_QUEUE_SIZE)
+    cancelled = threading.Event()
+
+    def put(item):
+        # the consumer may be gone: never block forever
+        while not cancelled.is_set():
+            try:
+                chunks.put(item, True, 0.1)
+                return
+            except Queue.Full:
+                pass
+        raise RenderCancelled()
+
+    def emit(chunk):
+        if encoding and isinstance(chunk, unicode):
+            chunk = chunk.encode(encoding)
+        put((chunk, None))
+
+    def render():
+        try:
+            out = ChunkWriter(emit, chunkSize)
+            streamState.writer = out
+            ttable.callTemplate(name, env, out)
+            out.flush()
+            put((None, None))
+        except RenderCancelled:
+            pass
+        except Exception:
+            try:
+                put((None, sys.exc_info()))
+            except RenderCancelled:
+                pass
+        finally:
+            streamState.writer = None
+
+    producer = threading.Thread(target=render, name='render %s' % name)
+    producer.daemon = True
+    producer.start()
+
+    try:
+        while True:
+            chunk, error = chunks.get()
+            if error:
+                raise error[0], error[1], error[2]
+            elif chunk is None:
+                return
+            yield chunk
+    finally:
+        cancelled.set()
+
+####################################################################################################
+# render cache
+####################################################################################################
+
+class RenderCache(object):
+    """LRU of template outputs, bounded by the size of the stored strings. Also
+    the default store of the {cache} fragments, with the get and set methods of
+    a memcached client."""
+
+    def __init__(self, maxBytes=16 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        # expiry times of the entries stored with a ttl
+        self.expires = dict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncacheable = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            text = self.entries.pop(key, None)
+            if text is not None and key in self.expires and self.expires[key] <= time.time():
+                del self.expires[key]
+                self.bytes -= sys.getsizeof(text)
+                text = None
+
+            if text is None:
+                self.misses += 1
+            else:
+                self.entries[key] = text
+                self.hits += 1
+            return text
+
+    def put(self, key, text, ttl=0):
+        size = sys.getsizeof(text)
+        if size > self.maxBytes:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= sys.getsizeof(old)
+
+            self.entries[key] = text
+            self.bytes += size
+
+            if ttl:
+                self.expires[key] = time.time() + ttl
+            else:
+                self.expires.pop(key, None)
+
+            while self.bytes > self.maxBytes:
+                key, old = self.entries.popitem(last=False)
+                self.expires.pop(key, None)
+                self.bytes -= sys.getsizeof(old)
+                self.evictions += 1
+
+    def set(self, key, text, time=0):
+        self.put(key, text, time)
+
+    def countUncacheable(self):
+        with self.lock:
+            self.uncacheable += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.expires.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return { 'hits': self.hits,
+                     'misses': self.misses,
+                     'evictions': self.evictions,
+                     'uncacheable': self.uncacheable,
+                     'entries': len(self.entries),
+                     'bytes': self.bytes }
+
+class Uncacheable(Exception): pass
+
+def freezeValue(value):
+    if isinstance(value, dict):
+        return (dict, tuple(sorted((key, freezeValue(item)) for key, item in value.iteritems())))
+    elif isinstance(value, (list, tuple)):
+        return (list, tuple([freezeValue(item) for item in value]))
+    elif value is None or isinstance(value, (basestring, Number)):
+        # the class keeps 1, 1.0 and True apart: they print differently
+        return (value.__class__, value)
+    else:
+        raise Uncacheable()
+
+def treeSignature(obj):
+    if isinstance(obj, List):
+        return (obj.__class__.__name__, tuple([treeSignature(item) for item in obj]))
+    elif isinstance(obj, (list, tuple)):
+        return tuple([treeSignature(item) for item in obj])
+    elif isinstance(obj, dict):
+        return tuple(sorted((key, treeSignature(value)) for key, value in obj.iteritems()))
+    else:
+        return obj
+
+def fragmentId(cache_, autoescape):
+    """Digest of the source of a {cache} command: a changed fragment gets new
+    keys, also in a store shared by several processes"""
+    signature = repr(treeSignature([cache_.code, autoescape]))
+    return hashlib.sha1(signature).hexdigest()[:16]
+
+def fragmentKey(fragment, value):
+    """Store key of the output of a fragment for a value of its key expression,
+    or None if the value is not a string, a number or a structure of them"""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        try:
+            value = repr(freezeValue(value))
+        except Uncacheable:
+            return None
+
+    return 'soy:%s:%s' % (fragment, value)
+
+####################################################################################################
+# futures
+####################################################################################################
+
+# Data values of these classes are resolved with result() when a template reads
+# them, so a render only waits for the futures it uses. Any class with done() and
+# result() methods can be registered.
+
+futureTypes = ()
+
+def registerFutureType(cls):
+    global futureTypes
+    if cls not in futureTypes:
+        futureTypes = futureTypes + (cls,)
+
+def resolveFuture(future):
+    if not future.done():
+        # send everything rendered so far before waiting
+        writer = getattr(streamState, 'writer', None)
+        if writer:
+            writer.flush()
+
+    return future.result()
+
+# threads of the pool of renderAsync shared by the TTables without renderThreads.
+# A render blocked on a future keeps its thread, so a table whose renders wait
+# for futures resolved by other renders needs a pool of its own that fits them.
+RENDER_THREADS = 4
+
+renderPoolLock = threading.Lock()
+sharedRenderPool = None
+
+def renderPool():
+    global sharedRenderPool
+    with renderPoolLock:
+        if sharedRenderPool is None:
+            sharedRenderPool = ThreadPool(RENDER_THREADS)
+        return sharedRenderPool
+
+####################################################################################################
+# batch rendering
+####################################################################################################
+
+# the TTable of the worker processes, inherited from the parent by fork
+forkedTTable = None
+forkLock = threading.Lock()
+
+def renderBatchChunk(name, envs):
+    start = time.time()
+    texts = [forkedTTable.callTemplate(name, env) for env in envs]
+    return os.getpid(), time.time() - start, texts
+
+class BatchRender(object):
+    def __init__(self, ttable, name, envs, workers, chunksize):
+        global forkedTTable
+        with forkLock:
+            forkedTTable = ttable
+            try:
+                self.pool = multiprocessing.Pool(workers)
+            finally:
+                forkedTTable = None
+
+        self.name = name
+        self.envs = iter(envs)
+        self.chunksize = chunksize
+        # chunks sent to the workers but not yielded yet: bounds the memory use
+        self.maxPending = 2 * workers
+        self.pending = deque()
+        self.texts = iter(())
+        self.workers = dict()
+
+    def __iter__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def next(self):
+        while True:
+            for text in self.texts:
+                return text
+
+            self.submit()
+            if not self.pending:
+                self.close()
+                raise StopIteration
+
+            try:
+                pid, seconds, texts = self.pending.popleft().get()
+            except:
+                self.close()
+                raise
+
+            renders, total = self.workers.get(pid, (0, 0.0))
+            self.workers[pid] = (renders + len(texts), total + seconds)
+            self.texts = iter(texts)
+
+    def submit(self):
+        while self.pool and len(self.pending) < self.maxPending:
+            envs = list(islice(self.envs, self.chunksize))
+            if not envs:
+                break
+            self.pending.append(self.pool.apply_async(renderBatchChunk, (self.name, envs)))
+
+    def close(self):
+        """Stops the worker processes, the iteration ends"""
+
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            self.pending.clear()
+            self.texts = iter(())
+
+    def stats(self):
+        """Renders, seconds spent rendering and renders per second of every
+        worker process, by pid"""
+
+        return dict((pid, { 'renders': renders,
+                            'seconds': seconds,
+                            'rendersPerSecond': renders / seconds if seconds else 0.0 })
+                    for pid, (renders, seconds) in self.workers.iteritems())
+
+####################################################################################################
+# instrumentation
+####################################################################################################
+
+class CountingWriter(object):
+    # counts per writer: the text of a {param} block is written to its buffer
+    # first, and counted again only if the callee writes it out
+    def __init__(self, out):
+        self.out = out
+        self.bytes = 0
+
+    def write(self, text):
+        self.bytes += len(text)
+        self.out.write(text)
+
+    def flush(self):
+        self.out.flush()
+
+def escapeLabel(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Instrumentation(object):
+    """Per template counters of a TTable created with instrumentation: calls,
+    seconds including and excluding the called templates, and characters
+    written including the called templates. onEnter(name, env) and
+    onExit(name, env, seconds, selfSeconds, size) are called around every
+    render of a template."""
+
+    METRICS = [('calls', 'calls_total', 'Renders of the template.'),
+               ('seconds', 'seconds_total', 'Seconds spent in the template and its callees.'),
+               ('selfSeconds', 'self_seconds_total', 'Seconds spent in the template itself.'),
+               ('size', 'output_characters_total', 'Characters written by the template and its callees.')]
+
+    def __init__(self, onEnter=None, onExit=None):
+        self.onEnter = onEnter
+        self.onExit = onExit
+        self.counters = dict()
+        self.lock = threading.Lock()
+        # per thread: the stack of the callee times
+        self.state = threading.local()
+
+    def wrap(self, name, template):
+        if getattr(template, 'instrumentation', None) is self:
+            return template
+
+        def instrumentedHandler(env, out, ttable):
+            state = self.state
+            if not hasattr(state, 'stack'):
+                state.stack = []
+
+            if self.onEnter:
+                self.onEnter(name, env)
+
+            if out and not isinstance(out, CountingWriter):
+                out = CountingWriter(out)
+
+            stack = state.stack
+            stack.append(0.0)
+            startBytes = out.bytes if out else 0
+            start = time.time()
+            text = None
+            try:
+                text = template(env, out, ttable)
+            finally:
+                seconds = time.time() - start
+                selfSeconds = seconds - stack.pop()
+                if stack:
+                    stack[-1] += seconds
+
+                if text is not None:
+                    size = len(text)
+                elif out:
+                    size = out.bytes - startBytes
+                else:
+                    size = 0
+
+                self.record(name, seconds, selfSeconds, size)
+                if self.onExit:
+                    self.onExit(name, env, seconds, selfSeconds, size)
+
+            return text
+
+        instrumentedHandler.instrumentation = self
+        return instrumentedHandler
+
+    def record(self, name, seconds, selfSeconds, size):
+        with self.lock:
+            counters = self.counters.get(name)
+            if counters is None:
+                counters = self.counters[name] = [0, 0.0, 0.0, 0]
+            counters[0] += 1
+            counters[1] += seconds
+            counters[2] += selfSeconds
+            counters[3] += size
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+
+    def stats(self):
+        with self.lock:
+            return dict((name, dict(zip([key for key, metric, help in self.METRICS], counters)))
+                        for name, counters in self.counters.iteritems())
+
+    def toJSON(self):
+        return json.dumps(self.stats(), sort_keys=True)
+
+    def toPrometheus(self, prefix='soy_template'):
+        """The counters in the Prometheus text exposition format"""
+
+        stats = self.stats()
+        lines = []
+        for key, metric, help in self.METRICS:
+            metric = '%s_%s' % (prefix, metric)
+            lines.append('# HELP %s %s' % (metric, help))
+            lines.append('# TYPE %s counter' % metric)
+            for name in sorted(stats):
+                lines.append('%s{template="%s"} %s' % (metric, escapeLabel(name), repr(stats[name][key])))
+
+        return '\n'.join(lines) + '\n'
+
+####################################################################################################
+# profiling
+####################################################################################################
+
+class Profiler(object):
+    """Sampling profiler of the template source. The handlers of a TTable built
+    with the profiler keep a stack of the templates and commands they run, as
+    'file:line' labels. While started, a thread samples the stacks of all
+    rendering threads every interval seconds."""
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        # the label stack of every thread, by thread ident
+        self.stacks = dict()
+        self.state = threading.local()
+        self.samples = dict()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def wrap(self, handler, label):
+        state = self.state
+        stacks = self.stacks
+
+        def profiledHandler(arg, out, ttable):
+            try:
+                stack = state.stack
+            except AttributeError:
+                stack = state.stack = stacks[threading.current_thread().ident] = []
+
+            stack.append(label)
+            try:
+                return handler(arg, out, ttable)
+            finally:
+                stack.pop()
+
+        return profiledHandler
+
+    def sample(self):
+        with self.lock:
+            for stack in self.stacks.values():
+                stack = tuple(stack)
+                if stack:
+                    self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def start(self):
+        if self.thread:
+            return
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        if self.thread:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+
+    def collapsed(self):
+        """The samples as collapsed stacks, one 'frame;frame;... count' line per
+        stack, the input format of flamegraph.pl and similar tools"""
+
+        with self.lock:
+            lines = ['%s %d' % (';'.join(stack), count) for stack, count in self.samples.iteritems()]
+
+        lines.sort()
+        return ''.join(line + '\n' for line in lines)
+
+    def lineStats(self):
+        """Samples by label: 'self' counts the samples at the top of the stack,
+        'total' the samples that include the label at all"""
+
+        stats = dict()
+        with self.lock:
+            for stack, count in self.samples.iteritems():
+                for label in set(stack):
+                    stats.setdefault(label, { 'self': 0, 'total': 0 })['total'] += count
+                stats[stack[-1]]['self'] += count
+
+        return stats
+
 ####################################################################################################
 # environment
 ####################################################################################################
@@ -85,92 +825,196 @@ class Env(object):
 # escape
 ####################################################################################################
 
+htmlEscapeRe = re.compile('[<>"\'&]')
+
 def escapeHtml(text):
     if isText(text):
-        out = StringIO()
-
-        for ch in text:
-            if ch == '<':
-                out.write('&lt;')
-            elif ch == '>':
-                out.write('&gt;')
-            elif ch == '"':
-                out.write('&quot;')
-            elif ch =="'":
-                out.write('&#039;')
-            elif ch == '&':
-                out.write('&amp;')
-            else:
-                out.write(ch)
-
-        return out.getvalue()
+        if htmlEscapeRe.search(text) is None:
+            return text
+
+        return (text.replace('&', '&amp;')
+                .replace('<', '&lt;')
+                .replace('>', '&gt;')
+                .replace('"', '&quot;')
+                .replace("'", '&#039;'))
     elif text is None:
         return ''
     else:
         return str(text)
 
-def encodeString(text, notEncode):
-    if isText(text):
-        out = StringIO()
+# '%XX' for every octet
+OCTET_ESCAPES = ['%%%02X' % octet for octet in xrange(256)]
 
-        for ch in text:
-            if (chr(0) <= ch <= chr(9)) or ('a' <= ch <= 'z') or ('A' <= ch <= 'Z') or (ch in notEncode):
-                out.write(str(ch))
-            else:
-                for octet in ch.encode('utf-8'):
-                    out.write('%%%02X' % ord(octet))
+class EncodeTable(dict):
+    """unicode.translate table, filled in on first use of every character"""
 
-        return out.getvalue()
-    elif text is None:
-        return ''
-    else:
-        return str(text)
+    def __init__(self, safeRe):
+        self.safeRe = safeRe
+
+    def __missing__(self, code):
+        ch = unichr(code)
+        if self.safeRe.match(ch):
+            value = ch
+        else:
+            value = u''.join([OCTET_ESCAPES[ord(octet)] for octet in ch.encode('utf-8')])
+
+        self[code] = value
+        return value
+
+def makeStringEncoder(notEncode):
+    safe = ur'\x00-\x09a-zA-Z%s' % re.escape(notEncode)
+    unsafeRe = re.compile(u'[^%s]' % safe, re.UNICODE)
+    table = EncodeTable(re.compile(u'[%s]' % safe, re.UNICODE))
+
+    def encodeString(text):
+        if isText(text):
+            if unsafeRe.search(text) is None:
+                return str(text)
+            return str(unicode(text).translate(table))
+        elif text is None:
+            return ''
+        else:
+            return str(text)
+
+    return encodeString
+
+encodeUri = makeStringEncoder('~!@#$&*()=:/,;?+\'')
+
+encodeUriComponent = makeStringEncoder('~!*()\'')
+
+####################################################################################################
+# scope
+####################################################################################################
+
+# A frame is a list: the template data in DATA_SLOT, then one slot per loop variable,
+# loop counter and loop sequence, assigned while the template is built. A loop
+# variable that is null falls through to the outer loop variables of its name and
+# then to the data, as the chained environments did.
+
+DATA_SLOT = 0
+
+class Scope(object):
+    def __init__(self, ttable=None, source=None):
+        self.size = DATA_SLOT + 1
+        self.vars = dict()
+        # the TTable the template is built for, links its static calls
+        self.ttable = ttable
+        # the file of the template and the Profiler its commands report to
+        self.source = source
+        self.profiler = ttable.profiler if ttable else None
+
+    def link(self, name):
+        if self.ttable:
+            return self.ttable.link(name)
+        else:
+            return None
+
+    def allocate(self):
+        self.size += 1
+        return self.size - 1
+
+    def lookup(self, name):
+        """The slots of the innermost loop variable name, or None"""
 
-def encodeUri(text):
-    return encodeString(text, '~!@#$&*()=:/,;?+\'')
+        stack = self.vars.get(name)
+        return stack[-1] if stack else None
+
+    def valueSlots(self, name):
+        """The value slots of the loop variables name, the innermost first"""
+
+        return [slots[0] for slots in reversed(self.vars.get(name, ()))]
+
+    def locals(self):
+        """(name, value slots) of every loop variable in scope"""
+
+        return [(name, self.valueSlots(name)) for name, stack in self.vars.iteritems() if stack]
+
+    def bind(self, name, slots):
+        self.vars.setdefault(name, []).append(slots)
+
+    def unbind(self, name):
+        self.vars[name].pop()
 
-def encodeUriComponent(text):
-    return encodeString(text, '~!*()\'')
-    
-    
 ####################################################################################################
 # expression handler
 ####################################################################################################
 
 def fetchProperty(obj, key):
     if isinstance(obj, dict):
-        return obj.get(key)
-    if isinstance(obj, Env):
+        value = obj.get(key)
+    elif isinstance(obj, Env):
         ex = fetchProperty(obj.extra, key)
         if ex != None:
             return ex
         else:
             return fetchProperty(obj.base, key)
     else:
-        return getattr(obj, key)
+        value = getattr(obj, key)
+
+    if futureTypes and isinstance(value, futureTypes):
+        return resolveFuture(value)
+
+    return value
+
+def fetchVariable(env, key):
+    try:
+        return fetchProperty(env, key)
+    except AttributeError:
+        return None
+
+def peekVariable(env, key):
+    # as fetchVariable, but leaves futures unresolved
+    if isinstance(env, Env):
+        value = peekVariable(env.extra, key)
+        return value if value != None else peekVariable(env.base, key)
+    elif isinstance(env, dict):
+        return env.get(key)
+    else:
+        return getattr(env, key, None)
 
 def makeConstantlyHandler(value):
-    def constantlyHandler(env):
+    def constantlyHandler(frame):
         return value
-    
+
     return constantlyHandler
 
 def makeDotRefHandler(expr, key):
-    def dotHandler(env):
-        return fetchProperty(expr(env), key(env))
+    def dotHandler(frame):
+        return fetchProperty(expr(frame), key)
 
     return dotHandler
 
 def makeARefHandler(expr, pos):
-    def aRefHandler(env):
-        return expr(env)[pos(env)]
+    def aRefHandler(frame):
+        return expr(frame)[pos(frame)]
     return aRefHandler
 
-def makeVariableHandler(var):
-    def variableHandler(env):
-        return fetchProperty(env, var)
-
-    return variableHandler
+def fetchLocal(frame, slots, var):
+    for slot in slots:
+        value = frame[slot]
+        if value is not None:
+            return value
+    return fetchProperty(frame[DATA_SLOT], var)
+
+def makeVariableHandler(var, scope):
+    slots = scope.valueSlots(var)
+
+    if len(slots) == 1:
+        slot = slots[0]
+        def localVariableHandler(frame):
+            value = frame[slot]
+            if value is None:
+                return fetchProperty(frame[DATA_SLOT], var)
+            return value
+        return localVariableHandler
+    elif slots:
+        def shadowingVariableHandler(frame):
+            return fetchLocal(frame, slots, var)
+        return shadowingVariableHandler
+    else:
+        def variableHandler(frame):
+            return fetchProperty(frame[DATA_SLOT], var)
+        return variableHandler
 
 def genericAdd(arg1, arg2):
     if isinstance(arg1, Number) and isinstance(arg2, Number):
@@ -189,8 +1033,8 @@ def makeOperatorHandler(name, args):
         if not op:
             raise Exception("Unknow unary operator: %s" % name)
 
-        def unaryOperatorHandler(env):
-            return op(arg(env))
+        def unaryOperatorHandler(frame):
+            return op(arg(frame))
 
         return unaryOperatorHandler
     elif len(args) == 2:
@@ -205,23 +1049,23 @@ def makeOperatorHandler(name, args):
                       '>': operator.gt,
                       '==': operator.eq,
                       '!=': operator.ne }
-        
+
         a = args[0]
         b = args[1]
         op = binaryOps.get(name)
 
         if op:
-            def binaryOperatorHandler(env):
-                return op(a(env), b(env))
+            def binaryOperatorHandler(frame):
+                return op(a(frame), b(frame))
             return binaryOperatorHandler
         elif name == 'and':
-            def andOperatorHandler(env):
-                return a(env) and b(env)
+            def andOperatorHandler(frame):
+                return a(frame) and b(frame)
             return andOperatorHandler
         elif name == 'or':
-            def orOperatorHandler(env):
-                return a(env) or b(env)
-            return orOperatorHandler                
+            def orOperatorHandler(frame):
+                return a(frame) or b(frame)
+            return orOperatorHandler
         else:
             raise Exception('Unknow binary operator: %s' % name)
     elif len(args) == 3:
@@ -229,12 +1073,12 @@ def makeOperatorHandler(name, args):
             cond = args[0]
             then_ = args[1]
             else_ = args[2]
-            
-            def ifOperatorHandler(env):
-                if cond(env):
-                    return then_(env)
+
+            def ifOperatorHandler(frame):
+                if cond(frame):
+                    return then_(frame)
                 else:
-                    return else_(env)
+                    return else_(frame)
 
             return ifOperatorHandler
         else:
@@ -248,34 +1092,54 @@ def ctRound(number, ndigits=None):
     else:
         return int(round(number))
 
-def loopVariableCounterName(varName):
-    return '%%counter_%s' % varName
+def notForeachVariable(name):
+    raise Exception('%s is not a foreach variable' % name)
+
+def findLoopSlots(var, scope):
+    slots = scope.lookup(var.name)
+    if slots and slots[1]:
+        return slots
+    else:
+        return None
+
+def makeNotForeachHandler(var):
+    # fails when evaluated, not when the template is built: the other
+    # templates of the namespace stay usable
+    def notForeachHandler(frame):
+        notForeachVariable(var.name)
+
+    return notForeachHandler
 
-def loopSequenceName(varName):
-    return '%%sequence_%s' % varName
+def makeLoopIndex(var, scope):
+    slots = findLoopSlots(var, scope)
+    if slots is None:
+        return makeNotForeachHandler(var)
+    counter = slots[1]
 
-def makeLoopIndex(varName):
-    counterName = loopVariableCounterName(varName)
-    
-    def loopIndex(env):
-        return fetchProperty(env.extra, counterName) + 1
+    def loopIndex(frame):
+        return frame[counter] + 1
 
     return loopIndex
 
-def makeLoopIsFirst(varName):
-    counterName = loopVariableCounterName(varName)
-    
-    def loopIsFirst(env):
-        return (0 == fetchProperty(env, counterName))
-    
+def makeLoopIsFirst(var, scope):
+    slots = findLoopSlots(var, scope)
+    if slots is None:
+        return makeNotForeachHandler(var)
+    counter = slots[1]
+
+    def loopIsFirst(frame):
+        return (0 == frame[counter])
+
     return loopIsFirst
 
-def makeLoopIsLast(varName):
-    seqName = loopSequenceName(varName)
-    counterName = loopVariableCounterName(varName)
+def makeLoopIsLast(var, scope):
+    slots = findLoopSlots(var, scope)
+    if slots is None:
+        return makeNotForeachHandler(var)
+    slot, counter, sequence = slots
 
-    def loopIsLast(env):
-        return (fetchProperty(env, counterName) == (len(fetchProperty(env, seqName)) - 1))
+    def loopIsLast(frame):
+        return (frame[counter] == (len(frame[sequence]) - 1))
 
     return loopIsLast
 
@@ -285,15 +1149,18 @@ def hasData(env):
     else:
         return len(env) > 0
 
-def makeFunctionHandler(name, args):
+def hasDataHandler(frame):
+    return hasData(frame[DATA_SLOT])
+
+def makeFunctionHandler(name, args, scope):
     if name == 'hasData':
-        return hasData
+        return hasDataHandler
     elif name == 'index':
-        return makeLoopIndex(args[0].name)
+        return makeLoopIndex(args[0], scope)
     elif name == 'isFirst':
-        return makeLoopIsFirst(args[0].name)
+        return makeLoopIsFirst(args[0], scope)
     elif name == 'isLast':
-        return makeLoopIsLast(args[0].name)
+        return makeLoopIsLast(args[0], scope)
 
     funDict = { 'length': len,
                 'keys': dict.keys,
@@ -304,31 +1171,39 @@ def makeFunctionHandler(name, args):
                 'max': max,
                 'randomInt': lambda n: randint(0, n - 1)}
 
-    fun = funDict[name]
+    fun = funDict.get(name)
 
-    exprArgs =[makeExpressionHandler(arg) for arg in args]
-    
     if not fun:
         raise Exception('Unknow function: %s' % name)
 
-    def functionHandler(env):
-        return fun(*[arg(env) for arg in exprArgs])
+    exprArgs = [makeExpressionHandler(arg, scope) for arg in args]
+
+    if len(exprArgs) == 1:
+        arg = exprArgs[0]
+        def functionHandler(frame):
+            return fun(arg(frame))
+    elif len(exprArgs) == 2:
+        arg1, arg2 = exprArgs
+        def functionHandler(frame):
+            return fun(arg1(frame), arg2(frame))
+    else:
+        def functionHandler(frame):
+            return fun(*[arg(frame) for arg in exprArgs])
 
     return functionHandler
 
-def makeExpressionHandler(expr):
+def makeExpressionHandler(expr, scope):
     if isinstance(expr, Variable):
-        return makeVariableHandler(expr.name)
+        return makeVariableHandler(expr.name, scope)
     elif isinstance(expr, DotRef):
-        return makeDotRefHandler(makeExpressionHandler(expr.expr),
-                                 makeExpressionHandler(expr.name))
+        return makeDotRefHandler(makeExpressionHandler(expr.expr, scope), expr.name)
     elif isinstance(expr, ARef):
-        return makeARefHandler(makeExpressionHandler(expr.expr),
-                               makeExpressionHandler(expr.position))
+        return makeARefHandler(makeExpressionHandler(expr.expr, scope),
+                               makeExpressionHandler(expr.position, scope))
     elif isinstance(expr, Operator):
-        return makeOperatorHandler(expr.op, [makeExpressionHandler(arg) for arg in expr.args])
+        return makeOperatorHandler(expr.op, [makeExpressionHandler(arg, scope) for arg in expr.args])
     elif isinstance(expr, Funcall):
-        return makeFunctionHandler(expr.name, expr.args)
+        return makeFunctionHandler(expr.name, expr.args, scope)
     else:
         return makeConstantlyHandler(expr)
 
@@ -344,23 +1219,26 @@ def writeTemplateAtom(obj, out):
     else:
         out.write(str(obj))
 
-def makeCodeBlockHandler(block, autoescape):
+def makeCodeBlockHandler(block, autoescape, scope):
     cmds = filter(None, block)
 
     for i in xrange(len(cmds)):
         if isinstance(cmds[i], Substition):
             cmds[i] = cmds[i].char
-            
-    commands = [makeCommandHandler(item, autoescape) for item in cmds]
-    
-    def codeBlockHandler(env, out, **kwargs):
-        for cmd in filter(None, commands):
-            cmd(env, out, **kwargs)
+
+    commands = filter(None, [makeCommandHandler(item, autoescape, scope) for item in cmds])
+
+    if len(commands) == 1:
+        return commands[0]
+
+    def codeBlockHandler(frame, out, ttable):
+        for cmd in commands:
+            cmd(frame, out, ttable)
 
     return codeBlockHandler
 
-def makePrintHandler(print_, autoescape):
-    exprHandler = makeExpressionHandler(print_.expr)
+def makePrintHandler(print_, autoescape, scope):
+    exprHandler = makeExpressionHandler(print_.expr, scope)
     directives = print_.directives
 
     if autoescape and (directives.get('noAutoescape') != True):
@@ -376,183 +1254,552 @@ def makePrintHandler(print_, autoescape):
         escapeHandler = encodeUri
 
     if escapeHandler:
-        def printHandler(env, out, **kwargs):
-            writeTemplateAtom(escapeHandler(exprHandler(env)), out)
+        def printHandler(frame, out, ttable):
+            out.write(escapeHandler(exprHandler(frame)))
     else:
-        def printHandler(env, out, **kwargs):
-            writeTemplateAtom(exprHandler(env), out)
+        def printHandler(frame, out, ttable):
+            writeTemplateAtom(exprHandler(frame), out)
 
     return printHandler
 
-def makeLiteralHandler(literal, autoescape):
+def makeLiteralHandler(literal, autoescape, scope):
     text = literal.text
 
-    def literalHandler(env, out, **kwargs):
+    def literalHandler(frame, out, ttable):
         writeTemplateAtom(text, out)
 
     return literalHandler
 
-def makeIfHandler(if_, autoescape):
-    options = [(makeExpressionHandler(item[0]), makeCodeBlockHandler(item[1], autoescape)) for item in if_]
+def makeIfHandler(if_, autoescape, scope):
+    options = [(makeExpressionHandler(item[0], scope), makeCodeBlockHandler(item[1], autoescape, scope))
+               for item in if_]
 
-    def ifHandler(env, out, **kwargs):
-        for option in options:
-            if option[0](env):
-                option[1](env, out, **kwargs)
+    def ifHandler(frame, out, ttable):
+        for cond, body in options:
+            if cond(frame):
+                body(frame, out, ttable)
                 return
 
     return ifHandler
 
-def makeSwitchHandler(switch_, autoescape):
-    expr = makeExpressionHandler(switch_.expr)
+def makeSwitchTable(cases):
+    # value -> handler of the first case that lists it, or None if a value is
+    # not hashable. Equal values hash alike, so lookups match like the in test.
+    table = dict()
+    try:
+        for values, body in cases:
+            for value in values:
+                table.setdefault(value, body)
+    except TypeError:
+        return None
+
+    return table
 
-    def makeCaseItem(case):
+def makeSwitchHandler(switch_, autoescape, scope):
+    expr = makeExpressionHandler(switch_.expr, scope)
+
+    cases = []
+    default = None
+    for case in switch_.cases:
         if isinstance(case, tuple):
-            return (case[0], makeCommandHandler(case[1], autoescape))
-        if isinstance(case, CodeBlock):
-            return makeCommandHandler(case, autoescape)
+            cases.append((case[0], makeCommandHandler(case[1], autoescape, scope)))
+        elif isinstance(case, CodeBlock):
+            default = makeCommandHandler(case, autoescape, scope)
+            break
         else:
             raise Exception('Bad of case')
-    
-    cases = [makeCaseItem(item) for item in switch_.cases]
 
-    def switchHandler(env, out, **kwargs):
-        value = expr(env)
-        
-        for case in cases:
-            if isinstance(case, tuple):
-                if value in case[0]:
-                    case[1](env, out, **kwargs)
-                    return
-            else:
-                case(env, out, **kwargs)
+    table = makeSwitchTable(cases)
+    if table is not None:
+        def switchHandler(frame, out, ttable):
+            value = expr(frame)
+            try:
+                body = table.get(value, default)
+            except TypeError:
+                # an unhashable value equals none of the literals
+                body = default
+
+            if body:
+                body(frame, out, ttable)
+
+        return switchHandler
+
+    def switchHandler(frame, out, ttable):
+        value = expr(frame)
+
+        for values, body in cases:
+            if value in values:
+                body(frame, out, ttable)
+                return
+
+        if default:
+            default(frame, out, ttable)
 
     return switchHandler
 
-def makeForeachHandler(foreach_, autoescape):
+def makeForeachHandler(foreach_, autoescape, scope):
     varName = foreach_.var.name
-    exprHandler = makeExpressionHandler(foreach_.expr)
-    bodyHandler = makeCommandHandler(foreach_.code, autoescape)
+    exprHandler = makeExpressionHandler(foreach_.expr, scope)
 
     emptyHandler = None
     if foreach_.ifEmptyCode:
-        emptyHandler = makeCommandHandler(foreach_.ifEmptyCode, autoescape)
+        emptyHandler = makeCommandHandler(foreach_.ifEmptyCode, autoescape, scope)
 
-    def foreachHandler(env, out, **kwargs):
-        r = exprHandler(env)
+    slot, counter, sequence = slots = (scope.allocate(), scope.allocate(), scope.allocate())
+    scope.bind(varName, slots)
+    bodyHandler = makeCommandHandler(foreach_.code, autoescape, scope)
+    scope.unbind(varName)
+
+    def foreachHandler(frame, out, ttable):
+        r = exprHandler(frame)
 
         if r:
-            extra = { loopSequenceName(varName): r }
-            counterName = loopVariableCounterName(varName)
+            frame[sequence] = r
 
             for i, value in enumerate(r):
-                extra[varName] = value
-                extra[counterName] = i
-                bodyHandler(Env(env, extra), out, **kwargs)
+                frame[slot] = value
+                frame[counter] = i
+                bodyHandler(frame, out, ttable)
         elif emptyHandler:
-            emptyHandler(env, out, **kwargs)
+            emptyHandler(frame, out, ttable)
 
     return foreachHandler
 
-def makeForHandler(for_, autoescape):
+def makeForHandler(for_, autoescape, scope):
     varName = for_.var.name
-    range_ = [makeExpressionHandler(item) for item in for_.range]
-    bodyHandler = makeCommandHandler(for_.code, autoescape)
+    range_ = [makeExpressionHandler(item, scope) for item in for_.range]
+
+    slot = scope.allocate()
+    scope.bind(varName, (slot, None, None))
+    bodyHandler = makeCommandHandler(for_.code, autoescape, scope)
+    scope.unbind(varName)
+
+    if len(range_) == 1:
+        end = range_[0]
+        def rangeHandler(frame):
+            return xrange(end(frame))
+    elif len(range_) == 2:
+        start, end = range_
+        def rangeHandler(frame):
+            return xrange(start(frame), end(frame))
+    else:
+        start, end, step = range_
+        def rangeHandler(frame):
+            return xrange(start(frame), end(frame), step(frame))
 
-    def forHandler(env, out, **kwargs):
-        for i in xrange(*[item(env) for item in range_]):
-            bodyHandler(Env(env, {varName: i}), out, **kwargs)
+    def forHandler(frame, out, ttable):
+        for i in rangeHandler(frame):
+            frame[slot] = i
+            bodyHandler(frame, out, ttable)
 
     return forHandler
 
-def makeCallHandler(call_, autoescape):
-    templateNameHandler = makeExpressionHandler(call_.name)
-    
-    if call_.data == True:
-        def dataHandler(env):
-            return env
+def makeCallEnv(data, params):
+    # keep the chain one level deep, whatever the depth of data="all" calls
+    if isinstance(data, Env):
+        extra = dict(data.extra)
+        for name, value in params.iteritems():
+            if value != None:
+                extra[name] = value
+        return Env(data.base, extra)
+    else:
+        return Env(data, params)
+
+def makeCallHandler(call_, autoescape, scope):
+    templateNameHandler = makeExpressionHandler(call_.name, scope)
+
+    locals_ = scope.locals()
+
+    if call_.data == True and locals_:
+        # the callee sees the loop variables of the caller
+        def dataHandler(frame):
+            extra = {}
+            for name, slots in locals_:
+                for slot in slots:
+                    value = frame[slot]
+                    if value is not None:
+                        extra[name] = value
+                        break
+            return makeCallEnv(frame[DATA_SLOT], extra)
+    elif call_.data == True:
+        def dataHandler(frame):
+            return frame[DATA_SLOT]
     elif call_.data == None:
-        def dataHandler(env):
+        def dataHandler(frame):
             return {}
     else:
-        dataHandler = makeExpressionHandler(call_.data)
+        dataHandler = makeExpressionHandler(call_.data, scope)
 
-    def makeParamHandler(param):                
+    def makeParamHandler(param):
         if isinstance(param[1], CodeBlock):
-            commandHandler = makeCommandHandler(param[1], autoescape)
-            def paramHandler(env, ttable):
+            commandHandler = makeCommandHandler(param[1], autoescape, scope)
+            def paramHandler(frame, ttable):
                 out = StringIO()
-                commandHandler(env, out, ttable=ttable)
+                commandHandler(frame, out, ttable)
                 return out.getvalue()
         else:
-            exprHandler = makeExpressionHandler(param[1])
-            def paramHandler(env, ttable):
-                return exprHandler(env)
+            exprHandler = makeExpressionHandler(param[1], scope)
+            def paramHandler(frame, ttable):
+                return exprHandler(frame)
 
         return (param[0], paramHandler)
 
     params = [makeParamHandler(param) for param in call_.params]
 
-    def callHandler(env, out, ttable, **kwargs):
-        newEnv = Env(dataHandler(env), {})
-
-        for name, handler in params:
-            newEnv.extra[name] = handler(env, ttable)
-            
-        ttable.callTemplate(templateNameHandler(env), newEnv, out)
+    if params:
+        def envHandler(frame, ttable):
+            extra = {}
+            for name, handler in params:
+                extra[name] = handler(frame, ttable)
+            return makeCallEnv(dataHandler(frame), extra)
+    else:
+        def envHandler(frame, ttable):
+            return dataHandler(frame)
+
+    link = scope.link(call_.name) if isText(call_.name) else None
+
+    if link:
+        # rendered through another table, a child of scope.ttable may
+        # override the callee: only the owner of the link can use it
+        name = call_.name
+        owner = scope.ttable
+        def callHandler(frame, out, ttable):
+            template = link.template
+            if template and (ttable is owner or ttable.ttable is owner):
+                template(envHandler(frame, ttable), out, ttable)
+            else:
+                ttable.callTemplate(name, envHandler(frame, ttable), out)
+    else:
+        def callHandler(frame, out, ttable):
+            ttable.callTemplate(templateNameHandler(frame), envHandler(frame, ttable), out)
 
     return callHandler
-    
-def makeCommandHandler(obj, autoescape):
+
+def makeCacheHandler(cache_, autoescape, scope):
+    keyHandler = makeExpressionHandler(cache_.key, scope)
+    ttlHandler = makeExpressionHandler(cache_.ttl, scope) if cache_.ttl is not None else None
+    body = makeCodeBlockHandler(cache_.code, autoescape, scope)
+    fragment = fragmentId(cache_, autoescape)
+
+    def cacheHandler(frame, out, ttable):
+        key = fragmentKey(fragment, keyHandler(frame))
+        if key is None:
+            return body(frame, out, ttable)
+
+        store = ttable.fragmentCache
+        text = store.get(key)
+        if text is None:
+            tee = TeeWriter(out)
+            body(frame, tee, ttable)
+            store.set(key, tee.getvalue(), ttlHandler(frame) if ttlHandler else 0)
+        else:
+            out.write(text)
+
+    return cacheHandler
+
+def flushHandler(frame, out, ttable):
+    out.flush()
+
+def makeCommandHandler(obj, autoescape, scope):
+    handler = makeNodeHandler(obj, autoescape, scope)
+
+    line = getattr(obj, 'line', None)
+    if scope.profiler and handler and line:
+        handler = scope.profiler.wrap(handler, '%s:%d' % (scope.source, line))
+
+    return handler
+
+def makeNodeHandler(obj, autoescape, scope):
     if isinstance(obj, CodeBlock):
-        return makeCodeBlockHandler(obj, autoescape)
+        return makeCodeBlockHandler(obj, autoescape, scope)
     elif isinstance(obj, LiteralTag):
-        return makeLiteralHandler(obj, autoescape)
+        return makeLiteralHandler(obj, autoescape, scope)
     elif isinstance(obj, Print):
-        return makePrintHandler(obj, autoescape)
+        return makePrintHandler(obj, autoescape, scope)
     elif isinstance(obj, If):
-        return makeIfHandler(obj, autoescape)
+        return makeIfHandler(obj, autoescape, scope)
     elif isinstance(obj, Switch):
-        return makeSwitchHandler(obj, autoescape)
+        return makeSwitchHandler(obj, autoescape, scope)
     elif isinstance(obj, Foreach):
-        return makeForeachHandler(obj, autoescape)
+        return makeForeachHandler(obj, autoescape, scope)
     elif isinstance(obj, For):
-        return makeForHandler(obj, autoescape)
+        return makeForHandler(obj, autoescape, scope)
     elif isinstance(obj, Call):
-        return makeCallHandler(obj, autoescape)
+        return makeCallHandler(obj, autoescape, scope)
+    elif isinstance(obj, Cache):
+        return makeCacheHandler(obj, autoescape, scope)
+    elif isinstance(obj, Flush):
+        return flushHandler
     elif isText(obj):
-        def singleStringHandler(env, out, **kwargs):
-            writeTemplateAtom(obj, out)
+        def singleStringHandler(frame, out, ttable):
+            out.write(obj)
         return singleStringHandler
     else:
         return None
 
+####################################################################################################
+# data analysis
+####################################################################################################
+
+# key of hasData() in the set of variables read by a template
+HAS_DATA = '%hasData'
+
+def collectExpressionReads(expr, reads):
+    if isinstance(expr, Variable):
+        # also a loop variable: it is looked up in the data when null
+        reads.add(expr.name)
+    elif isinstance(expr, DotRef):
+        collectExpressionReads(expr.expr, reads)
+    elif isinstance(expr, ARef):
+        collectExpressionReads(expr.expr, reads)
+        collectExpressionReads(expr.position, reads)
+    elif isinstance(expr, Operator):
+        for arg in expr.args:
+            collectExpressionReads(arg, reads)
+    elif isinstance(expr, Funcall):
+        if expr.name == 'randomInt':
+            raise Uncacheable()
+        elif expr.name == 'hasData':
+            reads.add(HAS_DATA)
+        elif expr.name not in ('index', 'isFirst', 'isLast'):
+            for arg in expr.args:
+                collectExpressionReads(arg, reads)
+
+def collectCommandReads(cmd, reads, templates, memo):
+    if isinstance(cmd, CodeBlock):
+        for item in cmd:
+            collectCommandReads(item, reads, templates, memo)
+    elif isinstance(cmd, Print):
+        collectExpressionReads(cmd.expr, reads)
+    elif isinstance(cmd, If):
+        for cond, block in cmd:
+            collectExpressionReads(cond, reads)
+            collectCommandReads(block, reads, templates, memo)
+    elif isinstance(cmd, Switch):
+        collectExpressionReads(cmd.expr, reads)
+        for case in cmd.cases:
+            if isinstance(case, tuple):
+                case = case[1]
+            collectCommandReads(case, reads, templates, memo)
+    elif isinstance(cmd, Foreach):
+        collectExpressionReads(cmd.expr, reads)
+        collectCommandReads(cmd.code, reads, templates, memo)
+        if cmd.ifEmptyCode:
+            collectCommandReads(cmd.ifEmptyCode, reads, templates, memo)
+    elif isinstance(cmd, For):
+        for item in cmd.range:
+            collectExpressionReads(item, reads)
+        collectCommandReads(cmd.code, reads, templates, memo)
+    elif isinstance(cmd, Cache):
+        collectExpressionReads(cmd.key, reads)
+        collectCommandReads(cmd.code, reads, templates, memo)
+    elif isinstance(cmd, Call):
+        if not (isText(cmd.name) and cmd.name in templates):
+            # the callee is computed or lives in another namespace
+            raise Uncacheable()
+
+        calleeReads = templateReads(templates[cmd.name], templates, memo)
+        if calleeReads is None:
+            raise Uncacheable()
+
+        if cmd.data == True:
+            reads.update(calleeReads)
+        elif cmd.data != None:
+            collectExpressionReads(cmd.data, reads)
+
+        for name, value in cmd.params:
+            if isinstance(value, CodeBlock):
+                collectCommandReads(value, reads, templates, memo)
+            else:
+                collectExpressionReads(value, reads)
+
+def templateReads(tmpl, templates, memo):
+    """Sorted names of the data variables that the output of tmpl depends on,
+    or None if it can not be cached: it uses randomInt, is recursive or calls a
+    template that is computed, unknown or uncacheable itself."""
+
+    if tmpl.name in memo:
+        if memo[tmpl.name] is Uncacheable:
+            # still collecting: a recursive call
+            raise Uncacheable()
+        return memo[tmpl.name]
+
+    memo[tmpl.name] = Uncacheable
+    reads = set()
+    try:
+        collectCommandReads(tmpl.code, reads, templates, memo)
+        memo[tmpl.name] = tuple(sorted(reads))
+    except Uncacheable:
+        memo[tmpl.name] = None
+
+    return memo[tmpl.name]
+
+def makeMemoKey(name, env, reads):
+    # the data does not change during a render: compare containers, objects and
+    # futures by identity, values holds them so their ids are not reused
+    key = [name]
+    values = []
+    for var in reads:
+        if var == HAS_DATA:
+            key.append(hasData(env))
+        else:
+            value = peekVariable(env, var)
+            if value is None or isinstance(value, (basestring, Number)):
+                key.append((value.__class__, value))
+            else:
+                key.append((object, id(value)))
+                values.append(value)
+    return tuple(key), values
+
+def makeCacheKey(name, env, reads):
+    key = [name]
+    for var in reads:
+        if var == HAS_DATA:
+            key.append(hasData(env))
+        else:
+            key.append(freezeValue(fetchVariable(env, var)))
+    return tuple(key)
+
 ####################################################################################################
 # namespace/template
 ####################################################################################################
-    
-def makeTemplateHandler(tmpl):
+
+def makeStaticTemplateHandler(text):
+    def staticTemplateHandler(env, out, ttable):
+        if out:
+            out.write(text)
+        else:
+            return text
+
+    return staticTemplateHandler
+
+def makeTemplateHandler(tmpl, reads=None, cache=False, memoize=False, ttable=None, source=None):
     name = tmpl.name
     props = tmpl.props
 
-    codeBlockHandler = makeCodeBlockHandler(tmpl.code, not(props.get('autoescape') == False))
+    # a template without dynamic content is its text, there is nothing to cache
+    text = blockText(tmpl.code)
+    if text is not None:
+        return makeStaticTemplateHandler(text)
+
+    scope = Scope(ttable, source)
+    codeBlockHandler = makeCodeBlockHandler(tmpl.code, not(props.get('autoescape') == False), scope)
+    size = scope.size
 
     def templateHandler(env, out, ttable):
+        frame = [None] * size
+        frame[DATA_SLOT] = env
+
         if out:
-            codeBlockHandler(env, out, ttable=ttable)
+            codeBlockHandler(frame, out, ttable)
         else:
             out = StringIO()
-            codeBlockHandler(env, out, ttable=ttable)
+            codeBlockHandler(frame, out, ttable)
             return out.getvalue()
 
-    return templateHandler
+    if reads is None:
+        return templateHandler
+
+    if cache:
+        templateHandler = makeCachedTemplateHandler(name, reads, templateHandler)
+
+    if not memoize:
+        return templateHandler
+
+    def memoTemplateHandler(env, out, ttable):
+        memo = ttable.callMemo
+        if memo is None:
+            return templateHandler(env, out, ttable)
+
+        key, values = makeMemoKey(name, env, reads)
+        entry = memo.get(key)
+
+        if entry is not None:
+            text = entry[0]
+        elif out:
+            # keep streaming to out while recording the output
+            tee = TeeWriter(out)
+            templateHandler(env, tee, ttable)
+            memo[key] = (tee.getvalue(), values)
+            return
+        else:
+            text = templateHandler(env, None, ttable)
+            memo[key] = (text, values)
+
+        if out:
+            out.write(text)
+        else:
+            return text
+
+    return memoTemplateHandler
+
+def makeCachedTemplateHandler(name, reads, templateHandler):
+    def cachedTemplateHandler(env, out, ttable):
+        cache = ttable.renderCache
+
+        try:
+            key = makeCacheKey(name, env, reads)
+        except Uncacheable:
+            cache.countUncacheable()
+            return templateHandler(env, out, ttable)
+
+        text = cache.get(key)
+        if text is None:
+            text = templateHandler(env, None, ttable)
+            cache.put(key, text)
+
+        if out:
+            out.write(text)
+        else:
+            return text
+
+    return cachedTemplateHandler
+
+def makeTemplateHandlers(nameSpace, ttable, source):
+    templates = dict((tmpl.name, tmpl) for tmpl in nameSpace.templates)
+    memo = dict()
+    handlers = []
 
-def updateTTable(nameSpace, ttable):
     for tmpl in nameSpace.templates:
-        ttable.registerTempalte(tmpl.name,
-                                makeTemplateHandler(tmpl))
+        cache = tmpl.props.get('cache')
+        cache = cache or (ttable.cacheTemplates and cache != False)
+
+        reads = None
+        if cache or ttable.memoizeCalls:
+            reads = templateReads(tmpl, templates, memo)
+
+        handlers.append(makeTemplateHandler(tmpl, reads, cache, ttable.memoizeCalls, ttable, source))
+
+    return handlers
+
+def makeInlinedTemplateHandler(owner, inlined, plain):
+    # a child table may override the callees inlined for the owner
+    def inlinedTemplateHandler(env, out, ttable):
+        if ttable is owner or ttable.ttable is owner:
+            return inlined(env, out, ttable)
+        else:
+            return plain(env, out, ttable)
+
+    return inlinedTemplateHandler
+
+def updateTTable(nameSpace, ttable):
+    source = getattr(nameSpace, 'path', None) or nameSpace.name
+    handlers = makeTemplateHandlers(optimizeNamespace(nameSpace, ttable.inlineCalls), ttable, source)
+
+    if ttable.inlineCalls:
+        plain = makeTemplateHandlers(optimizeNamespace(nameSpace, False), ttable, source)
+        handlers = [makeInlinedTemplateHandler(ttable, inlined, handler)
+                    for inlined, handler in zip(handlers, plain)]
+
+    for tmpl, handler in zip(nameSpace.templates, handlers):
+        if ttable.profiler:
+            handler = ttable.profiler.wrap(handler, '%s %s:%s' % (tmpl.name, source, getattr(tmpl, 'line', '?')))
+
+        ttable.registerTempalte(tmpl.name, handler)
 
-def makeTTable(nameSpace):
-    ttable = TTable()
+def makeTTable(nameSpace, cacheTemplates=False, memoizeCalls=False, instrumentation=None, profiler=None,
+               inlineCalls=False):
+    ttable = TTable(cacheTemplates=cacheTemplates, memoizeCalls=memoizeCalls,
+                    instrumentation=instrumentation, profiler=profiler, inlineCalls=inlineCalls)
     updateTTable(nameSpace, ttable)
     return ttable
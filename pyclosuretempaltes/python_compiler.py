@@ -0,0 +1,643 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# Compiles namespaces to plain Python source: one function per template
+# with the loops, conditionals and writes inlined. The generated modules
+# use the runtime helpers of python_backend and register their templates
+# in an ordinary TTable.
+#
+#     python -m pyclosuretempaltes.python_compiler SOURCE_DIR OUTPUT_PACKAGE_DIR
+
+import re
+import keyword
+import os
+import os.path
+import argparse
+import compileall
+from StringIO import StringIO
+from contextlib import closing
+
+from parser import *
+from parser.batch import findFiles
+from python_backend import TTable, fragmentId
+from optimizer import optimizeNamespace
+
+
+####################################################################################################
+# helpers
+####################################################################################################
+
+class LoopVar(object):
+    def __init__(self, name, counter=None, sequence=None):
+        self.name = name
+        self.counter = counter
+        self.sequence = sequence
+        # the loop variable of the same name that this one shadows
+        self.outer = None
+
+class Context(object):
+    def __init__(self, autoescape, prefix='template'):
+        self.autoescape = autoescape
+        self.prefix = prefix
+        self.localVars = dict()
+        self.dataVars = dict()
+        # module level (name, value) pairs written before the template function
+        self.constants = []
+        self.symbolCounter = 0
+        self.out = 'out'
+        self.write = 'write'
+
+    def gensym(self, prefix):
+        self.symbolCounter += 1
+        return '%s%d' % (prefix, self.symbolCounter)
+
+    def constant(self, prefix, value):
+        # no template function starts with an underscore
+        name = '_%s_%s' % (self.prefix, self.gensym(prefix))
+        self.constants.append((name, value))
+        return name
+
+class LocalVar:
+    def __init__(self, name, var, context):
+        self.name = name
+        self.var = var
+        self.context = context
+
+    def __enter__(self):
+        self.saved = self.context.localVars.get(self.name)
+        self.var.outer = self.saved
+        self.context.localVars[self.name] = self.var
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.saved:
+            self.context.localVars[self.name] = self.saved
+        else:
+            del self.context.localVars[self.name]
+
+class Output:
+    def __init__(self, out, write, context):
+        self.out = out
+        self.write = write
+        self.context = context
+
+    def __enter__(self):
+        self.saved = (self.context.out, self.context.write)
+        self.context.out = self.out
+        self.context.write = self.write
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.context.out, self.context.write = self.saved
+
+def py(value):
+    return repr(value)
+
+def identifier(name):
+    return re.sub('[^A-Za-z0-9_]', '_', name)
+
+####################################################################################################
+# expressions
+####################################################################################################
+
+BINARY_OPERATORS = frozenset(['-', '*', '/', '%', '<=', '>=', '<', '>', '==', '!=', 'and', 'or'])
+
+FUNCTIONS = { 'length': 'len',
+              'keys': 'dict.keys',
+              'round': 'ctRound',
+              'floor': 'math.floor',
+              'ceiling': 'math.ceil',
+              'min': 'min',
+              'max': 'max' }
+
+def compileLocal(local, fallback):
+    # a loop variable that is null falls through to the outer ones, then to fallback
+    if local is None:
+        return fallback
+    return '(%s if %s is not None else %s)' % (local.name, local.name, compileLocal(local.outer, fallback))
+
+def compileVariable(var, context):
+    local = context.localVars.get(var.name)
+    if local:
+        # fetched on demand: most loop variables are never null
+        return compileLocal(local, 'fetchVariable(env, %s)' % py(var.name))
+
+    # data variables are looked up once, at the start of the template
+    if var.name not in context.dataVars:
+        context.dataVars[var.name] = 'd_%s' % identifier(var.name)
+    return context.dataVars[var.name]
+
+def compileOperator(op, context):
+    name = op.op
+    args = [compileExpression(arg, context) for arg in op.args]
+
+    if len(args) == 1:
+        if name == 'neg':
+            return '(-%s)' % args[0]
+        elif name == 'not':
+            return '(not %s)' % args[0]
+        else:
+            raise Exception("Unknow unary operator: %s" % name)
+    elif len(args) == 2:
+        if name == '+':
+            return 'genericAdd(%s, %s)' % (args[0], args[1])
+        elif name in BINARY_OPERATORS:
+            return '(%s %s %s)' % (args[0], name, args[1])
+        else:
+            raise Exception('Unknow binary operator: %s' % name)
+    elif len(args) == 3:
+        if name == 'if':
+            return '(%s if %s else %s)' % (args[1], args[0], args[2])
+        else:
+            raise Exception('Unknow ternary operator: %s' % name)
+    else:
+        raise Exception('Bad operator arguments')
+
+def findLoopVar(arg, context):
+    local = context.localVars.get(arg.name)
+    if local and local.counter:
+        return local
+    else:
+        return None
+
+def compileFuncall(expr, context):
+    name = expr.name
+
+    if name in ('index', 'isFirst', 'isLast') and not findLoopVar(expr.args[0], context):
+        # fails when evaluated, as in the interpreter
+        return 'notForeachVariable(%s)' % py(expr.args[0].name)
+
+    if name == 'hasData':
+        return 'hasData(env)'
+    elif name == 'index':
+        return '(%s + 1)' % findLoopVar(expr.args[0], context).counter
+    elif name == 'isFirst':
+        return '(%s == 0)' % findLoopVar(expr.args[0], context).counter
+    elif name == 'isLast':
+        loopVar = findLoopVar(expr.args[0], context)
+        return '(%s == (len(%s) - 1))' % (loopVar.counter, loopVar.sequence)
+
+    args = [compileExpression(arg, context) for arg in expr.args]
+
+    if name == 'randomInt':
+        return 'randint(0, %s - 1)' % args[0]
+    elif name in FUNCTIONS:
+        return '%s(%s)' % (FUNCTIONS[name], ', '.join(args))
+    else:
+        raise Exception('Unknow function: %s' % name)
+
+def compileExpression(expr, context):
+    if isinstance(expr, Variable):
+        return compileVariable(expr, context)
+    elif isinstance(expr, DotRef):
+        return 'fetchProperty(%s, %s)' % (compileExpression(expr.expr, context), py(expr.name))
+    elif isinstance(expr, ARef):
+        return '%s[%s]' % (compileExpression(expr.expr, context), compileExpression(expr.position, context))
+    elif isinstance(expr, Operator):
+        return compileOperator(expr, context)
+    elif isinstance(expr, Funcall):
+        return compileFuncall(expr, context)
+    else:
+        return py(expr)
+
+####################################################################################################
+# commands
+####################################################################################################
+
+def writeLine(line, indentLevel, out):
+    out.write(' ' * 4 * indentLevel)
+    out.write(line)
+    out.write('\n')
+
+def writeBlock(block, context, indentLevel, out):
+    with closing(StringIO()) as body:
+        writeCommand(block, context, indentLevel, body)
+        code = body.getvalue()
+
+    out.write(code or (' ' * 4 * indentLevel + 'pass\n'))
+
+# CodeBlock
+
+def writeCodeBlock(block, context, indentLevel, out):
+    for cmd in filter(None, block):
+        if isinstance(cmd, Substition):
+            cmd = cmd.char
+        writeCommand(cmd, context, indentLevel, out)
+
+# Text and Literal
+
+def writeText(text, context, indentLevel, out):
+    if text:
+        writeLine('%s(%s)' % (context.write, py(text)), indentLevel, out)
+
+# Print
+
+def writePrint(print_, context, indentLevel, out):
+    directives = print_.directives
+    expr = compileExpression(print_.expr, context)
+
+    if directives.get('escapeHtml'):
+        escape = 'escapeHtml'
+    elif directives.get('id'):
+        escape = 'encodeUriComponent'
+    elif directives.get('escapeUri'):
+        escape = 'encodeUri'
+    elif context.autoescape and (directives.get('noAutoescape') != True):
+        escape = 'escapeHtml'
+    else:
+        escape = None
+
+    if escape:
+        writeLine('%s(%s(%s))' % (context.write, escape, expr), indentLevel, out)
+    else:
+        writeLine('writeTemplateAtom(%s, %s)' % (expr, context.out), indentLevel, out)
+
+# If
+
+def writeIf(if_, context, indentLevel, out):
+    first = True
+    for cond, block in if_:
+        if first:
+            writeLine('if %s:' % compileExpression(cond, context), indentLevel, out)
+            first = False
+        elif cond == True:
+            writeLine('else:', indentLevel, out)
+        else:
+            writeLine('elif %s:' % compileExpression(cond, context), indentLevel, out)
+
+        writeBlock(block, context, indentLevel + 1, out)
+
+# Switch
+
+# switches with this many cases look the case up in a dict
+SWITCH_DISPATCH_CASES = 8
+
+def makeSwitchIndex(cases):
+    # value -> number of the first case that lists it, or None if a value is
+    # not hashable
+    index = dict()
+    try:
+        for number, case in enumerate(cases):
+            for item in case[0]:
+                index.setdefault(item, number + 1)
+    except TypeError:
+        return None
+
+    return index
+
+def writeCaseTree(cases, number, context, indentLevel, out):
+    # binary search on the case number, so a case is found in log2(n) tests
+    if len(cases) == 1:
+        writeBlock(cases[0][1], context, indentLevel, out)
+    else:
+        middle = len(cases) // 2
+        writeLine('if %s < %d:' % (number, middle + cases[0][0]), indentLevel, out)
+        writeCaseTree(cases[:middle], number, context, indentLevel + 1, out)
+        writeLine('else:', indentLevel, out)
+        writeCaseTree(cases[middle:], number, context, indentLevel + 1, out)
+
+def writeSwitchDispatch(value, cases, default, index, context, indentLevel, out):
+    table = context.constant('switch', index)
+    number = context.gensym('case')
+
+    writeLine('try:', indentLevel, out)
+    writeLine('%s = %s.get(%s, 0)' % (number, table, value), indentLevel + 1, out)
+    writeLine('except TypeError:', indentLevel, out)
+    writeLine('%s = 0' % number, indentLevel + 1, out)
+
+    writeLine('if %s:' % number, indentLevel, out)
+    writeCaseTree([(i + 1, case[1]) for i, case in enumerate(cases)], number, context, indentLevel + 1, out)
+    if default:
+        writeLine('else:', indentLevel, out)
+        writeBlock(default, context, indentLevel + 1, out)
+
+def writeSwitch(switch_, context, indentLevel, out):
+    value = context.gensym('value')
+    writeLine('%s = %s' % (value, compileExpression(switch_.expr, context)), indentLevel, out)
+
+    cases = [case for case in switch_.cases if isinstance(case, tuple)]
+    if len(cases) >= SWITCH_DISPATCH_CASES:
+        index = makeSwitchIndex(cases)
+        if index is not None:
+            default = [case for case in switch_.cases if not isinstance(case, tuple)]
+            writeSwitchDispatch(value, cases, default[0] if default else None, index,
+                                context, indentLevel, out)
+            return
+
+    first = True
+    for case in switch_.cases:
+        if isinstance(case, tuple):
+            values = ', '.join([py(item) for item in case[0]])
+            writeLine('%s %s in (%s,):' % ('if' if first else 'elif', value, values), indentLevel, out)
+            writeBlock(case[1], context, indentLevel + 1, out)
+            first = False
+        elif first:
+            writeCommand(case, context, indentLevel, out)
+        else:
+            writeLine('else:', indentLevel, out)
+            writeBlock(case, context, indentLevel + 1, out)
+
+# Foreach
+
+def writeForeach(foreach_, context, indentLevel, out):
+    varName = foreach_.var.name
+    loopVar = LoopVar(context.gensym('v_%s_' % varName),
+                      context.gensym('i_%s_' % varName),
+                      context.gensym('s_%s_' % varName))
+
+    writeLine('%s = %s' % (loopVar.sequence, compileExpression(foreach_.expr, context)), indentLevel, out)
+    writeLine('if %s:' % loopVar.sequence, indentLevel, out)
+    writeLine('for %s, %s in enumerate(%s):' % (loopVar.counter, loopVar.name, loopVar.sequence),
+              indentLevel + 1, out)
+
+    with LocalVar(varName, loopVar, context):
+        writeBlock(foreach_.code, context, indentLevel + 2, out)
+
+    if foreach_.ifEmptyCode:
+        writeLine('else:', indentLevel, out)
+        writeBlock(foreach_.ifEmptyCode, context, indentLevel + 1, out)
+
+# For
+
+def writeFor(for_, context, indentLevel, out):
+    varName = for_.var.name
+    loopVar = LoopVar(context.gensym('v_%s_' % varName))
+
+    range_ = ', '.join([compileExpression(item, context) for item in for_.range])
+    writeLine('for %s in xrange(%s):' % (loopVar.name, range_), indentLevel, out)
+
+    with LocalVar(varName, loopVar, context):
+        writeBlock(for_.code, context, indentLevel + 1, out)
+
+# Call
+
+def writeCall(call_, context, indentLevel, out):
+    if call_.data == True and context.localVars:
+        # the callee sees the loop variables of the caller
+        data = 'Env(env, {%s})' % ', '.join(['%s: %s' % (py(name), compileLocal(local, 'None'))
+                                              for name, local in sorted(context.localVars.items())])
+    elif call_.data == True:
+        data = 'env'
+    elif call_.data == None:
+        data = '{}'
+    else:
+        data = compileExpression(call_.data, context)
+
+    if call_.params:
+        dataVar = context.gensym('data')
+        writeLine('%s = %s' % (dataVar, data), indentLevel, out)
+
+        params = []
+        for name, value in call_.params:
+            if isinstance(value, CodeBlock):
+                buf = context.gensym('buf')
+                writeLine('%s = StringIO()' % buf, indentLevel, out)
+                writeLine('%s_write = %s.write' % (buf, buf), indentLevel, out)
+                with Output(buf, buf + '_write', context):
+                    writeCommand(value, context, indentLevel, out)
+                params.append('%s: %s.getvalue()' % (py(name), buf))
+            else:
+                param = context.gensym('param')
+                writeLine('%s = %s' % (param, compileExpression(value, context)), indentLevel, out)
+                params.append('%s: %s' % (py(name), param))
+
+        data = 'Env(%s, {%s})' % (dataVar, ', '.join(params))
+
+    if isText(call_.name):
+        name = py(call_.name)
+    else:
+        name = compileExpression(call_.name, context)
+
+    writeLine('ttable.callTemplate(%s, %s, %s)' % (name, data, context.out), indentLevel, out)
+
+# Cache
+
+def writeCache(cache_, context, indentLevel, out):
+    key = context.gensym('key')
+    text = context.gensym('text')
+    tee = context.gensym('tee')
+
+    fragment = fragmentId(cache_, context.autoescape)
+    writeLine('%s = fragmentKey(%s, %s)' % (key, py(fragment), compileExpression(cache_.key, context)),
+              indentLevel, out)
+    writeLine('%s = %s and ttable.fragmentCache.get(%s)' % (text, key, key), indentLevel, out)
+
+    writeLine('if %s is None:' % text, indentLevel, out)
+    writeLine('%s = TeeWriter(%s)' % (tee, context.out), indentLevel + 1, out)
+    writeLine('%s_write = %s.write' % (tee, tee), indentLevel + 1, out)
+    with Output(tee, tee + '_write', context):
+        writeCommand(cache_.code, context, indentLevel + 1, out)
+
+    if cache_.ttl is None:
+        ttl = '0'
+    else:
+        ttl = compileExpression(cache_.ttl, context)
+
+    writeLine('if %s:' % key, indentLevel + 1, out)
+    writeLine('ttable.fragmentCache.set(%s, %s.getvalue(), %s)' % (key, tee, ttl), indentLevel + 2, out)
+    writeLine('else:', indentLevel, out)
+    writeLine('%s(%s)' % (context.write, text), indentLevel + 1, out)
+
+# Flush
+
+def writeFlush(flush_, context, indentLevel, out):
+    writeLine('%s.flush()' % context.out, indentLevel, out)
+
+# All Commands
+
+def writeCommand(cmd, context, indentLevel, out):
+    if isinstance(cmd, CodeBlock):
+        writeCodeBlock(cmd, context, indentLevel, out)
+    elif isinstance(cmd, LiteralTag):
+        writeText(cmd.text, context, indentLevel, out)
+    elif isinstance(cmd, Print):
+        writePrint(cmd, context, indentLevel, out)
+    elif isinstance(cmd, If):
+        writeIf(cmd, context, indentLevel, out)
+    elif isinstance(cmd, Switch):
+        writeSwitch(cmd, context, indentLevel, out)
+    elif isinstance(cmd, Foreach):
+        writeForeach(cmd, context, indentLevel, out)
+    elif isinstance(cmd, For):
+        writeFor(cmd, context, indentLevel, out)
+    elif isinstance(cmd, Call):
+        writeCall(cmd, context, indentLevel, out)
+    elif isinstance(cmd, Cache):
+        writeCache(cmd, context, indentLevel, out)
+    elif isinstance(cmd, Flush):
+        writeFlush(cmd, context, indentLevel, out)
+    elif isText(cmd):
+        writeText(cmd, context, indentLevel, out)
+
+####################################################################################################
+# namespace/template
+####################################################################################################
+
+HEADER = '''# -*- coding: utf-8 -*-
+# Generated by pyclosuretempaltes.python_compiler. Do not edit.
+
+from __future__ import division
+
+import math
+from random import randint
+from StringIO import StringIO
+
+from pyclosuretempaltes.python_backend import (TTable, Env, escapeHtml, encodeUri, encodeUriComponent,
+                                               fetchProperty, fetchVariable, genericAdd, ctRound, hasData,
+                                               writeTemplateAtom, TeeWriter, fragmentKey, notForeachVariable)
+'''
+
+FOOTER = '''
+def registerTemplates(ttable, supersede=False):
+    for name, template in TEMPLATES.iteritems():
+        ttable.registerTempalte(name, template, supersede)
+
+def makeTTable():
+    ttable = TTable()
+    registerTemplates(ttable)
+    return ttable
+'''
+
+def templateFunctionName(tmpl):
+    return 'template_%s' % identifier(tmpl.name)
+
+def writeTemplate(tmpl, out):
+    context = Context(not(tmpl.props.get('autoescape') == False), templateFunctionName(tmpl))
+
+    with closing(StringIO()) as body:
+        writeCommand(tmpl.code, context, 1, body)
+
+        if context.constants:
+            out.write('\n')
+        for name, value in context.constants:
+            out.write('%s = %s\n' % (name, py(value)))
+
+        out.write('\ndef %s(env, out, ttable):\n' % templateFunctionName(tmpl))
+        writeLine('write = out.write', 1, out)
+        for name, local in sorted(context.dataVars.items()):
+            writeLine('%s = fetchVariable(env, %s)' % (local, py(name)), 1, out)
+        out.write(body.getvalue())
+
+def writeNamespace(namespace, out):
+    out.write(HEADER)
+    out.write('\nNAMESPACE = %s\n' % py(namespace.name))
+
+    for tmpl in namespace.templates:
+        writeTemplate(tmpl, out)
+
+    out.write('\nTEMPLATES = {\n')
+    for tmpl in namespace.templates:
+        out.write('    %s: %s,\n' % (py(tmpl.name), templateFunctionName(tmpl)))
+    out.write('}\n')
+
+    out.write(FOOTER)
+
+def compileNamespaceToPython(namespace):
+    # no inlining: the data variables are fetched on entry, so the futures
+    # read by a callee would be resolved before the caller writes anything
+    with closing(StringIO()) as out:
+        writeNamespace(optimizeNamespace(namespace, inlineCalls=False), out)
+        return out.getvalue()
+
+def compileToPython(path):
+    return compileNamespaceToPython(parseFile(path))
+
+def updateCompiledTTable(nameSpace, ttable):
+    module = dict()
+    exec compile(compileNamespaceToPython(nameSpace), '<namespace %s>' % nameSpace.name, 'exec') in module
+    module['registerTemplates'](ttable)
+
+def makeCompiledTTable(nameSpace):
+    ttable = TTable()
+    updateCompiledTTable(nameSpace, ttable)
+    return ttable
+
+####################################################################################################
+# package
+####################################################################################################
+
+PACKAGE_TEMPLATE = '''# -*- coding: utf-8 -*-
+# Generated by pyclosuretempaltes.python_compiler. Do not edit.
+
+from pyclosuretempaltes.python_backend import TTable
+
+%(imports)s
+
+MODULES = [%(modules)s]
+
+def registerTemplates(ttable, supersede=False):
+    for module in MODULES:
+        module.registerTemplates(ttable, supersede)
+
+def makeTTable():
+    ttable = TTable()
+    registerTemplates(ttable)
+    return ttable
+'''
+
+# the names of the package that a module must not replace
+PACKAGE_NAMES = frozenset(['__init__', 'TTable', 'MODULES', 'registerTemplates', 'makeTTable'])
+
+def moduleName(root, path):
+    name = identifier(os.path.splitext(os.path.relpath(path, root))[0])
+    if not re.match('[A-Za-z_]', name):
+        name = '_' + name
+    if keyword.iskeyword(name) or name in PACKAGE_NAMES:
+        name = name + '_'
+    return name
+
+def compileDirectory(source, target, workers=None, byteCompile=True):
+    paths = findFiles(source)
+
+    modules = []
+    for path in paths:
+        module = moduleName(source, path)
+        if module in modules:
+            other = paths[modules.index(module)]
+            raise Exception('%s and %s are both compiled to the module %s' % (other, path, module))
+        modules.append(module)
+
+    namespaces = parseFiles(paths, workers=workers)
+
+    if not os.path.isdir(target):
+        os.makedirs(target)
+
+    for module, namespace in zip(modules, namespaces):
+        with open(os.path.join(target, module + '.py'), 'w') as f:
+            f.write(compileNamespaceToPython(namespace))
+
+    with open(os.path.join(target, '__init__.py'), 'w') as f:
+        f.write(PACKAGE_TEMPLATE % {
+                'imports': '\n'.join(['from . import %s' % module for module in modules]),
+                'modules': ', '.join(modules) })
+
+    if byteCompile:
+        compileall.compile_dir(target, quiet=True)
+
+    return modules
+
+####################################################################################################
+# main
+####################################################################################################
+
+if __name__ == "__main__":
+    argsParser = argparse.ArgumentParser(description='Compile a directory of .soy files to a Python package')
+    argsParser.add_argument('source')
+    argsParser.add_argument('target')
+    argsParser.add_argument('--workers', type=int, default=None)
+    argsParser.add_argument('--no-byte-compile', dest='byteCompile', action='store_false')
+    args = argsParser.parse_args()
+
+    for module in compileDirectory(args.source, args.target, args.workers, args.byteCompile):
+        print '%s.%s' % (os.path.basename(os.path.normpath(args.target)), module)
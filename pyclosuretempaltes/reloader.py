@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+# Hot reload of a directory of templates. The changed files are re-parsed,
+# and a new TTable is built that reuses the handlers of every template not
+# affected by the change. The new TTable then replaces the current one in
+# one assignment. A published TTable is never modified again, so a render
+# that is in progress finishes with the templates it started with.
+#
+#     reloader = Reloader('templates/')
+#     reloader.start()
+#     reloader.callTemplate('page', env)
+
+import os
+import time
+import threading
+
+from parser import *
+from parser.batch import findFiles, parseFiles
+from python_backend import TTable, updateTTable
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+####################################################################################################
+# helpers
+####################################################################################################
+
+def collectStaticCalls(obj, calls):
+    if isinstance(obj, Call) and isText(obj.name):
+        calls.add(obj.name)
+
+    if isinstance(obj, (list, tuple)):
+        for item in obj:
+            collectStaticCalls(item, calls)
+
+def staticCalls(namespace):
+    """Names of the templates that namespace calls by a static name"""
+
+    calls = set()
+    collectStaticCalls(namespace.templates, calls)
+    return calls
+
+def fileMTime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+####################################################################################################
+# reloader
+####################################################################################################
+
+class Reloader(object):
+    def __init__(self, root, interval=1.0, inotify=False, parser=None, cache=None, **options):
+        """options are passed to the constructor of every TTable. With inotify
+        and pyinotify installed, changes are noticed without waiting for the
+        next poll."""
+
+        self.root = root
+        self.interval = interval
+        self.inotify = inotify
+        self.parser = parser
+        self.cache = cache
+        self.options = options
+
+        self.namespaces = dict()
+        self.mtimes = dict()
+        # the mtimes of the last failed reload, not retried until a file changes
+        self.failedMTimes = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.notifier = None
+
+        self.reloads = 0
+        self.errors = 0
+        self.lastError = None
+        self.lastFiles = 0
+        self.lastTemplates = 0
+        self.lastParseSeconds = 0.0
+        self.lastBuildSeconds = 0.0
+        self.lastReloadSeconds = 0.0
+        self.lastLatency = 0.0
+        self.maxReloadSeconds = 0.0
+        self.totalReloadSeconds = 0.0
+
+        paths = findFiles(root)
+        for path in paths:
+            self.mtimes[path] = fileMTime(path)
+
+        for path, namespace in zip(paths, parseFiles(paths, parser=parser, cache=cache)):
+            self.namespaces[path] = namespace
+
+        self.ttable = self.makeTTable(self.namespaces, self.namespaces.keys(), None)
+
+    def callTemplate(self, name, env, out=None):
+        return self.ttable.callTemplate(name, env, out)
+
+    def makeTTable(self, namespaces, rebuild, old):
+        """A new TTable with the handlers of the templates of the files in
+        rebuild built anew and the others taken from old"""
+
+        ttable = TTable(**self.options)
+
+        if old:
+            for path, namespace in namespaces.iteritems():
+                if path not in rebuild:
+                    for tmpl in namespace.templates:
+                        ttable.registerTempalte(tmpl.name, old.dict[tmpl.name])
+
+        for path in sorted(rebuild):
+            if path in namespaces:
+                updateTTable(namespaces[path], ttable)
+
+        return ttable
+
+    def changedFiles(self):
+        mtimes = dict((path, fileMTime(path)) for path in findFiles(self.root))
+        for path in self.mtimes:
+            mtimes.setdefault(path, None)
+
+        changed = [path for path, mtime in mtimes.iteritems() if mtime != self.mtimes.get(path)]
+        changed.sort()
+        return changed, mtimes
+
+    def affectedFiles(self, changed, namespaces):
+        # the handlers of the callers of a changed template are linked to its
+        # old version: rebuild them too, up to the callers of the callers
+        names = set()
+        for path in changed:
+            for nameSpace in (self.namespaces.get(path), namespaces.get(path)):
+                if nameSpace:
+                    names.update(tmpl.name for tmpl in nameSpace.templates)
+
+        affected = set(changed)
+        while True:
+            callers = [path for path, nameSpace in namespaces.iteritems()
+                       if path not in affected and staticCalls(nameSpace) & names]
+            if not callers:
+                return affected
+
+            for path in callers:
+                affected.add(path)
+                names.update(tmpl.name for tmpl in namespaces[path].templates)
+
+    def check(self):
+        """Reloads the changed files, returns True if a new TTable was published"""
+
+        with self.lock:
+            changed, mtimes = self.changedFiles()
+            if not changed or mtimes == self.failedMTimes:
+                return False
+
+            start = time.time()
+            parsed = [path for path in changed if mtimes[path] is not None]
+            try:
+                namespaces = dict(self.namespaces)
+                for path in changed:
+                    namespaces.pop(path, None)
+                for path, namespace in zip(parsed, parseFiles(parsed, parser=self.parser,
+                                                              cache=self.cache)):
+                    namespaces[path] = namespace
+                parseSeconds = time.time() - start
+
+                affected = self.affectedFiles(changed, namespaces)
+                ttable = self.makeTTable(namespaces, affected, self.ttable)
+            except Exception as e:
+                # keep the current templates until the files change again
+                self.failedMTimes = mtimes
+                self.errors += 1
+                self.lastError = e
+                return False
+
+            self.ttable = ttable
+            self.namespaces = namespaces
+            self.mtimes = dict((path, mtime) for path, mtime in mtimes.iteritems() if mtime is not None)
+            self.failedMTimes = None
+
+            end = time.time()
+            self.reloads += 1
+            self.lastError = None
+            self.lastFiles = len(parsed)
+            self.lastTemplates = sum(len(namespaces[path].templates) for path in affected
+                                     if path in namespaces)
+            self.lastParseSeconds = parseSeconds
+            self.lastBuildSeconds = end - start - parseSeconds
+            self.lastReloadSeconds = end - start
+            self.lastLatency = end - max(mtimes[path] for path in parsed) if parsed else 0.0
+            self.maxReloadSeconds = max(self.maxReloadSeconds, self.lastReloadSeconds)
+            self.totalReloadSeconds += self.lastReloadSeconds
+            return True
+
+    def stats(self):
+        """Reload counters and the timings of the last reload in seconds.
+        latency is the time from the last modification of a changed file to
+        the publication of the new TTable, so it includes the polling delay."""
+
+        return { 'reloads': self.reloads,
+                 'errors': self.errors,
+                 'lastError': str(self.lastError) if self.lastError else None,
+                 'files': self.lastFiles,
+                 'templates': self.lastTemplates,
+                 'parseSeconds': self.lastParseSeconds,
+                 'buildSeconds': self.lastBuildSeconds,
+                 'reloadSeconds': self.lastReloadSeconds,
+                 'latency': self.lastLatency,
+                 'maxReloadSeconds': self.maxReloadSeconds,
+                 'totalReloadSeconds': self.totalReloadSeconds }
+
+    # watching
+
+    def start(self):
+        if self.thread:
+            return
+
+        if self.inotify and pyinotify:
+            manager = pyinotify.WatchManager()
+            self.notifier = pyinotify.ThreadedNotifier(manager, lambda event: self.wakeup.set())
+            self.notifier.daemon = True
+            self.notifier.start()
+            manager.add_watch(self.root,
+                              pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+                              | pyinotify.IN_CREATE | pyinotify.IN_DELETE,
+                              rec=True, auto_add=True)
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.watch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def watch(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if not self.stopped.is_set():
+                self.check()
+
+    def stop(self):
+        if not self.thread:
+            return
+
+        self.stopped.set()
+        self.wakeup.set()
+        self.thread.join()
+        self.thread = None
+
+        if self.notifier:
+            self.notifier.stop()
+            self.notifier = None
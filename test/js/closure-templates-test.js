@@ -185,6 +185,19 @@ ClosureTemplate.Test.testSwitch = function () {
     this.assertEqual('Variant 2: 2',
                     closureTemplate.python.testSwitch2({ 'var': 2 }));
 
+    this.assertEqual('11',
+                     closureTemplate.python.testSwitch3({ 'var': 11 }));
+    this.assertEqual('7',
+                     closureTemplate.python.testSwitch3({ 'var': 's7' }));
+    this.assertEqual('Again',
+                     closureTemplate.python.testSwitch3({ 'var': 'first' }));
+    this.assertEqual('Miss!',
+                     closureTemplate.python.testSwitch3({ 'var': '11' }));
+    this.assertEqual('Miss!',
+                     closureTemplate.python.testSwitch3({ 'var': 'constructor' }));
+    this.assertEqual('Miss!',
+                     closureTemplate.python.testSwitch3());
+
 };
 
 // Foreach
@@ -239,4 +252,26 @@ ClosureTemplate.Test.testCall = function () {
     this.assertEqual('Hello Andrey',
                     closureTemplate.python.testCall9());
 
-};
\ No newline at end of file
+};
+// Cache
+
+ClosureTemplate.Test.testCache = function () {
+    this.assertEqual('[alice][bob]',
+                     closureTemplate.python.testCache1({ users: [{ id: 1, name: 'alice' }, { id: 2, name: 'bob' }] }));
+    this.assertEqual('[alice][alice]',
+                     closureTemplate.python.testCache1({ users: [{ id: 1, name: 'alice' }, { id: 1, name: 'bob' }] }));
+    // objects are not keys of a fragment
+    this.assertEqual('[alice][bob]',
+                     closureTemplate.python.testCache2({ users: [{ name: 'alice' }, { name: 'bob' }] }));
+    this.assertEqual('[carol][dave]',
+                     closureTemplate.python.testCache2({ users: [{ name: 'carol' }, { name: 'dave' }] }));
+};
+
+// Inlining
+
+ClosureTemplate.Test.testInline = function () {
+    this.assertEqual('[x][x][x]',
+                     closureTemplate.python.testInline1());
+    this.assertEqual('[1ab][2ab][3ab]',
+                     closureTemplate.python.testInline2({ xs: [1, 2, 3], ys: ['a', 'b'] }));
+};
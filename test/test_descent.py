@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+import unittest
+import sys
+import os.path
+
+sys.path[0:0] = [""]
+
+from pyclosuretempaltes.parser import *
+
+TEST_SOY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'js', 'template.soy')
+
+EXPRESSIONS = [
+    "'Hello world'", "''", "'a\\'b\\\\c\\nd\\x'", "5", "3.14", "0x1F", "null", "true", "false",
+    " $var ", "$x.y", "$x.1.y", "$x[0].y", "$x[$z].y", "$x[0][1]", "$x[0][1][$y]", "$x[foo].bar",
+    "-$x", "not $x", " $x + $y ", "2 + 2", " $x - $y ", " $x * $y ", " $x/$y ", " $x % $y ",
+    "$x > $y", "$x < $y", "$x>=$y", "$x<=$y", "$x==$y", "$x!=$y", "$x and $y", "$x or $y",
+    "28 - 2 + (3 + 4)", "(2 + 3) * 4", "(20 - 3) %  5", "1 + 2 * 3 - 4 / 5 % 6",
+    "$a or $b and $c == $d < $e + $f * $g", "-$x + 1", "not $x and $y",
+    "hasData() ? 10 : 'Hello world'", "$a ? $b : $c ? $d : $e",
+    "max(2, $x ? min($x, $y ? 3 : 5 + 4, 6) : 4)", "hasData()", "min($x, $y)",
+    "min($x, max(5, $y))", "round ( 2.7182817 , $num )", "not hasData() ? round(3.141592653589793) : round(2.7182817, $num)",
+]
+
+TEMPLATES = [
+    '{template testA autoescape="true"}{/template}',
+    '{template testB private="false"}{/template}',
+    '{template testC autoescape="false" private="true"}{/template}',
+    '{template testE cache="true"}{/template}',
+    '{template testF autoescape="false" private="false" cache="false"}{/template}',
+    '{template testG private="true" inline="false"}{/template}',
+    '{template testD}\n    Hello\n{/template}',
+    '{template substitions}{sp}{nil}{\\r}{\\n}{\\t}{lb}{rb}{/template}',
+    '{template helloName}Hello {$name}{/template}',
+    '{template test}{2 + 2 |noAutoescape}{/template}',
+    '{template test}\n   {2 + 2 |noAutoescape |id |escapeHtml |escapeUri |escapeJs  |insertWordBreaks:5}\n{/template}',
+    '{template test}{print $x |id}{/template}',
+    '{template literalTest}{literal}Test {$x} {foreach $foo in $bar}{$foo}{/foreach}{/literal}{/template}',
+    '{template ifTest}{if $x}Hello {$x}{elseif $y}By {$y}{else}Hello world{/if}{/template}',
+    '{template switchTest}{switch $x}{case 1}hello world{case 2, 3, 4}by-by{default}none{/switch}{/template}',
+    '{template test}{foreach $x in $y.foo }{$x}{ifempty}Hello{/foreach}{/template}',
+    '{template test}{for $x in range(4, 10, 2)} ! {/for}{/template}',
+    '{template test}{call helloName1 data=\"$x\" /}{/template}',
+    '{template test}\n  {call helloName3 data=\"$data\"}\n    {param a: $x /}\n    {param b}Hello {$y}{/param}\n  {/call}\n{/template}',
+    '{template test}{call name=\"$x\" data=\"all\"  /}{/template}',
+    '{template test}{$x}/*c*/{$y}//\n  text // comment {with} braces\n  more /* block\n */ end{/template}',
+    '{template test}{$x}//tail\n  a{sp}  b  {nil}  c{/template}',
+    '{template page}<head>{$title}</head>\n{flush}\n<body>{$x}{flush}</body>{/template}',
+    '{template tree}{cache key="\'tree\'"}{$x}{/cache}{cache key="$c.id + \'-\' + $lang" ttl="600" }\n  <ul>{foreach $i in $c.items}<li>{$i}</li>{/foreach}</ul>\n{/cache}{/template}',
+]
+
+class TestDescentParser(unittest.TestCase):
+    def assertSameTree(self, a, b):
+        if isText(a):
+            self.assertTrue(isText(b), '%r != %r' % (a, b))
+            self.assertEqual(a, b)
+        elif isinstance(a, (list, tuple)):
+            self.assertIs(type(a), type(b))
+            self.assertEqual(len(a), len(b), '%r != %r' % (a, b))
+            for x, y in zip(a, b):
+                self.assertSameTree(x, y)
+        elif isinstance(a, dict):
+            self.assertIsInstance(b, dict)
+            self.assertEqual(sorted(a.keys()), sorted(b.keys()))
+            for key in a:
+                self.assertSameTree(a[key], b[key])
+        else:
+            self.assertIs(type(a), type(b))
+            self.assertEqual(a, b)
+
+    def testExpressions(self):
+        for text in EXPRESSIONS:
+            self.assertSameTree(parseExpression(text, 'descent'), parseExpression(text, 'lepl'))
+
+    def testLongExpressions(self):
+        chain = ' or '.join(['$a%d and $b%d' % (i, i) for i in xrange(50)])
+        self.assertSameTree(parseExpression(chain, 'descent'), parseExpression(chain, 'lepl'))
+
+        concat = parseExpression(' + '.join(["'s%d'" % i for i in xrange(100)]))
+        for i in xrange(99, 0, -1):
+            self.assertEqual(concat.op, '+')
+            self.assertEqual(concat.args[1], 's%d' % i)
+            concat = concat.args[0]
+        self.assertEqual(concat, 's0')
+
+        refs = '$a' + ''.join(['.b%d[%d]' % (i, i) for i in xrange(50)])
+        self.assertSameTree(parseExpression(refs, 'descent'), parseExpression(refs, 'lepl'))
+
+    def testTemplates(self):
+        for text in TEMPLATES:
+            self.assertSameTree(parseSingleTemplate(text, 'descent'), parseSingleTemplate(text, 'lepl'))
+
+    def testTemplateFile(self):
+        self.assertSameTree(parseFile(TEST_SOY, 'descent'), parseFile(TEST_SOY, 'lepl'))
+
+    def testDefaultParser(self):
+        try:
+            setDefaultParser('lepl')
+            self.assertSameTree(parseSingleTemplate(TEMPLATES[0]), leplParseSingleTemplate(TEMPLATES[0]))
+        finally:
+            setDefaultParser('descent')
+
+        self.assertRaises(Exception, setDefaultParser, 'unknown')
+
+    def testPositions(self):
+        namespace = parseNamespace('{namespace test}\n\n{template a}\n  <b>{$x}</b>\n'
+                                   '  {if $y}\n    {call b /}{/if}\n{/template}')
+        tmpl = namespace.templates[0]
+        print_, if_ = tmpl.code[1], tmpl.code[3]
+        call_ = if_[0][1][0]
+
+        self.assertEqual([(node.line, node.column) for node in (tmpl, print_, if_, call_)],
+                         [(3, 1), (4, 6), (5, 3), (6, 5)])
+
+    def testErrors(self):
+        with self.assertRaises(ParseError) as cm:
+            parseNamespace('{namespace test}\n\n{template a}\n  {if $x}Hello\n{/template}')
+        self.assertEqual(cm.exception.line, 5)
+        self.assertEqual(cm.exception.column, 1)
+
+        self.assertRaises(ParseError, parseNamespace, '{namespace test} {template a}{/template} garbage')
+        self.assertRaises(ParseError, parseSingleTemplate, '{template a}{foo bar}{/template}')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+import unittest
+import sys
+
+sys.path[0:0] = [""]
+
+from pyclosuretempaltes.parser import *
+from pyclosuretempaltes.optimizer import foldExpression, optimizeTemplate, optimizeNamespace, CallGraph
+from pyclosuretempaltes.python_backend import makeTTable
+from pyclosuretempaltes.javascript_backend import compileNamespaceToJS
+
+def fold(text):
+    return foldExpression(parseExpression(text))
+
+def hasCalls(node):
+    if isinstance(node, Call):
+        return True
+    return isinstance(node, (list, tuple)) and any(hasCalls(item) for item in node)
+
+def optimize(text):
+    return list(optimizeTemplate(parseSingleTemplate(text)).code)
+
+class TestFolding(unittest.TestCase):
+    def testOperators(self):
+        self.assertEqual(fold('(2 + 3) * 4'), 20)
+        self.assertEqual(fold('7 / 2'), 3.5)
+        self.assertEqual(fold('-(2 - 5)'), 3)
+        self.assertEqual(fold("'a' + 1 + 'b'"), 'a1b')
+        self.assertEqual(fold('1 < 2 and 3 >= 3'), True)
+        self.assertEqual(fold("not ''"), True)
+        self.assertEqual(fold("'a' == 'a' ? 'yes' : 'no'"), 'yes')
+        self.assertEqual(fold('max(1, 2 + 3)'), 5)
+        self.assertEqual(fold('floor(2.5)'), 2.0)
+        self.assertEqual(fold("length('hello')"), 5)
+        self.assertEqual(fold('round(2.4)'), 2)
+
+    def testPartial(self):
+        self.assertEqual(fold('true and $x'), Variable(['x']))
+        self.assertEqual(fold('false or $x.y'), DotRef(['y', Variable(['x'])]))
+        self.assertEqual(fold('$x + 2 * 3'), Operator(['+', Variable(['x']), 6]))
+        self.assertEqual(fold('$a[1 + 1]'), ARef([2, Variable(['a'])]))
+
+    def testNotFolded(self):
+        # the backends disagree on these, or they fail at run time
+        for text in ['1 / 0', "1.5 + 'a'", "true + 'a'", '1 == true', 'round(2.5)',
+                     "1 < 'a'", 'randomInt(3)', '9007199254740992 * 2']:
+            expr = parseExpression(text)
+            self.assertEqual(foldExpression(expr), expr)
+
+        self.assertEqual(fold('-7 % 2'), Operator(['%', -7, 2]))
+
+        expr = parseExpression('$x + 1')
+        self.assertIs(foldExpression(expr), expr)
+
+class TestOptimizer(unittest.TestCase):
+    def testIf(self):
+        self.assertEqual(optimize('{template t}a{if 1 > 2}b{elseif true}c{else}d{/if}e{/template}'),
+                         ['ace'])
+        self.assertEqual(optimize('{template t}a{if false}b{/if}{/template}'), ['a'])
+
+        if_ = optimize('{template t}{if false}a{elseif $x}b{elseif 1}c{else}d{/if}{/template}')[0]
+        self.assertEqual([cond for cond, block in if_], [Variable(['x']), True])
+
+    def testSwitch(self):
+        self.assertEqual(optimize("{template t}{switch 1 + 1}{case 1}a{case 2, 3}b{default}c{/switch}{/template}"),
+                         ['b'])
+        self.assertEqual(optimize("{template t}{switch 'x'}{case 1}a{default}c{/switch}{/template}"), ['c'])
+        self.assertEqual(optimize("{template t}x{switch 5}{case 1}a{/switch}{/template}"), ['x'])
+
+        # 1 == true in Python, but not in JavaScript
+        switch_ = optimize("{template t}{switch 1}{case true}a{case 1}b{/switch}{/template}")[0]
+        self.assertTrue(isinstance(switch_, Switch))
+
+    def testPositions(self):
+        tmpl = parseSingleTemplate('{template t}\n{if $x}\n{$x + 2 + 2}\n{/if}\n{/template}')
+        print_ = optimizeTemplate(tmpl).code[0][0][1][0]
+        self.assertEqual(print_.expr, Operator(['+', Operator(['+', Variable(['x']), 2]), 2]))
+        self.assertEqual((print_.line, print_.column), (3, 1))
+
+        # the parsed tree is not modified
+        self.assertTrue(isinstance(tmpl.code[0][0][1][0].expr, Operator))
+
+        tmpl = parseSingleTemplate('{template t}{$x}{/template}')
+        self.assertIs(optimizeTemplate(tmpl), tmpl)
+
+    def testCoalesce(self):
+        self.assertEqual(optimize("{template t}a{sp}{literal}{b}{/literal}{'<c>'}{nil}{5}{$x}d{\\n}{/template}"),
+                         ['a {b}&lt;c&gt;5', Print([Variable(['x']), {}]), 'd\n'])
+        self.assertEqual(optimize("{template t autoescape=\"false\"}{'<a>'}{'<b>' |escapeHtml}{/template}"),
+                         ['<a>&lt;b&gt;'])
+
+        # printed differently in JavaScript, or escaped with a different function
+        self.assertEqual(len(optimize("{template t}a{1.5}{true}{'b' |id}{/template}")), 4)
+
+        # a block without dynamic content is not worth caching
+        self.assertEqual(optimize('{template t}a{cache key="$x"}b{if true}c{/if}{/cache}{/template}'), ['abc'])
+        self.assertEqual(len(optimize('{template t}{cache key="$x"}{$x}{/cache}{/template}')), 1)
+
+    def testBackends(self):
+        nameSpace = parseNamespace("""
+        {namespace test}
+
+        {template page}
+            {(2 + 3) * 4}{if 2 > 3}never{elseif $x}{$x + 1 * 2}{else}{'no' + 'ne'}{/if}
+        {/template}
+        """)
+
+        ttable = makeTTable(nameSpace)
+        self.assertEqual(ttable.callTemplate('page', {'x': 1}), '203')
+        self.assertEqual(ttable.callTemplate('page', {}), '20none')
+
+        js = compileNamespaceToJS(nameSpace)
+        self.assertTrue('20' in js)
+        self.assertFalse('never' in js)
+        self.assertFalse('(2 + 3)' in js)
+
+        nameSpace = parseNamespace('{namespace test}\n{template static}a{sp}{if 1 < 2}<b>{/if}{/template}')
+        self.assertEqual(makeTTable(nameSpace).callTemplate('static', {}), 'a <b>')
+        self.assertTrue('if (!$target$) return "a <b>";' in compileNamespaceToJS(nameSpace))
+        self.assertEqual(optimizeNamespace(nameSpace).name, 'test')
+
+class TestInlining(unittest.TestCase):
+    def inline(self, text, name='page'):
+        nameSpace = optimizeNamespace(parseNamespace('{namespace test}\n' + text))
+        return [list(tmpl.code) for tmpl in nameSpace.templates if tmpl.name == name][0]
+
+    def assertInlined(self, text, inlined=True):
+        code = self.inline(text)
+        self.assertEqual(not hasCalls(code), inlined)
+        return code
+
+    def testParams(self):
+        self.assertEqual(self.inline("""
+        {template page}<a>{call icon}{param name: 'star' /}{param size}16{/param}{/call}</a>{/template}
+        {template icon}<i class="{$name}" width="{$size}">{if $alt}{$alt}{/if}</i>{/template}"""),
+                         ['<a><i class="star" width="16"></i></a>'])
+
+        code = self.assertInlined("""
+        {template page}{call button}{param label: $item.title /}{/call}{/template}
+        {template button}<b>{$label}</b>{$other}{/template}""")
+        # $other is null in the env of the call
+        self.assertEqual(code, ['<b>', Print([DotRef(['title', Variable(['item'])]), {}]), '</b>'])
+
+    def testData(self):
+        code = self.assertInlined("""
+        {template page}{call row data="$rows[0]" /}{/template}
+        {template row}{$name}{/template}""")
+        self.assertEqual(code[0].expr, DotRef(['name', ARef([0, Variable(['rows'])])]))
+
+        code = self.assertInlined("""
+        {template page}{call row data="all" /}{/template}
+        {template row}{$name}{if hasData()}!{/if}{call cell data="all" /}{/template}
+        {template cell}{$name}{/template}""")
+        self.assertEqual([cmd.expr for cmd in code if isinstance(cmd, Print)], [Variable(['name'])] * 2)
+
+        # hasData() and data="all" need the env of the call
+        self.assertInlined("""
+        {template page}{call row data="all"}{param x: 1 /}{/call}{/template}
+        {template row}{if hasData()}{$x}{/if}{/template}""", False)
+
+        # null params are looked up in data by Python, not by JavaScript
+        self.assertInlined("""
+        {template page}{call row data="all"}{param x: $y /}{/call}{/template}
+        {template row}{$x}{/template}""", False)
+
+    def testScopes(self):
+        # $name of the callee is not the foreach variable of the caller
+        self.assertInlined("""
+        {template page}{foreach $name in $names}{call row data="all" /}{/foreach}{/template}
+        {template row}{$name}{/template}""", False)
+
+        # nor is $item of the param the foreach variable of the callee
+        self.assertInlined("""
+        {template page}{call list}{param first: $item /}{/call}{/template}
+        {template list}{foreach $item in $items}{$first}{/foreach}{/template}""", False)
+
+        code = self.assertInlined("""
+        {template page}{foreach $item in $items}{call list}{param first: $item /}{/call}{/foreach}{/template}
+        {template list}{foreach $x in $xs}{$first}{index($x)}{/foreach}{/template}""")
+        self.assertEqual(code[0].code[0].code[0].expr, Variable(['item']))
+
+        # the loop variables of the callee would reset those of the caller in JavaScript
+        self.assertInlined("""
+        {template page}{for $i in range(3)}[{call row /}]{/for}{/template}
+        {template row}{for $i in range(1)}x{/for}{/template}""", False)
+        self.assertInlined("""
+        {template page}{foreach $x in $xs}[{$x}{call row}{param ys: $ys /}{/call}]{/foreach}{/template}
+        {template row}{foreach $x in $ys}{$x}{/foreach}{/template}""", False)
+
+    def testLimits(self):
+        self.assertInlined("""
+        {template page}{call tiny /}{/template}
+        {template tiny inline="false"}x{/template}""", False)
+
+        big = '{$a}{$b}' * 10
+        self.assertInlined("""
+        {template page}{call big /}{/template}
+        {template big}%s{/template}""" % big, False)
+        self.assertInlined("""
+        {template page}{call big /}{/template}
+        {template big private="true"}%s{/template}""" % big)
+        self.assertInlined("""
+        {template page}{call big /}{/template}
+        {template big inline="true"}%s{/template}""" % (big * 5))
+
+        self.assertInlined("""
+        {template page}{call page /}{/template}""", False)
+        self.assertEqual(self.inline("""
+        {template page}{call a /}{/template}
+        {template a}a{if $x}{call b /}{/if}{/template}
+        {template b}b{call a /}{/template}""")[0], 'a')
+
+        self.assertInlined("""
+        {template page}{call raw /}{/template}
+        {template raw autoescape="false"}{$html}{/template}""", False)
+
+    def testRender(self):
+        nameSpace = parseNamespace("""
+        {namespace test}
+
+        {template page}
+            {foreach $item in $items}
+                {call button}{param label: $item.label /}{param kind: 'primary' /}{/call}
+            {/foreach}
+            {call footer data="all" /}
+        {/template}
+
+        {template button private="true"}
+            <button class="{$kind}">{call icon}{param name: $kind /}{/call}{$label}</button>
+        {/template}
+
+        {template icon}
+            {switch $name}{case 'primary'}<i>*</i>{default}<i>?</i>{/switch}
+        {/template}
+
+        {template footer}
+            {if $items}{length($items)} items{/if}
+        {/template}
+        """)
+
+        env = {'items': [{'label': 'Save & exit'}, {'label': 'Cancel'}]}
+        expected = makeTTable(nameSpace).callTemplate('page', env)
+        self.assertEqual(makeTTable(nameSpace, inlineCalls=True).callTemplate('page', env), expected)
+
+        optimized = optimizeNamespace(nameSpace)
+        self.assertEqual(list(optimized.templates[0].code[0].code),
+                         ['<button class="primary"><i>*</i>', Print([DotRef(['label', Variable(['item'])]), {}]),
+                          '</button>'])
+
+        js = compileNamespaceToJS(nameSpace)
+        self.assertFalse('test.button(' in js)
+        self.assertTrue('test.button(' in compileNamespaceToJS(nameSpace, inlineCalls=False))
+
+class TestTreeShaking(unittest.TestCase):
+    nameSpace = parseNamespace("""
+    {namespace test}
+
+    {template page}{call header /}{foreach $x in $xs}{call row data="$x" /}{/foreach}{/template}
+    {template header inline="false"}<h1>{$title}</h1>{/template}
+    {template row inline="false"}{$name}{call cell /}{/template}
+    {template cell inline="false"}{$value}{call row /}{/template}
+    {template admin inline="false"}{call header /}{call settings /}{/template}
+    {template settings inline="false"}{$flags}{/template}
+    {template widget inline="false"}{call name="$kind" /}{/template}
+    """)
+
+    def testCallGraph(self):
+        graph = CallGraph(self.nameSpace.templates)
+        self.assertEqual(graph.calls['page'], set(['header', 'row']))
+        self.assertEqual(graph.dynamic, set(['widget']))
+        self.assertEqual(graph.reachable(['page']), set(['page', 'header', 'row', 'cell']))
+        self.assertEqual(graph.reachable(['settings', 'missing']), set(['settings']))
+
+    def testEntryPoints(self):
+        report = dict()
+        js = compileNamespaceToJS(self.nameSpace, entryPoints=['page'], report=report)
+        self.assertTrue('test.cell = function' in js)
+        self.assertFalse('test.admin = function' in js)
+        self.assertFalse('test.widget = function' in js)
+
+        self.assertEqual(report['kept'], ['page', 'header', 'row', 'cell'])
+        self.assertEqual(sorted(report['removed']), ['admin', 'settings', 'widget'])
+        self.assertEqual(report['removedBytes'], sum(report['removed'].values()))
+        self.assertEqual(report['bytes'], len(js))
+        self.assertEqual(report['dynamicCalls'], [])
+
+        full = compileNamespaceToJS(self.nameSpace)
+        self.assertTrue(report['bytes'] + report['removedBytes'] <= len(full))
+
+        # inlined callees are not needed at all
+        js = compileNamespaceToJS(parseNamespace("""
+        {namespace test}
+        {template page}{call icon /}{/template}
+        {template icon}<i></i>{/template}"""), entryPoints=['page'])
+        self.assertFalse('test.icon = function' in js)
+
+        self.assertRaises(Exception, compileNamespaceToJS, self.nameSpace, entryPoints=['missing'])
+
+    def testDynamicCalls(self):
+        # any template can be the callee of widget
+        report = dict()
+        js = compileNamespaceToJS(self.nameSpace, entryPoints=['page', 'widget'], report=report)
+        self.assertEqual(report['dynamicCalls'], ['widget'])
+        self.assertEqual(report['removed'], {})
+        self.assertTrue('test.settings = function' in js)
+
+        # unless it is not reachable
+        compileNamespaceToJS(self.nameSpace, entryPoints=['admin'], report=report)
+        self.assertEqual(report['dynamicCalls'], [])
+        self.assertEqual(report['kept'], ['header', 'admin', 'settings'])
+
+if __name__ == "__main__":
+    unittest.main()
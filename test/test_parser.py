@@ -16,6 +16,9 @@
 
 import unittest
 import sys
+import os.path
+import shutil
+import tempfile
 
 sys.path[0:0] = [""]
 
@@ -215,6 +218,9 @@ class TestCommandParser(unittest.TestCase):
         self.assertEqual(c.props.get('autoescape'), False)
         self.assertEqual(c.props.get('private'), True)
 
+        g = parseSingleTemplate('{template testG private="true" inline="false"}{/template}')
+        self.assertEqual(g.props.get('inline'), False)
+
         d = parseSingleTemplate("""{template testD}
             Hello
         {/template}""")
@@ -451,7 +457,116 @@ class TestCommandParser(unittest.TestCase):
 
     # def testWhitespaces(self):
     #     pass
-        
+
+
+class TestASTCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.soy')
+        self.writeSource('{namespace test}\n{template a}Hello {$name}{/template}')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def writeSource(self, text):
+        with open(self.path, 'w') as f:
+            f.write(text)
+
+    def testHitAndMiss(self):
+        cache = ASTCache(os.path.join(self.directory, 'cache'))
+
+        a = parseFile(self.path, cache=cache)
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 1, 'evictions': 0})
+
+        b = parseFile(self.path, cache=cache)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'evictions': 0})
+        self.assertEqual(a, b)
+        self.assertIsInstance(b, Namespace)
+        self.assertIsInstance(b.templates[0].code[1], Print)
+
+        self.writeSource('{namespace test}\n{template a}Bye {$name}{/template}')
+        c = parseFile(self.path, cache=ASTCache(os.path.join(self.directory, 'cache')))
+        self.assertEqual(c.templates[0].code[0], 'Bye ')
+
+    def testCorruptedEntry(self):
+        cache = ASTCache(os.path.join(self.directory, 'cache'))
+        parseFile(self.path, cache=cache)
+
+        for mtime, size, path in cache.entries():
+            with open(path, 'wb') as f:
+                f.write('garbage')
+
+        self.assertEqual(parseFile(self.path, cache=cache).name, 'test')
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(len(cache.entries()), 1)
+
+    def testEviction(self):
+        cache = ASTCache(os.path.join(self.directory, 'cache'))
+        tree = parseNamespace('{namespace test}\n{template a}Hello{/template}')
+
+        cache.put('a', 'descent', tree)
+        entrySize = cache.size
+        cache.maxSize = entrySize * 2
+
+        os.utime(cache.entryPath(cache.key('a', 'descent')), (0, 0))
+        cache.put('b', 'descent', tree)
+        cache.put('c', 'descent', tree)
+
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(len(cache.entries()), 2)
+        self.assertIsNone(cache.get('a', 'descent'))
+        self.assertEqual(cache.get('c', 'descent'), tree)
+
+
+class TestParseFiles(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def writeSource(self, name, text):
+        path = os.path.join(self.directory, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def testOrder(self):
+        for i in xrange(6):
+            self.writeSource('sub%d/file%d.soy' % (i % 2, i),
+                             '{namespace test%d}\n{template a}%d{/template}' % (i, i))
+        self.writeSource('readme.txt', 'not a template')
+
+        for workers in (1, 3):
+            namespaces = parseDirectory(self.directory, workers=workers)
+            self.assertEqual([ns.name for ns in namespaces],
+                             ['test0', 'test2', 'test4', 'test1', 'test3', 'test5'])
+
+    def testErrors(self):
+        good = self.writeSource('good.soy', '{namespace good}\n{template a}Hello{/template}')
+        bad1 = self.writeSource('bad1.soy', '{namespace bad}\n{template a}{if $x}{/template}')
+        bad2 = self.writeSource('bad2.soy', '{namespace bad}\n{template a}{/foreach}{/template}')
+        missing = os.path.join(self.directory, 'missing.soy')
+
+        with self.assertRaises(ParseErrors) as cm:
+            parseFiles([bad1, good, missing, bad2], workers=2)
+
+        self.assertEqual([path for path, error in cm.exception.errors], [bad1, missing, bad2])
+        self.assertIn('ParseError', cm.exception.errors[0][1])
+        self.assertIn('IOError', cm.exception.errors[1][1])
+        self.assertEqual(cm.exception.namespaces[1].name, 'good')
+        self.assertIsNone(cm.exception.namespaces[0])
+
+    def testCache(self):
+        path = self.writeSource('a.soy', '{namespace a}\n{template a}Hello{/template}')
+        cache = ASTCache(os.path.join(self.directory, 'cache'))
+
+        parseFiles([path], cache=cache)
+        self.assertEqual(parseFiles([path], cache=cache)[0].name, 'a')
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'evictions': 0})
+
 
 if __name__ == "__main__":
     unittest.main()
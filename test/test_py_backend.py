@@ -16,13 +16,41 @@
 
 import unittest
 import sys
+import inspect
+import threading
+import multiprocessing
+import time
+import json
+from StringIO import StringIO
 
 sys.path[0:0] = [""]
 
 from pyclosuretempaltes.parser import parseNamespace
-from pyclosuretempaltes.python_backend import makeTTable
+from pyclosuretempaltes.python_backend import (makeTTable, updateTTable, TTable, RenderCache, Env,
+                                               escapeHtml, encodeUri, encodeUriComponent, registerFutureType,
+                                               Instrumentation, Profiler)
+
+class Future(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+        self.event.set()
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self):
+        self.event.wait()
+        return self.value
+
+registerFutureType(Future)
 
 class TestPythonBackend(unittest.TestCase):
+    makeTTable = staticmethod(makeTTable)
+
     def setUp(self):
         pass
 
@@ -38,7 +66,7 @@ class TestPythonBackend(unittest.TestCase):
           <Hello world>
         {/template}""")
 
-        ttable = makeTTable(nameSpace)
+        ttable = self.makeTTable(nameSpace)
 
         self.assertEqual(ttable.callTemplate('helloWorld1', {}), 'Hello world!')
         self.assertEqual(ttable.callTemplate('helloWorld2', {}), '<Hello world>')
@@ -73,7 +101,7 @@ class TestPythonBackend(unittest.TestCase):
         
         """)
 
-        ttable = makeTTable(nameSpace)
+        ttable = self.makeTTable(nameSpace)
 
         self.assertEqual(ttable.callTemplate('testPrint1', {'arg': '<&\"\'>'}),
                          '&lt;&amp;&quot;&#039;&gt;')
@@ -102,7 +130,7 @@ class TestPythonBackend(unittest.TestCase):
           Hello world
         {/template}""")
 
-        ttable = makeTTable(nameSpace)
+        ttable = self.makeTTable(nameSpace)
 
         self.assertEqual(ttable.callTemplate('helloWorld1', {}), 'Hello world')
         self.assertEqual(ttable.callTemplate('helloWorld2', {}), 'Hello world')
@@ -142,7 +170,7 @@ class TestPythonBackend(unittest.TestCase):
         {template calculate10}{if $val != 5}true{else}false{/if}{/template}
         """)
 
-        ttable = makeTTable(nameSpace)
+        ttable = self.makeTTable(nameSpace)
 
         self.assertEqual(ttable.callTemplate('calculate1', {}), '20')
         self.assertEqual(ttable.callTemplate('calculate2', {}), '20')
@@ -196,7 +224,7 @@ class TestPythonBackend(unittest.TestCase):
         {/template}
         """)
 
-        ttable = makeTTable(nameSpace)
+        ttable = self.makeTTable(nameSpace)
 
         self.assertEqual(ttable.callTemplate('substitions', {}), ' \r\n\t{}')
 
@@ -214,7 +242,7 @@ class TestPythonBackend(unittest.TestCase):
         {/template}
         """)
 
-        ttable = makeTTable(nameSpace)
+        ttable = self.makeTTable(nameSpace)
 
         self.assertEqual(ttable.callTemplate('dotted1',
                                              {'obj': {'first': 'Hello', 'second': 'world'}}),
@@ -236,7 +264,7 @@ class TestPythonBackend(unittest.TestCase):
         {/template}
         """)
 
-        ttable = makeTTable(nameSpace)
+        ttable = self.makeTTable(nameSpace)
 
         self.assertEqual(ttable.callTemplate('local1',
                                              {'c': [{'d': 5}, {'d': 6}]}),
@@ -254,7 +282,7 @@ class TestPythonBackend(unittest.TestCase):
         {/template}
         """)
 
-        ttable = makeTTable(nameSpace)
+        ttable = self.makeTTable(nameSpace)
 
         self.assertEqual(ttable.callTemplate('literal1', {}), '&{$x}{}')
 
@@ -276,7 +304,7 @@ class TestPythonBackend(unittest.TestCase):
         {/template}
         """)
 
-        ttable = makeTTable(nameSpace)
+        ttable = self.makeTTable(nameSpace)
 
         self.assertEqual(ttable.callTemplate('testIf1', {'name': 'Andrey'}), 'Hello Andrey')
         self.assertEqual(ttable.callTemplate('testIf1', {}), '')
@@ -302,7 +330,7 @@ class TestPythonBackend(unittest.TestCase):
         {/template}
         """)
 
-        ttable = makeTTable(nameSpace)
+        ttable = self.makeTTable(nameSpace)
 
         self.assertEqual(ttable.callTemplate('testSwitch1', {'var': 0}), 'Variant 1: 0')
         self.assertEqual(ttable.callTemplate('testSwitch1', {'var': 'Hello'}), 'Variant 2: Hello')
@@ -314,6 +342,39 @@ class TestPythonBackend(unittest.TestCase):
         self.assertEqual(ttable.callTemplate('testSwitch2', {}), '')
         self.assertEqual(ttable.callTemplate('testSwitch2', {'var': 2}), 'Variant 2: 2')
 
+    def testLargeSwitch(self):
+        cases = ''.join(['{case %d, \'s%d\'}%d' % (i, i, i) for i in xrange(12)])
+        nameSpace = parseNamespace("""
+        {namespace test}
+
+        {template large}
+            {switch $var}%s{case 3, 'first'}Again{default}Miss!{/switch}
+        {/template}
+
+        {template noDefault}
+            {switch $var}%s{/switch}
+        {/template}
+        """ % (cases, cases))
+
+        ttable = self.makeTTable(nameSpace)
+
+        for i in xrange(12):
+            self.assertEqual(ttable.callTemplate('large', {'var': i}), str(i))
+            self.assertEqual(ttable.callTemplate('large', {'var': 's%d' % i}), str(i))
+
+        # the first case wins, and equal values match like with ==
+        self.assertEqual(ttable.callTemplate('large', {'var': 3}), '3')
+        self.assertEqual(ttable.callTemplate('large', {'var': 'first'}), 'Again')
+        self.assertEqual(ttable.callTemplate('large', {'var': 5.0}), '5')
+        self.assertEqual(ttable.callTemplate('large', {'var': u's7'}), '7')
+
+        # unhashable values fall back to the default
+        self.assertEqual(ttable.callTemplate('large', {'var': 12}), 'Miss!')
+        self.assertEqual(ttable.callTemplate('large', {'var': [1]}), 'Miss!')
+        self.assertEqual(ttable.callTemplate('large', {}), 'Miss!')
+        self.assertEqual(ttable.callTemplate('noDefault', {'var': {}}), '')
+        self.assertEqual(ttable.callTemplate('noDefault', {'var': 11}), '11')
+
     def testForeach(self):
         nameSpace = parseNamespace("""
         {namespace foreach}
@@ -351,7 +412,7 @@ class TestPythonBackend(unittest.TestCase):
         {/template}
         """)
 
-        ttable = makeTTable(nameSpace)
+        ttable = self.makeTTable(nameSpace)
 
         self.assertEqual(ttable.callTemplate('testForeach1',
                                              {'opernands': ["alpha", "beta", "gamma"]}),
@@ -392,15 +453,23 @@ class TestPythonBackend(unittest.TestCase):
                 {for  $j in range(1, 3)}{$i}{$j}{/for}{sp}
             {/for}
         {/template}
+
+        {template testFor5}
+            {for $i in range(3)}{if $first}{isFirst($i)}{/if}{$i}{/for}
+        {/template}
         """)
 
-        ttable = makeTTable(nameSpace)
+        ttable = self.makeTTable(nameSpace)
 
         self.assertEqual(ttable.callTemplate('testFor1', {}), '01234')
         self.assertEqual(ttable.callTemplate('testFor2', {}), '456789')
         self.assertEqual(ttable.callTemplate('testFor3', {'from': 1, 'to': 10, 'by': 3}), '147')
         self.assertEqual(ttable.callTemplate('testFor4', {}), '5152 6162 7172 ')
 
+        # isFirst() of a {for} variable fails only when it is evaluated
+        self.assertEqual(ttable.callTemplate('testFor5', {}), '012')
+        self.assertRaises(Exception, ttable.callTemplate, 'testFor5', {'first': True})
+
     def testCall(self):
         nameSpace = parseNamespace("""
         {namespace call}
@@ -460,7 +529,7 @@ class TestPythonBackend(unittest.TestCase):
         {/template}
         """)
 
-        ttable = makeTTable(nameSpace)
+        ttable = self.makeTTable(nameSpace)
 
         self.assertEqual(ttable.callTemplate('testCall1', {}), 'Hello world')
         self.assertEqual(ttable.callTemplate('testCall2', {}), 'Hello Andrey')
@@ -472,7 +541,674 @@ class TestPythonBackend(unittest.TestCase):
                                              {'author': {'name': 'Masha', 'city': 'Krasnodar'}}),
                          'Hello Andrey from Krasnodar')
         self.assertEqual(ttable.callTemplate('testCall8', {}), 'Hello world')
+
+    def testLoopScopes(self):
+        nameSpace = parseNamespace("""
+        {namespace test}
+
+        {template shadow}
+            {foreach $x in $items}
+                {foreach $x in $x.children}{$x}{/foreach}
+                {$x.name}{if isLast($x)}.{else},{/if}
+            {/foreach}
+        {/template}
+
+        {template index}
+            {foreach $a in $items}{foreach $b in $items}{index($a)}{index($b)}{/foreach}{/foreach}
+        {/template}
+        """)
+
+        ttable = self.makeTTable(nameSpace)
+        items = [{'name': 'a', 'children': [1, 2]}, {'name': 'b', 'children': [3]}]
+
+        self.assertEqual(ttable.callTemplate('shadow', {'items': items}), '12 a,3 b.')
+        self.assertEqual(ttable.callTemplate('index', {'items': [1, 2]}), '11122122')
+
+        # a loop variable that is null falls through to the data
+        nameSpace = parseNamespace("""
+        {namespace test}
+
+        {template nulls}
+            {foreach $x in $xs}{$x}{/foreach}|{foreach $x in $xs}{foreach $x in $ys}{$x}{/foreach}{/foreach}
+        {/template}
+        """)
+
+        env = {'x': 'D', 'xs': [None, 2], 'ys': [None]}
+        self.assertEqual(self.makeTTable(nameSpace).callTemplate('nulls', env), 'D2|D2')
+
+    def testCallScopes(self):
+        nameSpace = parseNamespace("""
+        {namespace test}
+
+        {template level1}
+            {call level2 data=\"all\"}{param b: 'b' /}{/call}
+        {/template}
+
+        {template level2}
+            {call level3 data=\"all\"}{param c: 'c' /}{param a: null /}{/call}
+        {/template}
+
+        {template level3}
+            {$a}{$b}{$c}
+        {/template}
+        """)
+
+        ttable = self.makeTTable(nameSpace)
+
+        self.assertEqual(ttable.callTemplate('level1', {'a': 'a', 'c': 'x'}), 'abc')
+
+        # data="all" passes the loop variables of the caller
+        nameSpace = parseNamespace("""
+        {namespace test}
+
+        {template loop}
+            {foreach $x in $xs}{call item data=\"all\" /}{/foreach}
+            {for $i in range(2)}{call item data=\"all\"}{param x: $i /}{/call}{/for}
+        {/template}
+
+        {template item}
+            [{$x}{$y}]
+        {/template}
+        """)
+
+        ttable = self.makeTTable(nameSpace)
+        self.assertEqual(ttable.callTemplate('loop', {'xs': [1, None], 'x': 'D', 'y': 'y'}), '[1y][Dy] [0y][1y]')
+
+    def testCacheFragments(self):
+        nameSpace = parseNamespace("""
+        {namespace test}
+
+        {template menu}
+            {foreach $c in $categories}
+                {cache key=\"'cat-' + $c.id\" ttl=\"60\"}<li>{$c.name}{$lang}</li>{/cache}
+            {/foreach}
+            {cache key=\"$categories\"}{length($categories)}{/cache}
+            {cache key=\"$self\"}!{/cache}
+        {/template}
+        """)
+
+        class Store(object):
+            # a stand-in for a memcached client
+            def __init__(self):
+                self.dict = dict()
+
+            def get(self, key):
+                return self.dict.get(key, (None, None))[0]
+
+            def set(self, key, text, time=0):
+                self.dict[key] = (text, time)
+
+        ttable = self.makeTTable(nameSpace)
+        ttable.fragmentCache = store = Store()
+
+        categories = [{'id': 1, 'name': 'Tea'}, {'id': 2, 'name': 'Coffee'}, {'id': 1, 'name': 'Juice'}]
+        env = {'categories': categories, 'lang': 'en', 'self': object()}
+        self.assertEqual(ttable.callTemplate('menu', env), '<li>Teaen</li><li>Coffeeen</li><li>Teaen</li> 3 !')
+        self.assertEqual(sorted(ttl for text, ttl in store.dict.values()), [0, 60, 60])
+
+        # the key alone decides, other data is not looked at
+        env['lang'] = 'de'
+        self.assertEqual(ttable.callTemplate('menu', env), '<li>Teaen</li><li>Coffeeen</li><li>Teaen</li> 3 !')
+
+        categories.append({'id': 3, 'name': 'Milk'})
+        self.assertEqual(ttable.callTemplate('menu', env),
+                         '<li>Teaen</li><li>Coffeeen</li><li>Teaen</li><li>Milkde</li> 4 !')
+
+        # the default in-process store expires entries
+        ttable = self.makeTTable(nameSpace)
+        ttable.fragmentCache.set('soy:x', 'text', 0.01)
+        self.assertEqual(ttable.fragmentCache.get('soy:x'), 'text')
+        time.sleep(0.02)
+        self.assertEqual(ttable.fragmentCache.get('soy:x'), None)
+
+    def testIterTemplate(self):
+        nameSpace = parseNamespace("""
+        {namespace test}
+
+        {template page}
+            <head>{$title}</head>
+            {flush}
+            <body>{foreach $row in $rows}<p>{$row}</p>{/foreach}{$slow.value}</body>
+        {/template}
+
+        {template broken}
+            Hello {call missing /}
+        {/template}
+        """)
+
+        ttable = self.makeTTable(nameSpace)
+        released = threading.Event()
+
+        class Slow(object):
+            @property
+            def value(self):
+                released.wait()
+                return u'\u044f'
+
+        env = {'title': 'Title', 'rows': range(100), 'slow': Slow()}
+        chunks = ttable.iterTemplate('page', env, chunkSize=64)
+
+        self.assertEqual(chunks.next(), '<head>Title</head> ')
+        released.set()
+        rest = list(chunks)
+
+        self.assertTrue(all(isinstance(chunk, str) for chunk in rest))
+        self.assertTrue(all(len(chunk) >= 64 for chunk in rest[:-1]))
+        self.assertEqual(''.join(rest).decode('utf-8'), ttable.callTemplate('page', env)[len('<head>Title</head> '):])
+
+        chunks = ttable.iterTemplate('broken', {})
+        self.assertRaises(Exception, list, chunks)
+        self.assertRaises(Exception, ttable.iterTemplate, 'missing', {})
+
+        chunks = ttable.iterTemplate('page', dict(env, rows=range(100000)), chunkSize=1)
+        chunks.next()
+        chunks.close()
+
+    def testRenderMany(self):
+        nameSpace = parseNamespace("""
+        {namespace test}
+
+        {template letter}
+            Dear {$name},{sp}{call signature /}
+        {/template}
+
+        {template signature}
+            Bye
+        {/template}
+        """)
+
+        ttable = self.makeTTable(nameSpace)
+        envs = [{'name': 'user%d' % i} for i in xrange(100)]
+
+        batch = ttable.renderMany('letter', iter(envs), workers=2, chunksize=7)
+        self.assertEqual(list(batch), [ttable.callTemplate('letter', env) for env in envs])
+
+        stats = batch.stats()
+        self.assertEqual(sum(item['renders'] for item in stats.values()), 100)
+        self.assertTrue(0 < len(stats) <= 2)
+
+        self.assertEqual(list(ttable.renderMany('letter', [], workers=2)), [])
+        self.assertRaises(Exception, ttable.renderMany, 'unknown', envs)
+
+        # errors of the workers are raised by the iterator
+        ttable.registerTempalte('signature', lambda env, out, ttable: 1 / 0, supersede=True)
+        self.assertRaises(ZeroDivisionError, list, ttable.renderMany('letter', envs, workers=2))
+
+        # an iteration left early stops the workers on close()
+        ttable.registerTempalte('signature', lambda env, out, ttable: out.write('Bye'), supersede=True)
+        batch = ttable.renderMany('letter', envs, workers=2)
+        batch.next()
+        batch.close()
+        self.assertEqual(list(batch), [])
+
+        with ttable.renderMany('letter', envs, workers=2) as batch:
+            self.assertEqual(batch.next(), 'Dear user0, Bye')
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def testFutures(self):
+        nameSpace = parseNamespace("""
+        {namespace test}
+
+        {template page}
+            <head>{$title}</head>{call body data=\"all\" /}
+        {/template}
+
+        {template body}
+            {if $show}{call never data=\"all\" /}{/if}<p>{$profile.name}</p>
+        {/template}
+
+        {template never}
+            {$never}
+        {/template}
+        """)
+
+        ttable = self.makeTTable(nameSpace)
+
+        def makeEnv():
+            return {'title': 'Title', 'show': False, 'profile': Future(), 'never': Future()}
+
+        env = makeEnv()
+        chunks = ttable.iterTemplate('page', env)
+        head = chunks.next()
+        self.assertTrue(head.startswith('<head>Title</head>'))
+        env['profile'].set({'name': 'Masha'})
+        self.assertEqual(head + ''.join(chunks), '<head>Title</head><p>Masha</p>')
+
+        env = makeEnv()
+        result = ttable.renderAsync('page', env)
+        self.assertFalse(result.ready())
+        env['profile'].set({'name': 'Ivan'})
+        self.assertEqual(result.get(5), '<head>Title</head><p>Ivan</p>')
+
+        # more renders waiting for futures at once than the threads of the shared pool
+        waiting = []
+        class WaitedFuture(Future):
+            def result(self):
+                waiting.append(self)
+                return Future.result(self)
+
+        pooled = TTable(prototype=ttable, renderThreads=6)
+        envs = [dict(makeEnv(), profile=WaitedFuture()) for i in xrange(5)]
+        results = [pooled.renderAsync('page', env) for env in envs]
+        deadline = time.time() + 5
+        while len(waiting) < 5 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(waiting), 5)
+
+        for i, env in enumerate(envs):
+            env['profile'].set({'name': str(i)})
+        self.assertEqual([result.get(5) for result in results],
+                         ['<head>Title</head><p>%d</p>' % i for i in xrange(5)])
+
+        env = makeEnv()
+        env['profile'].set({'name': 'Masha'})
+        self.assertEqual(ttable.callTemplate('page', env), '<head>Title</head><p>Masha</p>')
+
+    def testAllocations(self):
+        nameSpace = parseNamespace("""
+        {namespace test}
+
+        {template rows}
+            {foreach $row in $rows}
+                <tr><td>{$row.name}</td><td>{index($row)}</td>{if isLast($row)}<td>last</td>{/if}</tr>
+            {/foreach}
+        {/template}
+        """)
+
+        ttable = self.makeTTable(nameSpace)
+        rows = [{'name': 'row%d' % i} for i in xrange(10000)]
+
+        # tracemalloc is not available here: count the calls that allocate
+        # a scope, a keyword dict or a filtered list instead
+        allocations = [0]
+        envInit = Env.__init__.im_func.func_code
+
+        def profile(frame, event, arg):
+            if event == 'call':
+                if (frame.f_code is envInit) or (frame.f_code.co_flags & inspect.CO_VARKEYWORDS):
+                    allocations[0] += 1
+            elif event == 'c_call' and arg is filter:
+                allocations[0] += 1
+
+        sys.setprofile(profile)
+        try:
+            result = ttable.callTemplate('rows', {'rows': rows})
+        finally:
+            sys.setprofile(None)
+
+        self.assertTrue(result.endswith('<tr><td>row9999</td><td>10000</td><td>last</td></tr>'))
+        self.assertTrue(allocations[0] < 10)
         
+class TestRenderCache(unittest.TestCase):
+    NAMESPACE = """
+    {namespace test}
+
+    {template card cache="true"}
+        <b>{$product.name}</b>{if hasData()}:{/if}{call price data="all" /}
+    {/template}
+
+    {template price}
+        {foreach $p in $prices}{$p}{if not isLast($p)},{/if}{/foreach}
+    {/template}
+
+    {template lucky cache="true"}
+        {call dice /}
+    {/template}
+
+    {template dice}
+        {randomInt(6)}
+    {/template}
+
+    {template loop cache="true"}
+        {if $n}{$n}{call loop}{param n: $n - 1 /}{/call}{/if}
+    {/template}
+
+    {template plain}
+        {$x}
+    {/template}
+
+    {template notCached cache="false"}
+        {$x}
+    {/template}
+    """
+
+    def testCache(self):
+        ttable = makeTTable(parseNamespace(self.NAMESPACE))
+        cache = ttable.renderCache
+
+        env = {'product': {'name': 'Tea'}, 'prices': [1, 2], 'unused': 1}
+        self.assertEqual(ttable.callTemplate('card', env), '<b>Tea</b>:1,2')
+        self.assertEqual(ttable.callTemplate('card', dict(env, unused=2)), '<b>Tea</b>:1,2')
+        self.assertEqual(ttable.callTemplate('card', dict(env, prices=[1, 3])), '<b>Tea</b>:1,3')
+        self.assertEqual(ttable.callTemplate('card', dict(env, prices=[1, True])), '<b>Tea</b>:1,True')
+        self.assertEqual(cache.stats(), { 'hits': 1, 'misses': 3, 'evictions': 0, 'uncacheable': 0,
+                                          'entries': 3, 'bytes': cache.bytes })
+
+        class Product(object):
+            name = 'Coffee'
+
+        self.assertEqual(ttable.callTemplate('card', dict(env, product=Product())), '<b>Coffee</b>:1,2')
+        self.assertEqual(cache.uncacheable, 1)
+
+        # the counters are not lost by concurrent renders
+        def render():
+            for i in xrange(200):
+                ttable.callTemplate('card', dict(env, product=Product()))
+        threads = [threading.Thread(target=render) for i in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.uncacheable, 1601)
+
+        # randomInt and recursion are never cached
+        ttable.callTemplate('lucky', {})
+        self.assertEqual(ttable.callTemplate('loop', {'n': 3}), '321')
+        self.assertEqual(cache.stats()['misses'], 3)
+
+        # superseding a template drops the outputs that may include it
+        ttable.registerTempalte('price', lambda env, out, ttable: out.write('none'), supersede=True)
+        self.assertEqual(ttable.callTemplate('card', env), '<b>Tea</b>:none')
+
+    def testCacheTemplates(self):
+        ttable = makeTTable(parseNamespace(self.NAMESPACE), cacheTemplates=True)
+
+        for i in xrange(2):
+            ttable.callTemplate('plain', {'x': 1})
+            ttable.callTemplate('notCached', {'x': 1})
+
+        self.assertEqual((ttable.renderCache.hits, ttable.renderCache.misses), (1, 1))
+
+    def testMaxBytes(self):
+        ttable = TTable(renderCache=RenderCache(maxBytes=2000))
+        updateTTable(parseNamespace(self.NAMESPACE), ttable)
+        cache = ttable.renderCache
+
+        for i in xrange(100):
+            ttable.callTemplate('card', {'product': {'name': 'p%d' % i}, 'prices': range(10)})
+
+        self.assertTrue(0 < cache.bytes <= 2000)
+        self.assertEqual(cache.evictions, 100 - cache.stats()['entries'])
+
+class TestCallMemo(unittest.TestCase):
+    NAMESPACE = """
+    {namespace test}
+
+    {template list}
+        {foreach $item in $items}{call badge}{param user: $item.user /}{/call}{/foreach}
+    {/template}
+
+    {template badge}
+        [{$user.name}]
+    {/template}
+
+    {template dice}
+        {foreach $i in $items}{call roll /}{/foreach}
+    {/template}
+
+    {template roll}
+        {randomInt(1000000)}.
+    {/template}
+    """
+
+    def testMemo(self):
+        class User(object):
+            renders = 0
+
+            def __init__(self, name):
+                self._name = name
+
+            @property
+            def name(self):
+                User.renders += 1
+                return self._name
+
+        ttable = makeTTable(parseNamespace(self.NAMESPACE), memoizeCalls=True)
+        alice, bob = User('alice'), User('bob')
+        env = {'items': [{'user': alice}, {'user': bob}, {'user': alice}, {'user': alice}]}
+
+        self.assertEqual(ttable.callTemplate('list', env), '[alice][bob][alice][alice]')
+        self.assertEqual(User.renders, 2)
+
+        # the memo lives for a single render
+        self.assertEqual(ttable.callTemplate('list', env), '[alice][bob][alice][alice]')
+        self.assertEqual(User.renders, 4)
+
+        self.assertEqual(''.join(ttable.iterTemplate('list', env)), '[alice][bob][alice][alice]')
+        self.assertEqual(User.renders, 6)
+
+        # randomInt is never memoized
+        rolls = ttable.callTemplate('dice', {'items': range(20)}).split('.')
+        self.assertTrue(len(set(rolls)) > 2)
+
+class TestLinks(unittest.TestCase):
+    def testLinks(self):
+        base = makeTTable(parseNamespace("""
+        {namespace base}
+
+        {template footer}
+            (c) {$year}
+        {/template}
+        """))
+
+        class CountingTTable(TTable):
+            lookups = 0
+
+            def findTemplate(self, name):
+                CountingTTable.lookups += 1
+                return TTable.findTemplate(self, name)
+
+        ttable = CountingTTable(prototype=base)
+        updateTTable(parseNamespace("""
+        {namespace test}
+
+        {template page}
+            {call header data=\"all\" /}|{call footer data=\"all\" /}|{call name=\"$part\" data=\"all\" /}
+        {/template}
+
+        {template header}
+            {$title}
+        {/template}
+        """), ttable)
+
+        env = {'title': 'Home', 'year': 2012, 'part': 'header'}
+        self.assertEqual(ttable.callTemplate('page', env), 'Home|(c) 2012|Home')
+        # the top template, the footer of the prototype and the dynamic call
+        self.assertEqual(CountingTTable.lookups, 3)
+
+        # superseding a template relinks its callers, also in the prototype
+        ttable.registerTempalte('header', lambda env, out, ttable: out.write('New'), supersede=True)
+        base.registerTempalte('footer', lambda env, out, ttable: out.write('-'), supersede=True)
+        self.assertEqual(ttable.callTemplate('page', env), 'New|-|New')
+
+        ttable.registerTempalte('footer', lambda env, out, ttable: out.write('own'))
+        self.assertEqual(ttable.callTemplate('page', env), 'New|own|New')
+
+        ttable.clear()
+        self.assertRaises(Exception, ttable.callTemplate, 'page', env)
+
+    def testOverride(self):
+        base = makeTTable(parseNamespace("""
+        {namespace base}
+
+        {template page}
+            {call footer /}
+        {/template}
+
+        {template footer}
+            [base footer]
+        {/template}
+        """))
+        self.assertEqual(base.callTemplate('page', {}), '[base footer]')
+
+        # a child table renders the templates of its prototype with its own callees
+        child = TTable(prototype=base)
+        child.registerTempalte('footer', lambda env, out, ttable: out.write('[child footer]'))
+        self.assertEqual(child.callTemplate('page', {}), '[child footer]')
+        self.assertEqual(TTable(prototype=child).callTemplate('page', {}), '[child footer]')
+
+        memo = TTable(prototype=base, memoizeCalls=True)
+        memo.registerTempalte('footer', lambda env, out, ttable: out.write('[memo footer]'))
+        self.assertEqual(memo.callTemplate('page', {}), '[memo footer]')
+        self.assertEqual(base.callTemplate('page', {}), '[base footer]')
+
+        # nor are the callees inlined into the templates of the prototype
+        inlined = makeTTable(parseNamespace("""
+        {namespace base}
+
+        {template page}
+            {foreach $x in $xs}{call footer /}{/foreach}
+        {/template}
+
+        {template footer}
+            [base footer]
+        {/template}
+        """), inlineCalls=True)
+        child = TTable(prototype=inlined)
+        child.registerTempalte('footer', lambda env, out, ttable: out.write('[child footer]'))
+        self.assertEqual(child.callTemplate('page', {'xs': [1]}), '[child footer]')
+        self.assertEqual(inlined.callTemplate('page', {'xs': [1]}), '[base footer]')
+
+class TestInstrumentation(unittest.TestCase):
+    NAMESPACE = """
+    {namespace test}
+
+    {template page}
+        <h1>{$title}</h1>{foreach $item in $items}{call item}{param x: $item /}{/call}{/foreach}
+    {/template}
+
+    {template item}
+        <li>{$x}</li>
+    {/template}
+    """
+
+    def testCounters(self):
+        events = []
+        instrumentation = Instrumentation(onEnter=lambda name, env: events.append(('enter', name)),
+                                          onExit=lambda name, env, seconds, selfSeconds, size:
+                                              events.append(('exit', name, size)))
+
+        ttable = makeTTable(parseNamespace(self.NAMESPACE), instrumentation=instrumentation)
+        self.assertEqual(ttable.callTemplate('page', {'title': 'T', 'items': [1, 22]}),
+                         '<h1>T</h1><li>1</li><li>22</li>')
+
+        self.assertEqual(events, [('enter', 'page'), ('enter', 'item'), ('exit', 'item', 10),
+                                  ('enter', 'item'), ('exit', 'item', 11), ('exit', 'page', 31)])
+
+        stats = instrumentation.stats()
+        self.assertEqual((stats['page']['calls'], stats['page']['size']), (1, 31))
+        self.assertEqual((stats['item']['calls'], stats['item']['size']), (2, 21))
+        self.assertTrue(stats['page']['seconds'] >= stats['page']['selfSeconds'] >= 0)
+        self.assertTrue(stats['page']['seconds'] >= stats['item']['seconds'])
+
+        self.assertEqual(json.loads(instrumentation.toJSON())['item']['calls'], 2)
+
+        metrics = instrumentation.toPrometheus()
+        self.assertIn('# TYPE soy_template_calls_total counter\n', metrics)
+        self.assertIn('soy_template_calls_total{template="item"} 2\n', metrics)
+        self.assertIn('soy_template_output_characters_total{template="page"} 31\n', metrics)
+
+        # templates are wrapped once, also when copied to another table
+        other = TTable(instrumentation=instrumentation)
+        other.registerTempalte('page', ttable.dict['page'])
+        self.assertIs(other.dict['page'], ttable.dict['page'])
+
+        instrumentation.reset()
+        self.assertEqual(instrumentation.stats(), {})
+
+    def testParamSize(self):
+        # the output of c is written to the buffer of the param, and then by b
+        instrumentation = Instrumentation()
+        ttable = makeTTable(parseNamespace("""
+        {namespace test}
+
+        {template a}
+            {call b}{param p}{call c data="all" /}{/param}{/call}
+        {/template}
+
+        {template b}
+            [{$p}]
+        {/template}
+
+        {template c}
+            x{$x}x
+        {/template}
+        """), instrumentation=instrumentation)
+
+        for out in [None, StringIO()]:
+            instrumentation.reset()
+            text = ttable.callTemplate('a', {'x': 'x'}, out)
+            self.assertEqual(text or out.getvalue(), '[xxx]')
+
+            stats = instrumentation.stats()
+            self.assertEqual([stats[name]['size'] for name in 'abc'], [5, 5, 3])
+
+class TestProfiler(unittest.TestCase):
+    NAMESPACE = """{namespace test}
+    {template page}
+        <h1>{$title}</h1>
+        {foreach $item in $items}
+            {call item}{param x: $item /}{/call}
+        {/foreach}
+    {/template}
+    {template item}
+        <li>{$x.name}</li>
+    {/template}
+    """
+
+    def testSamples(self):
+        profiler = Profiler()
+        ttable = makeTTable(parseNamespace(self.NAMESPACE), profiler=profiler)
+
+        class Item(object):
+            @property
+            def name(self):
+                profiler.sample()
+                return 'x'
+
+        self.assertEqual(ttable.callTemplate('page', {'title': 'T', 'items': [Item(), Item()]}),
+                         '<h1>T</h1> <li>x</li><li>x</li>')
+        self.assertEqual(profiler.collapsed(),
+                         'page test:2;test:4;test:5;item test:8;test:9 2\n')
+
+        stats = profiler.lineStats()
+        self.assertEqual(stats['test:9'], { 'self': 2, 'total': 2 })
+        self.assertEqual(stats['test:4'], { 'self': 0, 'total': 2 })
+
+    def testThread(self):
+        profiler = Profiler(interval=0.001)
+        ttable = makeTTable(parseNamespace(self.NAMESPACE), profiler=profiler)
+
+        class Item(object):
+            @property
+            def name(self):
+                time.sleep(0.05)
+                return 'x'
+
+        with profiler:
+            ttable.callTemplate('page', {'title': 'T', 'items': [Item()]})
+
+        self.assertTrue(profiler.lineStats()['test:9']['self'] > 0)
+        profiler.reset()
+        self.assertEqual(profiler.collapsed(), '')
+
+class TestEscape(unittest.TestCase):
+    def testEscapeHtml(self):
+        self.assertEqual(escapeHtml('plain text'), 'plain text')
+        self.assertEqual(escapeHtml('<a href="x">&\'</a>'), '&lt;a href=&quot;x&quot;&gt;&amp;&#039;&lt;/a&gt;')
+        self.assertEqual(escapeHtml(u'\u044f & \u044b'), u'\u044f &amp; \u044b')
+        self.assertEqual(escapeHtml('&amp;'), '&amp;amp;')
+        self.assertEqual(escapeHtml(None), '')
+        self.assertEqual(escapeHtml(42), '42')
+
+    def testEncodeUri(self):
+        self.assertEqual(encodeUri('http://example.com/a b?x=1&y=<2>'),
+                         'http://example%2Ecom/a%20b?x=%31&y=%3C%32%3E')
+        self.assertEqual(encodeUri(u'\u044f\u20ac'), '%D1%8F%E2%82%AC')
+        self.assertEqual(encodeUriComponent(u'a/b \u044f'), 'a%2Fb%20%D1%8F')
+        self.assertEqual(encodeUriComponent('plain'), 'plain')
+        self.assertEqual(encodeUriComponent(None), '')
+        self.assertEqual(encodeUriComponent(7), '7')
 
 if __name__ == "__main__":
     unittest.main()
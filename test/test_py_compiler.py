@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+import unittest
+import sys
+import os.path
+import shutil
+import tempfile
+
+sys.path[0:0] = [""]
+
+from pyclosuretempaltes.parser import parseNamespace
+from pyclosuretempaltes.python_compiler import makeCompiledTTable, compileDirectory
+from test import test_py_backend
+
+class TestPythonCompiler(test_py_backend.TestPythonBackend):
+    makeTTable = staticmethod(makeCompiledTTable)
+
+    def testDataObject(self):
+        nameSpace = parseNamespace("""
+        {namespace test}
+
+        {template author}
+            {if $full}{$city}{/if}{$name}
+        {/template}
+
+        {template book}
+            {call author data=\"$author\" /}
+        {/template}
+        """)
+
+        class Author(object):
+            name = 'Masha'
+
+        ttable = self.makeTTable(nameSpace)
+
+        self.assertEqual(ttable.callTemplate('book', {'author': Author()}), 'Masha')
+
+    def testConstantNames(self):
+        # the dispatch table of the switch of a is not the function of a_switch2
+        cases = ''.join(['{case %d}%d' % (i, i) for i in range(10)])
+        nameSpace = parseNamespace("""
+        {namespace test}
+
+        {template a}
+            {switch $x}%s{/switch}
+        {/template}
+
+        {template a_switch2}
+            b
+        {/template}
+        """ % cases)
+
+        ttable = self.makeTTable(nameSpace)
+        self.assertEqual(ttable.callTemplate('a', {'x': 3}), '3')
+        self.assertEqual(ttable.callTemplate('a_switch2', {}), 'b')
+
+class TestCompileDirectory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testPackage(self):
+        source = os.path.join(self.directory, 'soy')
+        os.makedirs(os.path.join(source, 'sub'))
+
+        with open(os.path.join(source, 'hello.soy'), 'w') as f:
+            f.write('{namespace hello}\n{template hello}Hello {call name data="all" /}{/template}')
+        with open(os.path.join(source, 'sub', 'name.soy'), 'w') as f:
+            f.write('{namespace name}\n{template name}{$name}{/template}')
+
+        target = os.path.join(self.directory, 'compiledsoy')
+        self.assertEqual(compileDirectory(source, target, workers=1), ['hello', 'sub_name'])
+        self.assertTrue(os.path.exists(os.path.join(target, 'hello.pyc')))
+
+        sys.path.insert(0, self.directory)
+        try:
+            import compiledsoy
+            ttable = compiledsoy.makeTTable()
+        finally:
+            sys.path.remove(self.directory)
+            for name in ['compiledsoy', 'compiledsoy.hello', 'compiledsoy.sub_name']:
+                sys.modules.pop(name, None)
+
+        self.assertEqual(ttable.templateNameList(), ['hello', 'name'])
+        self.assertEqual(ttable.callTemplate('hello', {'name': 'Masha'}), 'Hello Masha')
+
+    def testModuleNames(self):
+        source = os.path.join(self.directory, 'soy')
+        os.makedirs(os.path.join(source, 'a'))
+
+        for path, name in [('class.soy', 'class'), ('__init__.soy', 'init'), ('makeTTable.soy', 'make')]:
+            with open(os.path.join(source, path), 'w') as f:
+                f.write('{namespace test}\n{template %s}%s{/template}' % (name, name))
+
+        target = os.path.join(self.directory, 'keywordsoy')
+        self.assertEqual(sorted(compileDirectory(source, target, workers=1)),
+                         ['__init___', 'class_', 'makeTTable_'])
+
+        sys.path.insert(0, self.directory)
+        try:
+            import keywordsoy
+            ttable = keywordsoy.makeTTable()
+        finally:
+            sys.path.remove(self.directory)
+            for name in ['keywordsoy', 'keywordsoy.class_', 'keywordsoy.__init___', 'keywordsoy.makeTTable_']:
+                sys.modules.pop(name, None)
+
+        self.assertEqual(ttable.templateNameList(), ['class', 'init', 'make'])
+
+        # a/b.soy and a_b.soy would overwrite each other
+        for path in [os.path.join('a', 'b.soy'), 'a_b.soy']:
+            with open(os.path.join(source, path), 'w') as f:
+                f.write('{namespace b}\n{template b}b{/template}')
+        self.assertRaises(Exception, compileDirectory, source, os.path.join(self.directory, 'clash'), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'clash')))
+
+if __name__ == "__main__":
+    unittest.main()
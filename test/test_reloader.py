@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2012 Moskvitin Andrey <archimag@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You
+# may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.  See the License for the specific language governing
+# permissions and limitations under the License.
+
+import unittest
+import sys
+import os
+import os.path
+import time
+import shutil
+import tempfile
+
+sys.path[0:0] = [""]
+
+from pyclosuretempaltes.reloader import Reloader
+
+class TestReloader(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.mtime = time.time() - 100
+
+        self.write('page.soy', '{namespace page}\n{template page}{call header /}|{call footer /}{/template}')
+        self.write('parts.soy', '{namespace parts}\n{template header}Head{/template}\n{template footer}Foot{/template}')
+        self.write('other.soy', '{namespace other}\n{template other}Other{/template}')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(text)
+
+        # a new mtime even on file systems with a coarse resolution
+        self.mtime += 1
+        os.utime(path, (self.mtime, self.mtime))
+
+    def testReload(self):
+        reloader = Reloader(self.directory)
+        self.assertEqual(reloader.callTemplate('page', {}), 'Head|Foot')
+        self.assertFalse(reloader.check())
+
+        old = reloader.ttable
+        self.write('parts.soy', '{namespace parts}\n{template header}New{/template}\n{template footer}Foot{/template}')
+        self.assertTrue(reloader.check())
+        self.assertEqual(reloader.callTemplate('page', {}), 'New|Foot')
+
+        # the published table is not modified
+        self.assertEqual(old.callTemplate('page', {}), 'Head|Foot')
+
+        # only the changed file and its callers are rebuilt
+        self.assertIs(reloader.ttable.dict['other'], old.dict['other'])
+        self.assertIsNot(reloader.ttable.dict['page'], old.dict['page'])
+
+        stats = reloader.stats()
+        self.assertEqual((stats['reloads'], stats['files'], stats['templates']), (1, 1, 3))
+        self.assertTrue(stats['reloadSeconds'] >= stats['parseSeconds'])
+
+        os.remove(os.path.join(self.directory, 'other.soy'))
+        self.assertTrue(reloader.check())
+        self.assertEqual(reloader.ttable.templateNameList(), ['footer', 'header', 'page'])
+
+    def testErrors(self):
+        reloader = Reloader(self.directory)
+
+        self.write('parts.soy', '{namespace parts}\n{template header}{if $x}{/template}')
+        self.write('page.soy', '{namespace page}\n{template page}{call header /}!{/template}')
+        self.assertFalse(reloader.check())
+        self.assertFalse(reloader.check())
+        self.assertEqual(reloader.stats()['errors'], 1)
+        self.assertEqual(reloader.callTemplate('page', {}), 'Head|Foot')
+
+        # a duplicate template is an error too
+        self.write('parts.soy', '{namespace parts}\n{template header}H{/template}\n{template other}O{/template}')
+        self.assertFalse(reloader.check())
+        self.assertEqual(reloader.stats()['errors'], 2)
+
+        self.write('parts.soy', '{namespace parts}\n{template header}H{/template}')
+        self.assertTrue(reloader.check())
+        self.assertEqual(reloader.callTemplate('page', {}), 'H!')
+        self.assertEqual(reloader.stats()['lastError'], None)
+
+    def testWatch(self):
+        reloader = Reloader(self.directory, interval=0.01)
+        reloader.start()
+        try:
+            self.write('other.soy', '{namespace other}\n{template other}Changed{/template}')
+
+            deadline = time.time() + 5
+            while reloader.stats()['reloads'] == 0 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            reloader.stop()
+
+        self.assertEqual(reloader.callTemplate('other', {}), 'Changed')
+
+if __name__ == "__main__":
+    unittest.main()